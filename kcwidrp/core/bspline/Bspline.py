@@ -140,7 +140,8 @@ class Bspline(object):
 
         return
 
-    def fit(self, xdata, ydata, invvar, x2=None):
+    def fit(self, xdata, ydata, invvar, x2=None, action=None, lower=None,
+            upper=None):
         """Calculate a B-spline in the least-squares sense.
 
         Fit is based on two variables: `xdata` sorted and spans a large range
@@ -157,6 +158,15 @@ class Bspline(object):
             Inverse variance of `ydata`.
         x2 : :class:`numpy.ndarray`, optional
             Orthogonal dependent variable for 2d fits.
+        action : :class:`numpy.ndarray`, optional
+            Action matrix to use, from :meth:`action` with the current
+            breakpoint mask.  If not supplied it is calculated.
+        lower : :class:`numpy.ndarray`, optional
+            If the action parameter is supplied, this parameter must also
+            be supplied.
+        upper : :class:`numpy.ndarray`, optional
+            If the action parameter is supplied, this parameter must also
+            be supplied.
 
         Returns
         -------
@@ -172,28 +182,13 @@ class Bspline(object):
             yfit = np.zeros(ydata.shape, dtype='f')
             return -2, yfit
         nfull = nn * self.npoly
-        bw = self.npoly * self.nord
-        a1, lower, upper = self.action(xdata, x2=x2)
-        foo = np.tile(invvar, bw).reshape(bw, invvar.size).transpose()
-        a2 = a1 * foo
-        alpha = np.zeros((bw, nfull+bw), dtype='d')
-        beta = np.zeros((nfull+bw,), dtype='d')
-        bi = np.arange(bw, dtype='i4')
-        bo = np.arange(bw, dtype='i4')
-        for k in range(1, bw):
-            bi = np.append(bi, np.arange(bw-k, dtype='i4')+(bw+1)*k)
-            bo = np.append(bo, np.arange(bw-k, dtype='i4')+bw*k)
-        for k in range(nn-self.nord+1):
-            itop = k*self.npoly
-            ibottom = min(itop, nfull) + bw - 1
-            ict = upper[k] - lower[k] + 1
-            if ict > 0:
-                work = np.dot(a1[lower[k]:upper[k]+1, :].T,
-                              a2[lower[k]:upper[k]+1, :])
-                wb = np.dot(ydata[lower[k]:upper[k]+1],
-                            a2[lower[k]:upper[k]+1, :])
-                alpha.T.flat[bo+itop*bw] += work.flat[bi]
-                beta[itop:ibottom+1] += wb
+        if action is None:
+            a1, lower, upper = self.action(xdata, x2=x2)
+        else:
+            a1 = action
+        a2 = a1 * invvar[:, np.newaxis]
+        alpha, beta = band_normal_equations(a1, a2, ydata, lower, upper,
+                                            nn-self.nord+1, self.npoly, nfull)
         min_influence = 1.0e-10 * invvar.sum() / nfull
         errb = cholesky_band(alpha, mininf=min_influence)
         if isinstance(errb[0], int) and errb[0] == -1:
@@ -300,13 +295,13 @@ class Bspline(object):
         """
         gb = self.breakpoints[self.mask]
         n = gb.size - self.nord
-        indx = np.zeros((x.size,), dtype='i4')
-        ileft = self.nord - 1
-        for i in range(x.size):
-            while x[i] > gb[ileft+1] and ileft < n - 1:
-                ileft += 1
-            indx[i] = ileft
-        return indx
+        # first segment whose upper breakpoint is not below each value
+        indx = np.searchsorted(gb, x, side='left') - 1
+        indx = np.clip(indx, self.nord - 1, max(n - 1, self.nord - 1))
+        # segments never move left, so NaNs and any unsorted values keep
+        # the segment of the previous value
+        indx[np.isnan(x)] = self.nord - 1
+        return np.maximum.accumulate(indx).astype('i4')
 
     def bsplvn(self, x, ileft):
         """Calculates the value of all possibly nonzero B-splines at `x`
@@ -391,12 +386,11 @@ class Bspline(object):
         else:
             goodcoeff = self.coeff[coeffbk]
         # maskthis = np.zeros(xwork.shape,dtype=xwork.dtype)
-        for i in range(n-self.nord+1):
-            ict = upper[i] - lower[i] + 1
-            if ict > 0:
-                yfit[lower[i]:upper[i] + 1] = np.dot(
-                    action[lower[i]:upper[i] + 1, :],
-                    (goodcoeff.flatten('F'))[i * self.npoly + spot])
+        kseg, ipts, iseg = band_segments(lower, upper, n-self.nord+1)
+        if ipts.size > 0:
+            cidx = kseg[iseg, np.newaxis] * self.npoly + spot
+            yfit[ipts] = np.einsum('ij,ij->i', action[ipts, :],
+                                   goodcoeff.flatten('F')[cidx])
         yy = yfit.copy()
         yy[xsort] = yfit
         mask = np.ones(x.shape, dtype='bool')
@@ -493,30 +487,10 @@ class Bspline(object):
             yfit = np.zeros(ydata.shape, dtype=float)
             return -2, yfit
         nfull = nn * self.npoly
-        bw = self.npoly * self.nord
-        foo = np.sqrt(np.tile(invvar, bw).reshape(bw, invvar.size).transpose())
-        a2 = action * foo
-        # a2 = action*np.sqrt(np.outer(invvar,np.ones(bw)))
-
-        alpha = np.zeros((bw, nfull + bw), dtype='d')
-        beta = np.zeros((nfull + bw,), dtype='d')
-        bi = np.arange(bw, dtype='i4')
-        bo = np.arange(bw, dtype='i4')
-        for k in range(1, bw):
-            bi = np.append(bi, np.arange(bw - k, dtype='i4') + (bw + 1) * k)
-            bo = np.append(bo, np.arange(bw - k, dtype='i4') + bw * k)
-        for k in range(nn - self.nord + 1):
-            itop = k * self.npoly
-            ibottom = min(itop, nfull) + bw - 1
-            ict = upper[k] - lower[k] + 1
-            if ict > 0:
-                work = np.dot(a2[lower[k]:upper[k] + 1, :].T,
-                              a2[lower[k]:upper[k] + 1, :])
-                wb = np.dot(ydata[lower[k]:upper[k] + 1] * np.sqrt(
-                    invvar[lower[k]:upper[k] + 1]),
-                            a2[lower[k]:upper[k] + 1, :])
-                alpha.T.flat[bo + itop * bw] += work.flat[bi]
-                beta[itop:ibottom + 1] += wb
+        a2 = action * np.sqrt(invvar)[:, np.newaxis]
+        alpha, beta = band_normal_equations(a2, a2, ydata * np.sqrt(invvar),
+                                            lower, upper, nn - self.nord + 1,
+                                            self.npoly, nfull)
         min_influence = 1.0e-10 * invvar.sum() / nfull
         # Right now we are not returning the covariance,
         # although it may arise that we should
@@ -555,6 +529,85 @@ class Bspline(object):
         return 0, yfit
 
 
+def band_segments(lower, upper, nseg):
+    """Find the data points in each breakpoint segment.
+
+    Parameters
+    ----------
+    lower : :class:`numpy.ndarray`
+        First data point in each segment.
+    upper : :class:`numpy.ndarray`
+        Last data point in each segment, less than `lower` if it is empty.
+    nseg : :class:`int`
+        Number of segments to use.
+
+    Returns
+    -------
+    :func:`tuple`
+        A tuple containing the non-empty segments, the data points in those
+        segments, and the position in the non-empty segments of each point.
+    """
+    lower = np.asarray(lower[:nseg], dtype=int)
+    upper = np.asarray(upper[:nseg], dtype=int)
+    count = upper - lower + 1
+    kseg = (count > 0).nonzero()[0]
+    count = count[kseg]
+    iseg = np.repeat(np.arange(kseg.size), count)
+    start = np.cumsum(count) - count
+    ipts = np.arange(count.sum()) - np.repeat(start - lower[kseg], count)
+    return kseg, ipts, iseg
+
+
+def band_normal_equations(a1, a2, ydata, lower, upper, nseg, npoly, nfull):
+    """Assemble the banded normal equations of a B-spline fit.
+
+    The products of the action matrix columns are summed over the data
+    points of every breakpoint segment at once, instead of one segment at
+    a time.
+
+    Parameters
+    ----------
+    a1 : :class:`numpy.ndarray`
+        Action matrix, with dimensions [ndata, bandwidth].
+    a2 : :class:`numpy.ndarray`
+        Weighted action matrix.
+    ydata : :class:`numpy.ndarray`
+        Dependent variable, weighted to match `a2`.
+    lower : :class:`numpy.ndarray`
+        First data point in each segment.
+    upper : :class:`numpy.ndarray`
+        Last data point in each segment.
+    nseg : :class:`int`
+        Number of segments to use.
+    npoly : :class:`int`
+        Polynomial order of the 2nd variable.
+    nfull : :class:`int`
+        Number of coefficients.
+
+    Returns
+    -------
+    :func:`tuple`
+        A tuple containing the padded, *lower* banded matrix and the right
+        hand side vector.
+    """
+    bw = a1.shape[1]
+    alpha = np.zeros((bw, nfull+bw), dtype='d')
+    beta = np.zeros((nfull+bw,), dtype='d')
+    kseg, ipts, iseg = band_segments(lower, upper, nseg)
+    if kseg.size == 0:
+        return alpha, beta
+    itop = kseg * npoly
+    a1 = a1[ipts, :]
+    a2 = a2[ipts, :]
+    for k in range(bw):
+        for m in range(bw-k):
+            alpha[m, itop+k] += np.bincount(iseg, weights=a1[:, k]*a2[:, k+m],
+                                            minlength=kseg.size)
+        beta[itop+k] += np.bincount(iseg, weights=ydata[ipts]*a2[:, k],
+                                    minlength=kseg.size)
+    return alpha, beta
+
+
 def cholesky_band(ndl, mininf=0.0):
     """Compute *lower* Cholesky decomposition of a banded matrix.
 
@@ -642,6 +695,70 @@ def cholesky_solve(a, bb):
     return x
 
 
+def binned_invvar(xwork, ywork, maskwork, invwork, nbins=1000):
+    """Estimate the inverse variance in bins of the independent variable.
+
+    The variance of the unmasked data is measured in `nbins` equal bins
+    spanning `xwork`, and assigned to the points strictly inside each bin.
+    Points in bins without a finite inverse variance keep their values.
+    Bins that overlap by rounding are applied in order, as in a loop over
+    the bins.
+
+    Parameters
+    ----------
+    xwork : :class:`numpy.ndarray`
+        Independent variable.
+    ywork : :class:`numpy.ndarray`
+        Dependent variable.
+    maskwork : :class:`numpy.ndarray`
+        Mask of the good points.
+    invwork : :class:`numpy.ndarray`
+        Current inverse variance of `ywork`.
+    nbins : :class:`int`, optional
+        Number of bins.
+
+    Returns
+    -------
+    :class:`numpy.ndarray`
+        Updated inverse variance.
+    """
+    xmin = np.min(xwork)
+    xmax = np.max(xwork)
+    bin0 = np.linspace(xmin, xmax, nbins)
+    bin1 = bin0 + (xmax - xmin)/(nbins-1)
+    # variance of good points with bin0 <= x < bin1
+    jlo = np.searchsorted(bin1, xwork, side='right')
+    jhi = np.searchsorted(bin0, xwork, side='right') - 1
+    nin = np.maximum(jhi - jlo + 1, 0)
+    good = maskwork.astype(bool)
+    count = np.zeros(nbins)
+    total = np.zeros(nbins)
+    for off in np.arange(nin.max(initial=0)):
+        sel = good & (nin > off)
+        count += np.bincount(jlo[sel]+off, minlength=nbins)
+        total += np.bincount(jlo[sel]+off, weights=ywork[sel],
+                             minlength=nbins)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = total / count
+        sumsq = np.zeros(nbins)
+        for off in np.arange(nin.max(initial=0)):
+            sel = good & (nin > off)
+            jj = jlo[sel]+off
+            sumsq += np.bincount(jj, weights=(ywork[sel]-mean[jj])**2,
+                                 minlength=nbins)
+        binvar = 1/(sumsq / count)
+    finite = np.isfinite(binvar)
+    # assign to points with bin0 < x < bin1, later bins win
+    invwork = invwork.copy()
+    jhi = np.searchsorted(bin0, xwork, side='left') - 1
+    nin = np.maximum(jhi - jlo + 1, 0)
+    for off in np.arange(nin.max(initial=0)):
+        jj = np.minimum(jlo + off, nbins-1)
+        sel = (nin > off) & finite[jj]
+        invwork[sel] = binvar[jj[sel]]
+    return invwork
+
+
 def iterfit(xdata, ydata, invvar=None, upper=5, lower=5, x2=None,
             maxiter=4, nord=4, bkpt=None, fullbkpt=None,
             kwargs_bspline={}, kwargs_reject={}):
@@ -748,6 +865,7 @@ def iterfit(xdata, ydata, invvar=None, upper=5, lower=5, x2=None,
     iiter = 0
     error = 0
     qdone = False
+    action = None
     while (error != 0 or qdone is False) and iiter <= maxiter:
         # print('xwork')
         # print(xwork)
@@ -759,26 +877,7 @@ def iterfit(xdata, ydata, invvar=None, upper=5, lower=5, x2=None,
         #         continue
         #     testvar = np.var(ywork[(maskwork==True) & (xwork > fullbkpt[i]) & (xwork < fullbkpt[i+1])])
         #     invwork[(xwork > fullbkpt[i]) & (xwork < fullbkpt[i+1])] = 1/testvar
-        bk = 1000
-        # print(bk)
-        arr = np.linspace(np.min(xwork), np.max(xwork), bk)
-        range = (np.max(xwork) - np.min(xwork))/(bk-1)
-        for i in arr:
-            # print(np.min(xwork), np.max(xwork))
-
-            testvar = np.var(ywork[(maskwork==True) & (xwork >= i) & (xwork < i+range)])
-            # if len(invwork[(xwork >= i) & (xwork < i+range)]) < 50:
-            #
-            #     print(len(invwork[(xwork > i) & (xwork < i+range)]))
-            # if (testvar == 0) or (testvar == np.inf) or (testvar == np.nan):
-            #     testvar = np.var(ywork[(maskwork==True) & (xwork > i-range) & (xwork < i)])
-            # print(testvar, 1/testvar)
-            if ~np.isfinite((1/testvar)):
-                # print(testvar, 1/testvar)
-                continue
-                # testvar = np.var(ywork[(maskwork==True) & (xwork >= i-range) & (xwork < i)])
-                # print(f'New testvar: {testvar}')
-            invwork[(xwork > i) & (xwork < i+range)] = 1/testvar
+        invwork = binned_invvar(xwork, ywork, maskwork, invwork)
 
         goodbk = sset.mask.nonzero()[0]
         if maskwork.sum() <= 1 or not sset.mask.any():
@@ -803,8 +902,13 @@ def iterfit(xdata, ydata, invvar=None, upper=5, lower=5, x2=None,
 
             # print(invwork*maskwork)
             # print(len(invwork*maskwork))
+            # the action matrix only changes if breakpoints were dropped
+            if action is None or not np.array_equal(action_mask, sset.mask):
+                action_mask = sset.mask.copy()
+                action, alower, aupper = sset.action(xwork, x2=x2work)
             error, yfit = sset.fit(xwork, ywork, invwork*maskwork,
-                                   x2=x2work)
+                                   x2=x2work, action=action, lower=alower,
+                                   upper=aupper)
             # print(f'yfit length: {len(yfit)}')
             # print('yfit')
             # print(yfit)
@@ -15,9 +15,9 @@ def kcwi_correct_extin(img, hdr, logger=None):
     package = __name__.split('.')[0]
     full_path = pkg_resources.resource_filename(package, path)
     if os.path.exists(full_path):
-        hdul = pf.open(full_path)
-        exwl = hdul[1].data['LAMBDA']
-        exma = hdul[1].data['EXT']
+        with pf.open(full_path) as hdul:
+            exwl = np.array(hdul[1].data['LAMBDA'])
+            exma = np.array(hdul[1].data['EXT'])
         # get object wavelengths
         sz = img.shape
         dw = hdr['CD3_3']
@@ -31,10 +31,8 @@ def kcwi_correct_extin(img, hdr, logger=None):
         # convert to flux ratio
         flxr = 10.**(oexma * air * 0.4)
         if len(sz) == 3:
-            # apply to cube
-            for ix in range(sz[2]):
-                for iy in range(sz[1]):
-                    img[:, iy, ix] *= flxr
+            # apply to cube, in place, broadcasting along wavelength
+            img *= flxr[:, np.newaxis, np.newaxis]
         else:
             # apply to vector
             img *= flxr
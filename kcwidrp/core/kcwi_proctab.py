@@ -1,67 +1,223 @@
-from astropy.table import Table, unique
+from astropy.table import Table
+from astropy.io import ascii
+import numpy as np
+import atexit
+import json
 import os
 import logging
 
 
 class Proctab:
+    """Processing table of all frames and products of a reduction
+
+    Rows are held in memory, unique on (CID, FRAMENO, TYPE), with hash
+    indexes on (CAM, TYPE, CID) and (CAM, TYPE, DID) and a sorted MJD
+    index per indexed group for nearest lookups.  New rows are appended to
+    a journal file (the proc table file name plus '.jnl') by write_proctab.
+    The legacy fixed-width proc table file is only rewritten by
+    compact_proctab, which is also run at interpreter exit.
+    Callers can wait_for rows with given index keys instead of polling
+    search_proctab.
+    """
+
+    cnames = ('FRAMENO', 'CID', 'DID', 'TYPE', 'GRPID', 'TTIME', 'CAM',
+              'IFU', 'GRAT', 'GANG', 'CWAVE', 'BIN', 'FILT', 'MJD',
+              'STAGE', 'SUFF', 'OFNAME', 'TARGNAME', 'filename')
+    dtypes = ('int32', 'S24', 'int64', 'S9', 'S12', 'float64', 'S4',
+              'S6', 'S5', 'float64', 'float64', 'S4', 'S5', 'float64',
+              'int32', 'S5', 'S25', 'S25', 'S25')
 
     def __init__(self, logger):
         self.log = logging.getLogger('KCWI')
-        self.proctab = None
+        self.tfil = 'kcwi.proc'
+        # rows keyed on the unique (CID, FRAMENO, TYPE) key
+        self.rows = None
+        # (CAM, TYPE, 'CID' or 'DID', value) -> {row key: row}
+        self.index = {}
+        # (CAM, TYPE, 'CID' or 'DID', value) -> sorted unique MJDs
+        self.mjd_index = {}
+        # (CAM, MJD) -> number of rows
+        self.cam_mjds = {}
+        # rows not yet written to the journal
+        self.pending = []
+        # materialized table, rebuilt when rows change
+        self.table = None
+        # rows changed since the legacy file was last written
+        self.dirty = False
+        self.compact_registered = False
+        # index key -> waiters for a row with that key, see wait_for
+        self.waiters = {}
+
+    @property
+    def proctab(self):
+        """The proc table as an astropy Table sorted on FRAMENO"""
+        if self.rows is None:
+            return None
+        if self.table is None:
+            self.table = self.make_table(self.rows.values())
+        return self.table
+
+    def make_table(self, rows):
+        """Build a proc table from a sequence of row dictionaries"""
+        rows = sorted(rows, key=lambda r: r['FRAMENO'])
+        columns = []
+        for name, dtype in zip(self.cnames, self.dtypes):
+            values = [row[name] for row in rows]
+            # prevent string column truncation
+            if dtype.startswith('S'):
+                columns.append(np.array(values, dtype='object'))
+            else:
+                columns.append(np.array(values, dtype=dtype))
+        tab = Table(columns, names=self.cnames,
+                    meta={'KCWI DRP PROC TABLE': 'new table'})
+        # format columns
+        tab['GANG'].format = '7.2f'
+        tab['CWAVE'].format = '8.2f'
+        tab['MJD'].format = '15.6f'
+        return tab
+
+    def make_row(self, values):
+        """Coerce a sequence of column values to a row dictionary"""
+        row = {}
+        for name, dtype, value in zip(self.cnames, self.dtypes, values):
+            if dtype.startswith('S'):
+                row[name] = '' if np.ma.is_masked(value) else str(value)
+            elif dtype.startswith('int'):
+                row[name] = int(value)
+            elif value is None or np.ma.is_masked(value):
+                row[name] = np.nan
+            else:
+                row[name] = float(value)
+        return row
+
+    @staticmethod
+    def index_keys(row):
+        """Return the hash index keys for a row"""
+        cam = row['CAM'].strip()
+        return ((cam, row['TYPE'], 'CID', row['CID']),
+                (cam, row['TYPE'], 'DID', row['DID']))
+
+    def add_row(self, row):
+        """Insert or replace a row and update the indexes"""
+        key = (row['CID'], row['FRAMENO'], row['TYPE'])
+        old = self.rows.pop(key, None)
+        if old is not None:
+            for ikey in self.index_keys(old):
+                del self.index[ikey][key]
+                self.mjd_index.pop(ikey, None)
+            cam_mjd = (old['CAM'].strip(), old['MJD'])
+            self.cam_mjds[cam_mjd] -= 1
+            if self.cam_mjds[cam_mjd] <= 0:
+                del self.cam_mjds[cam_mjd]
+        self.rows[key] = row
+        for ikey in self.index_keys(row):
+            self.index.setdefault(ikey, {})[key] = row
+            self.mjd_index.pop(ikey, None)
+        cam_mjd = (row['CAM'].strip(), row['MJD'])
+        self.cam_mjds[cam_mjd] = self.cam_mjds.get(cam_mjd, 0) + 1
+        self.table = None
+        # wake up anyone waiting for this row
+        for ikey in self.index_keys(row):
+            for waiter in self.waiters.pop(ikey, []):
+                if waiter:
+                    waiter.pop()()
 
     def new_proctab(self):
-        cnames = ('FRAMENO', 'CID', 'DID', 'TYPE', 'GRPID', 'TTIME', 'CAM',
-                  'IFU', 'GRAT', 'GANG', 'CWAVE', 'BIN', 'FILT', 'MJD',
-                  'STAGE', 'SUFF', 'OFNAME', 'TARGNAME', 'filename')
-        dtypes = ('int32', 'S24', 'int64', 'S9', 'S12', 'float64', 'S4',
-                  'S6', 'S5', 'float64', 'float64', 'S4', 'S5', 'float64',
-                  'int32', 'S5', 'S25', 'S25', 'S25')
-        meta = {'KCWI DRP PROC TABLE': 'new table'}
-        self.proctab = Table(names=cnames, dtype=dtypes, meta=meta)
-        # prevent string column truncation
-        for col in self.proctab.itercols():
-            if col.dtype.kind in 'SU':
-                self.proctab.replace_column(col.name, col.astype('object'))
+        self.rows = {}
+        self.index = {}
+        self.mjd_index = {}
+        self.cam_mjds = {}
+        self.pending = []
+        self.table = None
+        self.dirty = False
 
     def read_proctab(self, tfil='kcwi.proc'):
+        self.tfil = tfil
+        self.new_proctab()
         if os.path.isfile(tfil):
             self.log.info("reading proc table file: %s" % tfil)
-            self.proctab = Table.read(tfil, format='ascii.fixed_width')
-            self.proctab.dtypes = ('int32', 'S24', 'int64', 'S9', 'S12',
-                                   'float64', 'S4', 'S6', 'S5', 'float64',
-                                   'float64', 'S4', 'S5', 'float64', 'int32',
-                                   'S5', 'S25', 'S25', 'S25')
+            # keep string columns as strings, even if they look numeric
+            converters = {name: [ascii.convert_numpy(str)]
+                          for name, dtype in zip(self.cnames, self.dtypes)
+                          if dtype.startswith('S')}
+            tab = Table.read(tfil, format='ascii.fixed_width',
+                             converters=converters)
+            for trow in tab:
+                self.add_row(self.make_row([trow[c] for c in self.cnames]))
         else:
             self.log.info("proc table file not found: %s" % tfil)
-            self.new_proctab()
-        if len(self.proctab) == 0:
-            self.new_proctab()
-        # format columns
-        self.proctab['GANG'].format = '7.2f'
-        self.proctab['CWAVE'].format = '8.2f'
-        self.proctab['MJD'].format = '15.6f'
-        # prevent string column truncation
-        for col in self.proctab.itercols():
-            if col.dtype.kind in 'SU':
-                self.proctab.replace_column(col.name, col.astype('object'))
-
-    def write_proctab(self, tfil='kcwi.proc'):
-        if self.proctab is not None:
+        # replay rows journaled since the last compaction
+        jfil = self.journal_file(tfil)
+        if os.path.isfile(jfil):
+            self.log.info("replaying proc table journal: %s" % jfil)
+            with open(jfil) as jfile:
+                for line in jfile:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        self.log.warning("skipping bad journal entry: %s" %
+                                         line)
+                        continue
+                    self.add_row(self.make_row([entry.get(c)
+                                                for c in self.cnames]))
+                    self.dirty = True
+        if not self.compact_registered:
+            atexit.register(self.compact_proctab)
+            self.compact_registered = True
+
+    @staticmethod
+    def journal_file(tfil):
+        return tfil + '.jnl'
+
+    def write_proctab(self, tfil=None):
+        """Append new rows to the proc table journal"""
+        if tfil is None:
+            tfil = self.tfil
+        if self.rows is not None:
+            if self.pending:
+                with open(self.journal_file(tfil), 'a') as jfile:
+                    for row in self.pending:
+                        jfile.write(json.dumps(row) + '\n')
+                self.log.info("journaled %d proc table rows" %
+                              len(self.pending))
+                self.pending = []
+        else:
+            self.log.info("no proc table to write")
+
+    def compact_proctab(self, tfil=None):
+        """Write the legacy proc table file and clear the journal"""
+        if tfil is None:
+            tfil = self.tfil
+        if self.rows is not None:
+            if not self.dirty and os.path.isfile(tfil):
+                self.log.info("proc table file is up to date: %s" % tfil)
+                return
             if os.path.isfile(tfil):
                 over_write = True
             else:
                 over_write = False
-
-            self.proctab.write(filename=tfil, format='ascii.fixed_width',
-                               overwrite=over_write)
-            self.log.info("writing proc table file: %s" % tfil)
+            try:
+                self.proctab.write(filename=tfil, format='ascii.fixed_width',
+                                   overwrite=over_write)
+                self.log.info("writing proc table file: %s" % tfil)
+                jfil = self.journal_file(tfil)
+                if os.path.isfile(jfil):
+                    os.remove(jfil)
+            except OSError as e:
+                self.log.error("unable to write proc table file: %s" % e)
+                return
+            self.pending = []
+            self.dirty = False
         else:
             self.log.info("no proc table to write")
 
     def update_proctab(self, frame, suffix='raw', newtype=None, filename=""):
         if filename == "":
             self.log.error(f"No filename given for {frame.header['OFNAME']}")
-        if frame is not None and self.proctab is not None:
+        if frame is not None and self.rows is not None:
             stages = {'RAW': 0,
                       'mbias': 1,
                       'int': 1,
@@ -128,71 +284,101 @@ class Proctab:
                        trgnm,
                        filename]
         else:
-            new_row = None
+            self.log.warning("Unable to update proctab")
+            return
         # print("Attempting to add %s" % str(new_row))
-        self.proctab.add_row(new_row)
-        self.proctab = unique(self.proctab, keys=['CID', 'FRAMENO', 'TYPE'],
-                              keep='last')
-        self.proctab.sort('FRAMENO')
+        row = self.make_row(new_row)
+        self.add_row(row)
+        self.pending.append(row)
+        self.dirty = True
         self.log.info(f"proctable updated with {frame.header['OFNAME']} and {filename}")
 
+    @staticmethod
+    def search_key(frame, target_type):
+        """Return the index key search_proctab uses for a target type"""
+        cam = frame.header['CAMERA'].strip()
+        # BIASES and DARKS are matched on CCDCFG, the rest on STATEID
+        if 'BIAS' in target_type or target_type in ('DARK', 'MDARK'):
+            return cam, target_type, 'DID', int(frame.header['CCDCFG'])
+        return cam, target_type, 'CID', str(frame.header['STATEID'])
+
+    def wait_for(self, ikeys, callback):
+        """Call callback once a row with any of the index keys is added"""
+        # shared by all the keys, so the callback only runs once
+        waiter = [callback]
+        for ikey in ikeys:
+            self.waiters.setdefault(ikey, []).append(waiter)
+
+    def nearest_mjd(self, ikey, mjd):
+        """Return the MJD in an index group nearest to the given MJD"""
+        if ikey not in self.mjd_index:
+            self.mjd_index[ikey] = np.unique(
+                [row['MJD'] for row in self.index[ikey].values()])
+        mjds = self.mjd_index[ikey]
+        ii = np.searchsorted(mjds, mjd)
+        candidates = mjds[max(ii - 1, 0):ii + 1]
+        return candidates[np.argmin(np.abs(candidates - mjd))]
+
     def search_proctab(self, frame, target_type=None, target_group=None,
                   nearest=False, return_ofname=True):
         self.frame = frame
-        if target_type is not None and self.proctab is not None:
+        if target_type is not None and self.rows is not None:
             self.log.info('Looking for %s frames' % target_type)
             # get relevant camera (blue or red)
             self.log.info('Camera is %s' % self.frame.header['CAMERA'])
-            tab = self.proctab[(self.proctab['CAM'] ==
-                                self.frame.header['CAMERA'].strip())]
             # get target type images
-            tab = tab[(self.proctab['TYPE'] == target_type)]
             self.log.info('Target type is %s' % target_type)
+            filtered = False
             # BIASES must have the same CCDCFG
             if 'BIAS' in target_type:
                 self.log.info('Looking for frames with CCDCFG = %s' %
                               self.frame.header['CCDCFG'])
-                tab = tab[(tab['DID'] == int(self.frame.header['CCDCFG']))]
+                ikey = self.search_key(self.frame, target_type)
+                rows = list(self.index.get(ikey, {}).values())
                 if target_group is not None:
                     self.log.info('Looking for frames with GRPID = %s' %
                                   target_group)
-                    tab = tab[(tab['GRPID'] == target_group)]
+                    rows = [r for r in rows if r['GRPID'] == target_group]
+                    filtered = True
             # raw DARKS must have the same CCDCFG and TTIME
             elif target_type == 'DARK':
                 self.log.info('Looking for frames with CCDCFG = %s and '
                               'TTIME = %f' % (self.frame.header['CCDCFG'],
                                               self.frame.header['TTIME']))
-                tab = tab[tab['DID'] == int(self.frame.header['CCDCFG'])]
-                tab = tab[tab['TTIME'] == float(self.frame.header['TTIME'])]
+                ikey = self.search_key(self.frame, target_type)
+                ttime = float(self.frame.header['TTIME'])
+                rows = [r for r in self.index.get(ikey, {}).values()
+                        if r['TTIME'] == ttime]
+                filtered = True
                 if target_group is not None:
                     self.log.info('Looking for frames with GRPID = %s' %
                                   target_group)
-                    tab = tab[tab['GRPID'] == target_group]
+                    rows = [r for r in rows if r['GRPID'] == target_group]
             # MDARKS must have the same CCDCFG, will be scaled to match TTIME
             elif target_type == 'MDARK':
                 self.log.info('Looking for frames with CCDCFG = %s' %
                               self.frame.header['CCDCFG'])
-                tab = tab[(tab['DID'] == int(self.frame.header['CCDCFG']))]
+                ikey = self.search_key(self.frame, target_type)
+                rows = list(self.index.get(ikey, {}).values())
             else:
                 self.log.info('Looking for frames with STATEID = %s (%s)' %
                               (self.frame.header['STATEID'], self.frame.header['STATENAM']))
-                tab = tab[(tab['CID'] == self.frame.header['STATEID'])]
+                ikey = self.search_key(self.frame, target_type)
+                rows = list(self.index.get(ikey, {}).values())
             # Check if nearest entry is requested
-            if nearest and len(tab) > 1:
+            if nearest and len(rows) > 1:
                 tfno = self.frame.header['MJD']
-                minoff = 99999
-                trow = None
-                for row in tab:
-                    off = abs(row['MJD'] - tfno)
-                    if off < minoff:
-                        minoff = off
-                        trow = row
-                if trow is not None:
-                    tab = tab[(tab['MJD'] == trow['MJD'])]
+                if filtered:
+                    near = min(rows, key=lambda r: (abs(r['MJD'] - tfno),
+                                                    r['FRAMENO']))['MJD']
+                else:
+                    near = self.nearest_mjd(ikey, tfno)
+                rows = [r for r in rows if r['MJD'] == near]
+            tab = self.make_table(rows)
         else:
             if target_type is None:
                 self.log.warning("No target for proctab")
-            if self.proctab is None:
+            if self.rows is None:
                 self.log.warning("Proctab is empty")
             tab = None
         return tab
@@ -200,10 +386,5 @@ class Proctab:
     def in_proctab(self, frame):
         self.frame = frame
         # get relevant camera (blue or red)
-        tab = self.proctab[(self.proctab['CAM'] ==
-                            self.frame.header['CAMERA'].strip())]
-        imno_list = tab['MJD']
-        if self.frame.header['MJD'] in imno_list:
-            return True
-        else:
-            return False
+        return (self.frame.header['CAMERA'].strip(),
+                float(self.frame.header['MJD'])) in self.cam_mjds
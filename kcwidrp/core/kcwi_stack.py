@@ -0,0 +1,86 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+from astropy.stats import mad_std
+
+
+def combine_rows(images, r0, r1, method, low_thresh, high_thresh):
+    """Sigma clip and combine rows r0:r1 of a stack of images
+
+    Follows ccdproc.combine with sigma_clip=True: one clipping pass about
+    the mean with the (population) standard deviation, then a NaN-aware
+    average or median of the surviving pixels.
+    """
+    stack = np.stack([np.asarray(im[r0:r1], dtype=np.float64)
+                      for im in images])
+    nimg = len(images)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        center = stack.mean(axis=0)
+        dev = stack.std(axis=0)
+        # a non-finite pixel makes the bounds NaN, clipping its whole column
+        clipped = ~((stack >= center - low_thresh * dev) &
+                    (stack <= center + high_thresh * dev))
+        nmasked = clipped.sum(axis=0)
+        ngood = nimg - nmasked
+        data = np.where(clipped, np.nan, stack)
+        if method == 'median':
+            comb = np.nanmedian(data, axis=0)
+            unc = mad_std(data, axis=0, ignore_nan=True)
+        else:
+            good = np.where(clipped, 0., stack)
+            comb = good.sum(axis=0) / ngood
+            dev = np.where(clipped, 0., stack - comb)
+            unc = np.sqrt((dev * dev).sum(axis=0) / ngood)
+        unc = np.asarray(unc) / np.sqrt(ngood)
+    return comb, nmasked == nimg, unc
+
+
+def sigma_clip_combine(images, method='average', low_thresh=3.,
+                       high_thresh=3., chunk_rows=256, nthreads=0,
+                       diff_pair=None):
+    """Sigma-clipped combine of a stack of images, in parallel row chunks
+
+    Only chunk_rows rows of each image are in memory at a time per thread,
+    so the inputs can be memory mapped.
+
+    Args:
+        images (list): 2-D arrays of the same shape (e.g. memory maps)
+        method (str): 'average' or 'median'
+        low_thresh (float): clip pixels this many sigma below the mean
+        high_thresh (float): clip pixels this many sigma above the mean
+        chunk_rows (int): rows combined per task, None for 256
+        nthreads (int): number of threads, 0 or None for the number of CPUs
+        diff_pair (tuple): indices (i, j) of two images whose float32
+            difference is also returned, or None
+
+    Returns:
+        data, mask, uncertainty and difference (or None) images
+    """
+    ny, nx = images[0].shape
+    data = np.empty((ny, nx), dtype=np.float64)
+    mask = np.empty((ny, nx), dtype=bool)
+    unc = np.empty((ny, nx), dtype=np.float64)
+    diff = None
+    if diff_pair is not None:
+        diff = np.empty((ny, nx), dtype=np.float32)
+    # unset configuration values fall back to the defaults
+    if chunk_rows is None:
+        chunk_rows = 256
+    chunk_rows = max(1, int(chunk_rows))
+
+    def do_chunk(r0):
+        r1 = min(ny, r0 + chunk_rows)
+        data[r0:r1], mask[r0:r1], unc[r0:r1] = combine_rows(
+            images, r0, r1, method, low_thresh, high_thresh)
+        if diff is not None:
+            im1, im2 = images[diff_pair[0]], images[diff_pair[1]]
+            diff[r0:r1] = np.asarray(im1[r0:r1], dtype=np.float32) - \
+                np.asarray(im2[r0:r1], dtype=np.float32)
+
+    if nthreads is None or nthreads <= 0:
+        nthreads = os.cpu_count()
+    with ThreadPoolExecutor(max_workers=nthreads) as executor:
+        # list() re-raises errors from the chunks
+        list(executor.map(do_chunk, range(0, ny, chunk_rows)))
+    return data, mask, unc, diff
@@ -0,0 +1,79 @@
+import copy
+import hashlib
+import logging
+import os
+import pickle
+
+import numpy as np
+
+logger = logging.getLogger('KCWI')
+
+# in-process copies of the cache files read or written, by file name
+cache_items = {}
+
+
+def cache_key(*items):
+    """Content address of a sequence of items
+
+    Arrays are hashed by value, everything else by its string form.
+    """
+    digest = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            digest.update(np.ascontiguousarray(item).tobytes())
+        else:
+            digest.update(str(item).encode())
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def wavesol_key(header, grangle, refwave, reflux, taperfrac):
+    """Content address of the wavelength solution for an arc
+
+    The key covers the instrument state (STATEID), the CCD configuration
+    (CCDCFG), the grating angle, the taper fraction and a checksum of the
+    convolved atlas spectrum the solution was fit against.
+    """
+    return cache_key(header['STATEID'], header['CCDCFG'], "%.2f" % grangle,
+                     "%.3f" % taperfrac,
+                     np.asarray(refwave, dtype=np.float64),
+                     np.asarray(reflux, dtype=np.float64))
+
+
+def cache_file(cache_dir, kind, key):
+    """Path of the cache file for an item of the given kind and key"""
+    return os.path.join(cache_dir, "%s_%s.pkl" % (kind, key))
+
+
+def read_cache(file):
+    """Read a cached item, or None if there is none
+
+    Items are kept in memory once read, and each call returns a copy that
+    the caller is free to modify.
+    """
+    if not file:
+        return None
+    if file not in cache_items:
+        if not os.path.exists(file):
+            return None
+        try:
+            with open(file, 'rb') as ifile:
+                cache_items[file] = pickle.load(ifile)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            logger.warning("Unable to read cache file %s: %s" % (file, e))
+            return None
+    return copy.deepcopy(cache_items[file])
+
+
+def write_cache(file, item):
+    """Write an item to the cache
+
+    The file is replaced atomically, so concurrent readers see either the
+    old or the new item.
+    """
+    os.makedirs(os.path.dirname(file), exist_ok=True)
+    tmp_file = "%s.%d.tmp" % (file, os.getpid())
+    with open(tmp_file, 'wb') as ofile:
+        pickle.dump(item, ofile)
+    os.replace(tmp_file, file)
+    cache_items[file] = copy.deepcopy(item)
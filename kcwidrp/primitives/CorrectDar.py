@@ -1,7 +1,7 @@
 from keckdrpframework.primitives.base_primitive import BasePrimitive
 from kcwidrp.core.kcwi_get_std import kcwi_get_std
 from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_writer, \
-    kcwi_fits_reader, strip_fname
+    kcwi_fits_reader, strip_fname, product_exists
 
 import numpy as np
 from scipy.ndimage import shift
@@ -9,6 +9,7 @@ from astropy.nddata import CCDData
 import math
 import ref_index
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 
 def atm_disper(w0, w1, airmass, temperature=10.0, pressure_pa=61100.0,
@@ -17,7 +18,7 @@ def atm_disper(w0, w1, airmass, temperature=10.0, pressure_pa=61100.0,
 
     Args:
         w0 (float): reference wavelength (Angstroms)
-        w1 (float): offset wavelength (Angstroms)
+        w1 (float or numpy.ndarray): offset wavelength(s) (Angstroms)
         airmass (float): unitless airmass
         temperature (float): atmospheric temperature (C)
         pressure_pa (float): atmospheric pressure (Pa)
@@ -37,6 +38,29 @@ def atm_disper(w0, w1, airmass, temperature=10.0, pressure_pa=61100.0,
     return 206265.0 * (n0 - n1) * math.tan(z)
 
 
+def dar_shift_planes(cubes, y_shifts, x_shifts, j0, j1):
+    """Shift wavelength planes j0 to j1 of each cube in place
+
+    Args:
+        cubes (list): (cube, order, kwargs) for each cube, where kwargs are
+            extra arguments to scipy.ndimage.shift; integer cubes are
+            rounded up after shifting
+        y_shifts (numpy.ndarray): y shift for each wavelength plane (pix)
+        x_shifts (numpy.ndarray): x shift for each wavelength plane (pix)
+        j0 (int): first wavelength plane
+        j1 (int): end wavelength plane (exclusive)
+
+    """
+    for j in range(j0, j1):
+        for cube, order, kwargs in cubes:
+            shifted = shift(cube[j, :, :], (y_shifts[j], x_shifts[j]),
+                            order=order, **kwargs)
+            # integer (mask, flag) cubes round up any contamination
+            if np.issubdtype(cube.dtype, np.integer):
+                shifted = np.ceil(shifted)
+            cube[j, :, :] = shifted
+
+
 class CorrectDar(BasePrimitive):
     """Correct for Differential Atmospheric Refraction"""
 
@@ -173,7 +197,7 @@ class CorrectDar(BasePrimitive):
             full_path = os.path.join(
                 self.config.instrument.cwd,
                 self.config.instrument.output_directory, objfn)
-            if os.path.exists(full_path):
+            if product_exists(full_path):
                 obj = kcwi_fits_reader(full_path)[0]
                 output_obj = np.zeros(
                     (image_size[0], image_size[1] + 2 * padding_y,
@@ -185,7 +209,7 @@ class CorrectDar(BasePrimitive):
             full_path = os.path.join(
                 self.config.instrument.cwd,
                 self.config.instrument.output_directory, skyfn)
-            if os.path.exists(full_path):
+            if product_exists(full_path):
                 sky = kcwi_fits_reader(full_path)[0]
                 output_sky = np.zeros(
                     (image_size[0], image_size[1] + 2 * padding_y,
@@ -204,7 +228,7 @@ class CorrectDar(BasePrimitive):
             full_path = os.path.join(
                 self.config.instrument.cwd,
                 self.config.instrument.output_directory, delfn)
-            if os.path.exists(full_path):
+            if product_exists(full_path):
                 dew = kcwi_fits_reader(full_path)[0]
                 output_del = np.zeros(
                     (image_size[0], image_size[1] + 2 * padding_y,
@@ -216,52 +240,33 @@ class CorrectDar(BasePrimitive):
         self.logger.info(f"Std. Dev. cube DAR order = {self.config.instrument.DAR_shift_order}")
         self.logger.info(f"Mask cube DAR order = 1 (constant)")
         self.logger.info(f"Flag cube DAR order = 1 (constant)")
-        # Perform correction
-        for j, wl in enumerate(waves):
-            dispersion_correction = atm_disper(wref, wl, airmass)
-            x_shift = dispersion_correction * \
-                math.sin(projection_angle) / x_scale
-            y_shift = dispersion_correction * \
-                math.cos(projection_angle) / y_scale
-            output_image[j, :, :] = shift(output_image[j, :, :], (y_shift,
-                                                                  x_shift), order=self.config.instrument.DAR_shift_order)
-            output_stddev[j, :, :] = shift(output_stddev[j, :, :], (y_shift,
-                                                                    x_shift), order=self.config.instrument.DAR_shift_order)
-            output_mask[j, :, :] = np.ceil(shift(output_mask[j, :, :], (y_shift,
-                                                                x_shift), order=1, mode = 'constant', cval=128))
-            output_flags[j, :, :] = np.ceil(shift(output_flags[j, :, :], (y_shift,
-                                                                  x_shift), order=1, mode = 'constant', cval=128))
-        # for obj, sky if they exist
-        if output_obj is not None:
-            for j, wl in enumerate(waves):
-                dispersion_correction = atm_disper(wref, wl, airmass)
-                x_shift = dispersion_correction * \
-                    math.sin(projection_angle) / x_scale
-                y_shift = dispersion_correction * \
-                    math.cos(projection_angle) / y_scale
-                output_obj[j, :, :] = shift(output_obj[j, :, :], (y_shift,
-                                                                  x_shift))
-
-        if output_sky is not None:
-            for j, wl in enumerate(waves):
-                dispersion_correction = atm_disper(wref, wl, airmass)
-                x_shift = dispersion_correction * \
-                    math.sin(projection_angle) / x_scale
-                y_shift = dispersion_correction * \
-                    math.cos(projection_angle) / y_scale
-                output_sky[j, :, :] = shift(output_sky[j, :, :], (y_shift,
-                                                                  x_shift))
-
-        # for delta wavelength cube, if it exists
-        if output_del is not None:
-            for j, wl in enumerate(waves):
-                dispersion_correction = atm_disper(wref, wl, airmass)
-                x_shift = dispersion_correction * \
-                    math.sin(projection_angle) / x_scale
-                y_shift = dispersion_correction * \
-                    math.cos(projection_angle) / y_scale
-                output_del[j, :, :] = shift(output_del[j, :, :], (y_shift,
-                                                                  x_shift))
+        # DAR shifts for all wavelengths
+        dispersion_correction = atm_disper(wref, waves, airmass)
+        x_shifts = dispersion_correction * math.sin(projection_angle) / x_scale
+        y_shifts = dispersion_correction * math.cos(projection_angle) / y_scale
+        # cubes to correct, with their shift order and mode
+        dar_order = self.config.instrument.DAR_shift_order
+        cubes = [(output_image, dar_order, {}),
+                 (output_stddev, dar_order, {}),
+                 (output_mask, 1, {'mode': 'constant', 'cval': 128}),
+                 (output_flags, 1, {'mode': 'constant', 'cval': 128})]
+        # for obj, sky and delta wavelength cubes, if they exist
+        for output_cube in (output_obj, output_sky, output_del):
+            if output_cube is not None:
+                cubes.append((output_cube, 3, {}))
+        # Perform correction in batches of wavelength planes
+        chunk = max(1, int(self.config.instrument.getValue('dar_chunk_size',
+                                                           256)))
+        nthreads = self.config.instrument.getValue('dar_nthreads', 0)
+        if nthreads <= 0:
+            nthreads = os.cpu_count()
+        with ThreadPoolExecutor(max_workers=nthreads) as executor:
+            batches = [executor.submit(dar_shift_planes, cubes, y_shifts,
+                                       x_shifts, j0,
+                                       min(j0 + chunk, image_size[0]))
+                       for j0 in range(0, image_size[0], chunk)]
+            for batch in batches:
+                batch.result()
 
         self.action.args.ccddata.data = output_image
         self.action.args.ccddata.uncertainty.array = output_stddev
@@ -1,5 +1,5 @@
 from keckdrpframework.primitives.base_primitive import BasePrimitive
-from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_writer, strip_fname, kcwi_fits_reader
+from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_writer, strip_fname, kcwi_fits_reader, product_exists
 
 import numpy as np
 import pkg_resources
@@ -7,6 +7,85 @@ import os
 import pandas as pd
 from astropy.io import fits
 
+# compiled defect lists, keyed on (defect file, image shape)
+defect_cache = {}
+
+
+def compile_defects(full_path, shape, pixel_range_for_good_value=5):
+    """Compile a defect list into index arrays for an image shape
+
+    Args:
+        full_path (str): defect list file with X0, X1, Y0, Y1 columns
+            (one-biased, inclusive of X1 and Y1)
+        shape (tuple): (ny, nx) shape of the image to correct
+        pixel_range_for_good_value (int): columns sampled on each side of
+            a defect to calculate the replacement value
+
+    Returns:
+        dict with 'defects', a list of (rows, bad columns, sample columns)
+        index arrays per defect, and 'rows' and 'cols', the index arrays of
+        every defective pixel
+    """
+    defect_table = pd.read_csv(full_path, sep=r'\s+')
+    xpix = np.arange(shape[1])
+    defects = []
+    bad_rows = []
+    bad_cols = []
+    for x0, x1, y0, y1 in zip(defect_table['X0'], defect_table['X1'],
+                              defect_table['Y0'], defect_table['Y1']):
+        # adjust for python zero bias
+        x0 = x0 - 1
+        y0 = y0 - 1
+        rows = np.arange(y0, y1)
+        cols = np.arange(x0, x1)
+        # sample on low and high sides of bad area
+        samples = np.concatenate(
+            (xpix[x0-pixel_range_for_good_value:x0],
+             xpix[x1+1:x1+pixel_range_for_good_value+1]))
+        if len(rows) == 0 or len(cols) == 0:
+            continue
+        defects.append((rows, cols, samples))
+        bad_rows.append(np.repeat(rows, len(cols)))
+        bad_cols.append(np.tile(cols, len(rows)))
+    if defects:
+        bad_rows = np.concatenate(bad_rows)
+        bad_cols = np.concatenate(bad_cols)
+    else:
+        bad_rows = np.zeros(0, dtype=int)
+        bad_cols = np.zeros(0, dtype=int)
+    return {'defects': defects, 'rows': bad_rows, 'cols': bad_cols}
+
+
+def get_defects(full_path, shape):
+    """Return the compiled defect list, re-reading it only if it changed"""
+    key = (full_path, tuple(shape))
+    mtime = os.path.getmtime(full_path)
+    cached = defect_cache.get(key)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, compile_defects(full_path, shape))
+        defect_cache[key] = cached
+    return cached[1]
+
+
+def correct_defects(data, flags, compiled):
+    """Replace defective pixels with the median of the neighboring columns
+
+    Args:
+        data (numpy.ndarray): image, corrected in place
+        flags (numpy.ndarray): flag image, defective pixels are incremented
+            by 2 in place
+        compiled (dict): defect list from compile_defects()
+
+    Returns:
+        int: number of defective pixels cleaned
+    """
+    # defects are applied in order, as a later one may sample an earlier one
+    for rows, cols, samples in compiled['defects']:
+        good_values = np.nanmedian(data[np.ix_(rows, samples)], axis=1)
+        data[np.ix_(rows, cols)] = good_values[:, np.newaxis]
+    np.add.at(flags, (compiled['rows'], compiled['cols']), 2)
+    return len(compiled['rows'])
+
 
 class CorrectDefects(BasePrimitive):
     """Remove known bad columns"""
@@ -41,30 +120,10 @@ class CorrectDefects(BasePrimitive):
         number_of_bad_pixels = 0   # count of defective pixels cleaned
         if os.path.exists(full_path):
             self.logger.info("Reading defect list in: %s" % full_path)
-            defect_table = pd.read_csv(full_path, sep=r'\s+')
-            # range of pixels for calculating good value
-            pixel_range_for_good_value = 5
-            for index, row in defect_table.iterrows():
-                # Get coords and adjust for python zero bias
-                x0 = row['X0'] - 1
-                x1 = row['X1']
-                y0 = row['Y0'] - 1
-                y1 = row['Y1']
-                # Loop over y range
-                for by in range(y0, y1):
-                    # sample on low side of bad area
-                    values = list(self.action.args.ccddata.data[by,
-                                  x0-pixel_range_for_good_value:x0])
-                    # sample on high side
-                    values.extend(self.action.args.ccddata.data[by,
-                                  x1+1:x1+pixel_range_for_good_value+1])
-                    # get replacement value
-                    good_values = np.nanmedian(np.asarray(values))
-                    # Replace baddies with gval
-                    for bx in range(x0, x1):
-                        self.action.args.ccddata.data[by, bx] = good_values
-                        flags[by, bx] += 2
-                        number_of_bad_pixels += 1
+            defects = get_defects(full_path,
+                                  self.action.args.ccddata.data.shape)
+            number_of_bad_pixels = correct_defects(
+                self.action.args.ccddata.data, flags, defects)
             self.action.args.ccddata.header[key] = (True, keycom)
             self.action.args.ccddata.header['BPFILE'] = (path, 'defect list')
         else:
@@ -84,8 +143,11 @@ class CorrectDefects(BasePrimitive):
             wmf = mroot + '_wavemap.fits'
             self.logger.info("Reading image: %s" % wmf)
 
-            if os.path.exists(os.path.join(self.config.instrument.cwd, 'redux', wmf)):
-                wavemap = kcwi_fits_reader(os.path.join(self.config.instrument.cwd, 'redux', wmf))[0]
+            if product_exists(os.path.join(self.config.instrument.cwd, 'redux', wmf)):
+                # memory-mapped, without the float64 cast
+                wavemap = kcwi_fits_reader(
+                    os.path.join(self.config.instrument.cwd, 'redux', wmf),
+                    extensions=(), dtype=None, memmap=True)[0]
                 wavegood0 = wavemap.header['WAVGOOD0']
                 wavegood1 = wavemap.header['WAVGOOD1']
 
@@ -145,7 +207,8 @@ class CorrectDefects(BasePrimitive):
                              table=self.action.args.table,
                              output_file=self.action.args.name,
                              output_dir=self.config.instrument.output_directory,
-                             suffix="def")
+                             suffix="def",
+                             background=self.config.instrument.background_writes)
 
         return self.action.args
     # END: class CorrectDefects()
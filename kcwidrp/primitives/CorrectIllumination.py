@@ -1,6 +1,6 @@
 from keckdrpframework.primitives.base_primitive import BasePrimitive
 from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_reader, \
-    kcwi_fits_writer, get_master_name, strip_fname
+    kcwi_fits_writer, get_master_name, strip_fname, product_exists
 
 import os
 
@@ -87,7 +87,7 @@ class CorrectIllumination(BasePrimitive):
                 full_path = os.path.join(
                     self.config.instrument.cwd,
                     self.config.instrument.output_directory, objfn)
-                if os.path.exists(full_path):
+                if product_exists(full_path):
                     obj = kcwi_fits_reader(full_path)[0]
                     # correction
                     obj.data *= mflat.data
@@ -102,7 +102,7 @@ class CorrectIllumination(BasePrimitive):
                 full_path = os.path.join(
                     self.config.instrument.cwd,
                     self.config.instrument.output_directory, skyfn)
-                if os.path.exists(full_path):
+                if product_exists(full_path):
                     sky = kcwi_fits_reader(full_path)[0]
                     # correction
                     sky.data *= mflat.data
@@ -125,7 +125,8 @@ class CorrectIllumination(BasePrimitive):
                          table=self.action.args.table,
                          output_file=self.action.args.name,
                          output_dir=self.config.instrument.output_directory,
-                         suffix="intf")
+                         suffix="intf",
+                         background=self.config.instrument.background_writes)
         self.context.proctab.update_proctab(frame=self.action.args.ccddata,
                                             suffix="intf",
                                             filename=self.action.args.name)
@@ -2,6 +2,8 @@ from keckdrpframework.primitives.base_primitive import BasePrimitive
 from kcwidrp.core.bokeh_plotting import bokeh_plot
 from kcwidrp.core.kcwi_plotting import get_plot_lims, oplot_slices, \
     set_plot_lims
+from kcwidrp.core.kcwi_wavesol import wavesol_key, cache_file, \
+    read_cache, write_cache
 
 from bokeh.plotting import figure
 import numpy as np
@@ -9,6 +11,8 @@ import math
 from scipy.interpolate import interpolate
 from multiprocessing import get_context
 from scipy import signal
+from scipy import fft as sp_fft
+import os
 import time
 
 
@@ -73,78 +77,122 @@ def pascal_shift(coefficients=None, x0=None):
     # END: def pascal_shift()
 
 
+def central_coefficients(zero_point, dispersion, argument):
+    """Grating equation coefficients for a given central dispersion"""
+    coefficients = [0., 0., 0., 0., 0.]
+    coefficients[4] = zero_point
+    coefficients[3] = dispersion
+    cosbeta = dispersion / (argument['PIX'] * argument['ybin']) * \
+        argument['rho'] * argument['FCAM'] * 1.e-4
+    if cosbeta > 1.:
+        cosbeta = 1.
+    beta = math.acos(cosbeta)
+    coefficients[2] = -(argument['PIX'] * argument['ybin'] /
+                        argument['FCAM']) ** 2 * math.sin(beta) / 2. / \
+        argument['rho'] * 1.e4
+    coefficients[1] = -(argument['PIX'] * argument['ybin'] /
+                        argument['FCAM']) ** 3 * math.cos(beta) / 6. / \
+        argument['rho'] * 1.e4
+    coefficients[0] = (argument['PIX'] * argument['ybin'] /
+                       argument['FCAM']) ** 4 * math.sin(beta) / 24. / \
+        argument['rho'] * 1.e4
+    return coefficients
+
+
+def dispersion_trials(dispersion, deviation, refdisp, nrows):
+    """Dispersions to scan within a fractional deviation of a dispersion
+
+    Returns the number of steps and the nn + 1 trial dispersions.
+    """
+    nn = int(deviation * abs(dispersion) / refdisp * nrows / 2.0)
+    if nn < 10:
+        nn = 10
+    if nn > 50:
+        nn = 50
+    disps = dispersion * (1.0 + deviation * (np.arange(0, nn + 1) - nn / 2.) *
+                          2.0 / nn)
+    return nn, disps
+
+
+def batch_cross_correlate(spectra, references):
+    """Cross-correlate pairs of equal length spectra with one batched FFT
+
+    Each pair may have its own length.  For each pair, returns the peak of
+    the central third of np.correlate(spectrum, reference, mode='full')
+    and the offset of that peak.
+    """
+    lengths = np.array([len(spec) for spec in spectra])
+    nfft = sp_fft.next_fast_len(int(2 * lengths.max() - 1), real=True)
+    spec_matrix = np.zeros((len(spectra), nfft))
+    ref_matrix = np.zeros((len(spectra), nfft))
+    for k, (spec, ref) in enumerate(zip(spectra, references)):
+        spec_matrix[k, :len(spec)] = spec
+        ref_matrix[k, :len(ref)] = ref
+    # circular correlation, zero padding makes it the full one
+    crosscorrelation = sp_fft.irfft(
+        sp_fft.rfft(spec_matrix, axis=1) *
+        np.conj(sp_fft.rfft(ref_matrix, axis=1)), n=nfft, axis=1)
+    maxima = []
+    shifts = []
+    for k, samples_number in enumerate(lengths):
+        # central region of the full correlation
+        ncc = 2 * samples_number - 1
+        x0c = int(ncc / 3)
+        x1c = int(2 * (ncc / 3))
+        central_offsets_array = np.arange(x0c, x1c) - (samples_number - 1)
+        central_crosscorrelation = crosscorrelation[
+            k, central_offsets_array % nfft]
+        # Calculate offset
+        maxima.append(central_crosscorrelation[
+                          central_crosscorrelation.argmax()])
+        shifts.append(central_offsets_array[central_crosscorrelation.argmax()])
+    return maxima, shifts
+
+
 def bar_fit_helper(argument):
 
     b = argument['b']
     bs = argument['bs']
-    # wavelength coefficients
-    coefficients = [0., 0., 0., 0., 0.]
-    # container for maxima, shifts
-    maxima = []
-    shifts = []
+    refwave = argument['refwave']
     # get sub spectrum for this bar
     sub_spectrum = bs[argument['minrow']:argument['maxrow']]
-    # now loop over dispersions
+    # tapered bar and atlas spectra for each dispersion
+    spectra = []
+    references = []
     for di, dispersion in enumerate(argument['disps']):
         # populate the coefficients
-        coefficients[4] = argument['p0'][b]
-        coefficients[3] = dispersion
-        cosbeta = dispersion / (argument['PIX'] * argument['ybin']) * \
-            argument['rho'] * argument['FCAM'] * 1.e-4
-        if cosbeta > 1.:
-            cosbeta = 1.
-        beta = math.acos(cosbeta)
-        coefficients[2] = -(argument['PIX'] * argument['ybin'] /
-                            argument['FCAM']) ** 2 * math.sin(beta) / 2. / \
-            argument['rho'] * 1.e4
-        coefficients[1] = -(argument['PIX'] * argument['ybin'] /
-                            argument['FCAM']) ** 3 * math.cos(beta) / 6. / \
-            argument['rho'] * 1.e4
-        coefficients[0] = (argument['PIX'] * argument['ybin'] /
-                           argument['FCAM']) ** 4 * math.sin(beta) / 24. / \
-            argument['rho'] * 1.e4
+        coefficients = central_coefficients(argument['p0'][b], dispersion,
+                                            argument)
         # what are the min and max wavelengths to consider?
         wl0 = np.polyval(coefficients, argument['xvals'][argument['minrow']])
         wl1 = np.polyval(coefficients, argument['xvals'][argument['maxrow']])
         minimum_wavelength = np.nanmin([wl0, wl1])
         maximum_wavelength = np.nanmax([wl0, wl1])
         # where will we need to interpolate to cross-correlate?
-        minrw = [i for i, v in enumerate(argument['refwave'])
-                 if v >= minimum_wavelength][0]
-        maxrw = [i for i, v in enumerate(argument['refwave'])
-                 if v <= maximum_wavelength][-1]
-        ref_wave_of_sub_spectrum = argument['refwave'][minrw:maxrw]
-        ref_flux_of_sub_spectrum = argument['reflux'][minrw:maxrw]
+        minrw = np.searchsorted(refwave, minimum_wavelength, side='left')
+        maxrw = np.searchsorted(refwave, maximum_wavelength,
+                                side='right') - 1
+        ref_wave_of_sub_spectrum = refwave[minrw:maxrw]
         # get bell cosine taper to avoid nasty edge effects
-        tkwgt = signal.windows.tukey(len(ref_flux_of_sub_spectrum),
+        tkwgt = signal.windows.tukey(len(ref_wave_of_sub_spectrum),
                                      alpha=argument['taperfrac'])
         # apply taper to atlas spectrum
-        ref_flux_of_sub_spectrum *= tkwgt
+        references.append(argument['reflux'][minrw:maxrw] * tkwgt)
         # adjust wavelengths
         waves = np.polyval(coefficients, argument['subxvals'])
         # interpolate the bar spectrum
         obsint = interpolate.interp1d(waves, sub_spectrum, kind='cubic',
                                       bounds_error=False,
                                       fill_value='extrapolate')
-        intspec = obsint(ref_wave_of_sub_spectrum)
         # apply taper to bar spectrum
-        intspec *= tkwgt
-        # get a label
-        # cross correlate the interpolated spectrum with the atlas spec
-        samples_number = len(ref_wave_of_sub_spectrum)
-        offsets_array = np.arange(1 - samples_number, samples_number)
-        # Cross-correlate
-        crosscorrelation = np.correlate(intspec, ref_flux_of_sub_spectrum,
-                                        mode='full')
-        # Get central region
-        x0c = int(len(crosscorrelation) / 3)
-        x1c = int(2 * (len(crosscorrelation) / 3))
-        central_crosscorrelation = crosscorrelation[x0c:x1c]
-        central_offsets_array = offsets_array[x0c:x1c]
-        # Calculate offset
-        maxima.append(central_crosscorrelation[
-                          central_crosscorrelation.argmax()])
-        shifts.append(central_offsets_array[central_crosscorrelation.argmax()])
+        spectra.append(obsint(ref_wave_of_sub_spectrum) * tkwgt)
+    # cross correlate the interpolated spectra with the atlas spectra
+    maxima, shifts = batch_cross_correlate(spectra, references)
+    # normalized peak of the best trial, a fit quality measure that does
+    # not depend on the brightness of the arc lamp
+    best = int(np.argmax(maxima))
+    norm = np.linalg.norm(spectra[best]) * np.linalg.norm(references[best])
+    xcorr_peak = maxima[best] / norm if norm > 0. else 0.
     # Get interpolations
     int_max = interpolate.interp1d(argument['disps'], maxima, kind='cubic',
                                    bounds_error=False,
@@ -164,28 +212,14 @@ def bar_fit_helper(argument):
     bardisp = central_xdisps[maxima_res.argmax()]
     barshift = shifts_res[maxima_res.argmax()]
     # update coeffs
-    coefficients[4] = argument['p0'][b] - barshift
-    coefficients[3] = bardisp
-    cosbeta = coefficients[3] / (argument['PIX'] * argument['ybin']) * \
-        argument['rho'] * argument['FCAM'] * 1.e-4
-    if cosbeta > 1.:
-        cosbeta = 1.
-    beta = math.acos(cosbeta)
-    coefficients[2] = -(argument['PIX'] * argument['ybin'] /
-                        argument['FCAM']) ** 2 * \
-        math.sin(beta) / 2. / argument['rho'] * 1.e4
-    coefficients[1] = -(argument['PIX'] * argument['ybin'] /
-                        argument['FCAM']) ** 3 * \
-        math.cos(beta) / 6. / argument['rho'] * 1.e4
-    coefficients[0] = (argument['PIX'] * argument['ybin'] /
-                       argument['FCAM']) ** 4 * \
-        math.sin(beta) / 24. / argument['rho'] * 1.e4
+    coefficients = central_coefficients(argument['p0'][b] - barshift,
+                                        bardisp, argument)
     shifted_coefficients = pascal_shift(coefficients, argument['x0'])
     print("Bar#: %3d, Cdisp: %.4f" % (b, bardisp))
 
     # Return results
     return b, shifted_coefficients, coefficients[4], coefficients[3], \
-           maxima, bardisp
+           maxima, bardisp, xcorr_peak
     # END: def bar_fit_helper()
 
 
@@ -220,22 +254,11 @@ class FitCenter(BasePrimitive):
                                                      self.action.args.refdisp,
                                                      self.action.args.minrow,
                                                      self.action.args.maxrow))
-        number_of_values_to_try = (int(maximum_dispersion_deviation *
-                                       abs(self.context.prelim_disp) /
-                                   self.action.args.refdisp *
-                                       (self.action.args.maxrow -
-                                        self.action.args.minrow) / 2.0))
-        if number_of_values_to_try < 10:
-            number_of_values_to_try = 10
-        if number_of_values_to_try > 50:
-            number_of_values_to_try = 50
+        number_of_values_to_try, disps = dispersion_trials(
+            self.context.prelim_disp, maximum_dispersion_deviation,
+            self.action.args.refdisp,
+            self.action.args.maxrow - self.action.args.minrow)
         self.logger.info("N disp. samples: %d" % number_of_values_to_try)
-        # dispersions to try
-        disps = self.context.prelim_disp * (
-                1.0 + maximum_dispersion_deviation *
-                (np.arange(0, number_of_values_to_try + 1) -
-                 number_of_values_to_try / 2.) *
-                2.0 / number_of_values_to_try)
         # values for central fit
         subxvals = self.action.args.xvals[
                    self.action.args.minrow:self.action.args.maxrow]
@@ -272,9 +295,62 @@ class FitCenter(BasePrimitive):
         twkcoeff = {}
         centwave = []
         centdisp = []
+        xcorr_peak = []
+
+        # solution cached for this configuration?
+        cached = None
+        self.action.args.wavesol_file = None
+        if self.config.instrument.wavesol_cache:
+            cache_dir = os.path.join(
+                self.config.instrument.cwd,
+                self.config.instrument.output_directory,
+                os.path.expanduser(self.config.instrument.wavesol_cache_dir))
+            self.action.args.wavesol_file = cache_file(
+                cache_dir, 'wavesol',
+                wavesol_key(self.action.args.ccddata.header,
+                            self.action.args.grangle,
+                            self.action.args.refwave,
+                            self.action.args.reflux,
+                            self.config.instrument.TAPERFRAC))
+            cached = read_cache(self.action.args.wavesol_file)
+            if cached is not None and \
+                    (len(cached['centdisp']) != len(my_arguments) or
+                     'xcorr_peak' not in cached):
+                cached = None
 
         p = get_context("spawn").Pool()
-        results = p.map(bar_fit_helper, list(my_arguments))
+        if cached is not None:
+            # only refine a narrow window about the cached dispersions
+            self.logger.info("Warm start from cached solution: %s" %
+                             self.action.args.wavesol_file)
+            window = self.config.instrument.wavesol_window
+            for arguments in my_arguments:
+                arguments['nn'], arguments['disps'] = dispersion_trials(
+                    cached['centdisp'][arguments['b']], window,
+                    self.action.args.refdisp,
+                    self.action.args.maxrow - self.action.args.minrow)
+            results = p.map(bar_fit_helper, list(my_arguments))
+            # fall back to the full scan for bars that moved too far or
+            # correlate worse with the atlas than the cached solution did
+            tolerance = self.config.instrument.wavesol_tolerance
+            min_xcorr = self.config.instrument.wavesol_min_xcorr
+            failed = [ir for ir, result in enumerate(results)
+                      if abs(result[5] / cached['centdisp'][result[0]] - 1.)
+                      > tolerance or
+                      result[6] < min_xcorr * cached['xcorr_peak'][result[0]]]
+            if failed:
+                self.logger.info("Warm start failed for %d bars, "
+                                 "scanning full dispersion range" %
+                                 len(failed))
+                for ir in failed:
+                    my_arguments[ir]['nn'] = number_of_values_to_try
+                    my_arguments[ir]['disps'] = disps
+                refit = p.map(bar_fit_helper,
+                              [my_arguments[ir] for ir in failed])
+                for ir, result in zip(failed, refit):
+                    results[ir] = result
+        else:
+            results = p.map(bar_fit_helper, list(my_arguments))
         p.close()
 
         next_bar_to_plot = 0
@@ -286,6 +362,7 @@ class FitCenter(BasePrimitive):
             twkcoeff[b] = shifted_coefficients
             centwave.append(_centwave)
             centdisp.append(_centdisp)
+            xcorr_peak.append(result[6])
             maxima = result[4]
             bardisp = result[5]
             self.logger.info("Central Fit: Bar# %3d, Cdisp %.4f, "
@@ -302,8 +379,10 @@ class FitCenter(BasePrimitive):
                            plot_height=self.config.instrument.plot_height,
                            x_axis_label="Central dispersion (Ang/px)",
                            y_axis_label="X-Corr Peak Value")
-                p.scatter(disps, maxima, color='red', legend_label="Data")
-                p.line(disps, maxima, color='blue', legend_label="Data")
+                p.scatter(my_arguments[ir]['disps'], maxima, color='red',
+                          legend_label="Data")
+                p.line(my_arguments[ir]['disps'], maxima, color='blue',
+                       legend_label="Data")
                 ylim = [min(maxima), max(maxima)]
                 p.line([_centdisp, _centdisp], ylim, color='green',
                        legend_label="Fit Disp")
@@ -320,6 +399,17 @@ class FitCenter(BasePrimitive):
                         next_bar_to_plot = ir + 1
 
         self.action.args.twkcoeff = twkcoeff
+        # cache the solution for the next arc with this configuration
+        if self.action.args.wavesol_file:
+            write_cache(self.action.args.wavesol_file, {
+                'STATEID': self.action.args.ccddata.header['STATEID'],
+                'CCDCFG': self.action.args.ccddata.header['CCDCFG'],
+                'GRANGLE': self.action.args.grangle,
+                'twkcoeff': twkcoeff,
+                'centwave': centwave,
+                'centdisp': centdisp,
+                'xcorr_peak': xcorr_peak
+            })
         # Plot results
         if self.config.instrument.plot_level >= 1:
             # Plot central wavelength
@@ -1,6 +1,6 @@
 from keckdrpframework.primitives.base_primitive import BasePrimitive
 from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_writer, \
-    kcwi_fits_reader, get_master_name, strip_fname
+    kcwi_fits_reader, get_master_name, strip_fname, product_exists
 from kcwidrp.core.kcwi_correct_extin import kcwi_correct_extin
 
 import os
@@ -92,12 +92,10 @@ class FluxCalibrate(BasePrimitive):
             # extinction correct calibration
             kcwi_correct_extin(mscal, self.action.args.ccddata.header,
                                logger=self.logger)
-            # do calibration
-            for isl in range(sz[2]):
-                for ix in range(sz[1]):
-                    self.action.args.ccddata.data[:, ix, isl] *= mscal
-                    self.action.args.ccddata.uncertainty.array[:, ix, isl] *= \
-                        mscal
+            # do calibration, in place, broadcasting along wavelength
+            mscal_cube = mscal[:, np.newaxis, np.newaxis]
+            self.action.args.ccddata.data *= mscal_cube
+            self.action.args.ccddata.uncertainty.array *= mscal_cube
 
             # check for obj, sky cubes
             if self.action.args.nasmask and self.action.args.numopen > 1:
@@ -107,23 +105,19 @@ class FluxCalibrate(BasePrimitive):
                 full_path = os.path.join(
                     self.config.instrument.cwd,
                     self.config.instrument.output_directory, objfn)
-                if os.path.exists(full_path):
+                if product_exists(full_path):
                     obj = kcwi_fits_reader(full_path)[0]
                     # do calibration
-                    for isl in range(sz[2]):
-                        for ix in range(sz[1]):
-                            obj.data[:, ix, isl] *= mscal
+                    obj.data *= mscal_cube
                 # sky cube
                 skyfn = strip_fname(ofn) + '_scubed.fits'
                 full_path = os.path.join(
                     self.config.instrument.cwd,
                     self.config.instrument.output_directory, skyfn)
-                if os.path.exists(full_path):
+                if product_exists(full_path):
                     sky = kcwi_fits_reader(full_path)[0]
                     # do calibration
-                    for isl in range(sz[2]):
-                        for ix in range(sz[1]):
-                            sky.data[:, ix, isl] *= mscal
+                    sky.data *= mscal_cube
 
             # units
             flam16_u = 1.e16 * u.erg / (u.angstrom * u.cm ** 2 * u.s)
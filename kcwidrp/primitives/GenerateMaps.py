@@ -8,6 +8,64 @@ from astropy.nddata import CCDData
 from astropy import units as u
 
 
+def generate_geometry_maps(geom, data_img):
+    """Generate wavelength, position, slice and delta wavelength maps
+
+    The inverse transform of each slice is evaluated once for all the
+    (x, y) pixels within the slice limits, and the maps are filled with
+    boolean-mask assignment.  Slices are processed in order, so pixels
+    shared by neighboring slices get the values of the later slice.
+
+    Args:
+        geom (dict): geometry read from the _geom.pkl file
+        data_img (numpy.ndarray): image used as the template for the maps
+
+    Returns:
+        tuple of wave, xpos, slice and delta map images (-1 outside slices)
+    """
+    xl0s = geom['xl0']  # lower slice pos limit
+    xl1s = geom['xl1']  # upper slice pos limit
+    invtf_list = geom['invtf']
+    wave0 = geom['wave0out']
+    dw = geom['dwout']
+    xsize = geom['xsize']
+    ny = data_img.shape[0]  # number of wavelength pixels
+    # Create map images
+    wave_map_img = np.full_like(data_img, fill_value=-1.)
+    xpos_map_img = np.full_like(data_img, fill_value=-1.)
+    slice_map_img = np.full_like(data_img, fill_value=-1.)
+    delta_map_img = np.full_like(data_img, fill_value=-1.)
+    # loop over slices
+    for isl in range(0, 24):
+        itrf = invtf_list[isl]
+        xl0 = xl0s[isl]
+        xl1 = xl1s[isl]
+        nx = xl1 - xl0
+        if nx <= 0:
+            continue
+        # all slice pixel coordinates, column by column
+        coords = np.zeros((nx * ny, 2))
+        coords[:, 0] = np.repeat(np.arange(nx), ny)
+        coords[:, 1] = np.tile(np.arange(ny), nx)
+        ncoo = itrf(coords)
+        # back to image orientation: (wavelength, slice position)
+        xpos = ncoo[:, 0].reshape(nx, ny).T
+        wpix = ncoo[:, 1].reshape(nx, ny).T
+        good = (xpos >= 0) & (xpos <= xsize)
+        # delta wavelength is only defined above the first row
+        dgood = good.copy()
+        dgood[0, :] = False
+        delta = np.zeros_like(wpix)
+        delta[1:, :] = np.abs((wpix[1:, :] - wpix[:-1, :]) * dw)
+        # fill maps
+        slice_map_img[:, xl0:xl1][good] = isl
+        xpos_map_img[:, xl0:xl1][good] = xpos[good]
+        wave_map_img[:, xl0:xl1][good] = wpix[good] * dw + wave0
+        delta_map_img[:, xl0:xl1][dgood] = delta[dgood]
+
+    return wave_map_img, xpos_map_img, slice_map_img, delta_map_img
+
+
 class GenerateMaps(BasePrimitive):
     """Generate map images"""
 
@@ -24,43 +82,11 @@ class GenerateMaps(BasePrimitive):
                 os.path.exists(self.action.args.geometry_file):
             with open(self.action.args.geometry_file, 'rb') as ifile:
                 geom = pickle.load(ifile)
-            # get geom params
-            xl0s = geom['xl0']  # lower slice pos limit
-            xl1s = geom['xl1']  # upper slice pos limit
-            invtf_list = geom['invtf']
-            wave0 = geom['wave0out']
-            dw = geom['dwout']
-            xsize = geom['xsize']
             # Store original data
             data_img = self.action.args.ccddata.data
-            ny = data_img.shape[0]  # number of wavelength pixels
             # Create map images
-            wave_map_img = np.full_like(data_img, fill_value=-1.)
-            xpos_map_img = np.full_like(data_img, fill_value=-1.)
-            slice_map_img = np.full_like(data_img, fill_value=-1.)
-            delta_map_img = np.full_like(data_img, fill_value=-1.)
-            # loop over slices
-            for isl in range(0, 24):
-                itrf = invtf_list[isl]
-                xl0 = xl0s[isl]
-                xl1 = xl1s[isl]
-                # loop over slice position
-                for ix in range(xl0, xl1):
-                    coords = np.zeros((ny, 2))
-                    # loop over wavelength pixels
-                    for iy in range(0, ny):
-                        coords[iy, 0] = ix - xl0
-                        coords[iy, 1] = iy
-                    ncoo = itrf(coords)
-                    # loop over wavelength
-                    for iy in range(0, ny):
-                        if 0 <= ncoo[iy, 0] <= xsize:
-                            slice_map_img[iy, ix] = isl
-                            xpos_map_img[iy, ix] = ncoo[iy, 0]
-                            wave_map_img[iy, ix] = ncoo[iy, 1] * dw + wave0
-                            if iy > 0:
-                                delta_map_img[iy, ix] = abs(
-                                    (ncoo[iy, 1] - ncoo[iy-1, 1]) * dw)
+            wave_map_img, xpos_map_img, slice_map_img, delta_map_img = \
+                generate_geometry_maps(geom, data_img)
 
             # update header
             self.action.args.ccddata.header['HISTORY'] = log_string
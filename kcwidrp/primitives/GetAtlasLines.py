@@ -1,6 +1,8 @@
 from keckdrpframework.primitives.base_primitive import BasePrimitive
 from kcwidrp.core.bokeh_plotting import bokeh_plot
 from kcwidrp.core.kcwi_plotting import save_plot
+from kcwidrp.core.kcwi_wavesol import cache_file, cache_key, read_cache, \
+    write_cache
 
 from bokeh.plotting import figure
 from bokeh.models import Range1d
@@ -19,6 +21,111 @@ def gaus(x, a, mu, sigma):
     return a * np.exp(-(x - mu) ** 2 / (2. * sigma ** 2))
 
 
+def fit_gaussians(xvecs, yvecs, p0, maxiter=200, tol=1.e-10):
+    """Least-squares Gaussian fits to many line windows at once
+
+    Runs Levenberg-Marquardt on all windows together, zero padding the
+    shorter ones.  Windows that do not converge, or whose Gaussian leaves
+    the window, are refit one at a time with curve_fit.
+
+    Args:
+        xvecs (list): x values of each window
+        yvecs (list): y values of each window
+        p0 (list): starting amplitude, center and sigma for each window
+        maxiter (int): iterations before a fit is declared failed
+        tol (float): relative change in cost or parameters for convergence
+
+    Returns:
+        (nwin, 3) array of fit parameters and a boolean array that is False
+        for windows whose fit failed
+    """
+    nwin = len(xvecs)
+    params = np.array(p0, dtype=np.float64).reshape(nwin, 3)
+    if nwin == 0:
+        return params, np.zeros(0, dtype=bool)
+    npts = max(len(xv) for xv in xvecs)
+    x = np.zeros((nwin, npts))
+    y = np.zeros((nwin, npts))
+    wgt = np.zeros((nwin, npts))
+    good = np.isfinite(params).all(axis=1)
+    for k, (xv, yv) in enumerate(zip(xvecs, yvecs)):
+        if len(xv) < 3 or not (np.isfinite(xv).all() and
+                               np.isfinite(yv).all()):
+            good[k] = False
+        if good[k]:
+            x[k, :len(xv)] = xv
+            y[k, :len(yv)] = yv
+            wgt[k, :len(xv)] = 1.
+    finite = good.copy()
+    # failed windows are parked on a flat, harmless model
+    params[~good] = [0., 0., 1.]
+
+    xmin = np.where(wgt > 0., x, np.inf).min(axis=1)
+    xmax = np.where(wgt > 0., x, -np.inf).max(axis=1)
+
+    def get_residuals(k, par):
+        with np.errstate(all='ignore'):
+            model = gaus(x[k], par[:, 0:1], par[:, 1:2], par[:, 2:3])
+        return (model - y[k]) * wgt[k]
+
+    def in_window(k, par):
+        with np.errstate(invalid='ignore'):
+            return np.isfinite(par).all(axis=1) & \
+                (par[:, 1] >= xmin[k]) & (par[:, 1] <= xmax[k]) & \
+                (np.abs(par[:, 2]) <= xmax[k] - xmin[k])
+
+    resid = get_residuals(slice(None), params)
+    cost = (resid * resid).sum(axis=1)
+    damping = np.full(nwin, 1.e-3)
+    active = good.copy()
+    settled = np.zeros(nwin, dtype=bool)
+    for _ in range(maxiter):
+        k = np.flatnonzero(active)
+        if len(k) == 0:
+            break
+        par = params[k]
+        amp, mu, sig = par[:, 0:1], par[:, 1:2], par[:, 2:3]
+        with np.errstate(all='ignore'):
+            expo = np.exp(-(x[k] - mu) ** 2 / (2. * sig ** 2))
+            jac = np.stack([expo, amp * expo * (x[k] - mu) / sig ** 2,
+                            amp * expo * (x[k] - mu) ** 2 / sig ** 3],
+                           axis=2) * wgt[k, :, np.newaxis]
+        jtj = np.einsum('kni,knj->kij', jac, jac)
+        grad = np.einsum('kni,kn->ki', jac, resid[k])
+        diag = np.einsum('kii->ki', jtj)
+        lhs = jtj + damping[k, np.newaxis, np.newaxis] * \
+            np.einsum('ki,ij->kij', np.maximum(diag, 1.e-30), np.eye(3))
+        step = -np.einsum('kij,kj->ki', np.linalg.pinv(lhs), grad)
+        trial = par + step
+        trial_resid = get_residuals(k, trial)
+        trial_cost = (trial_resid * trial_resid).sum(axis=1)
+        better = np.isfinite(trial_cost) & (trial_cost <= cost[k])
+        small = (cost[k] - trial_cost <= tol * cost[k]) | \
+            (np.sqrt((step * step).sum(axis=1)) <=
+             tol * (np.sqrt((par * par).sum(axis=1)) + tol))
+        kb = k[better]
+        params[kb] = trial[better]
+        resid[kb] = trial_resid[better]
+        cost[kb] = trial_cost[better]
+        damping[kb] /= 10.
+        damping[k[~better]] *= 10.
+        # converged, or no step can lower the cost any further
+        done = (better & small) | (damping[k] > 1.e16)
+        settled[k[done]] = True
+        # fits that wander off their window are left to curve_fit
+        done |= ~in_window(k, params[k])
+        active[k[done]] = False
+    # refit the stragglers with curve_fit
+    settled &= in_window(slice(None), params)
+    for k in np.flatnonzero(finite & ~settled):
+        try:
+            params[k], _ = curve_fit(gaus, xvecs[k], yvecs[k], p0=p0[k])
+            good[k] = True
+        except (RuntimeError, ValueError):
+            good[k] = False
+    return params, good
+
+
 def get_line_window(y, c, thresh=0., logger=None, strict=False):
     """Find a window that includes the fwhm of the line"""
     verbose = logger is not None
@@ -116,8 +223,20 @@ def get_line_window(y, c, thresh=0., logger=None, strict=False):
     # END: get_line_window()
 
 
+def line_peak(xvec, yvec):
+    """Densely resampled cubic interpolation of a line"""
+    int_line = interpolate.interp1d(xvec, yvec, kind='cubic',
+                                    bounds_error=False,
+                                    fill_value='extrapolate')
+    # use very dense sampling
+    xplot = np.linspace(min(xvec), max(xvec), num=1000)
+    return xplot, int_line(xplot)
+
+
 def findpeaks(x, y, wid, sth, ath, pkg=None, verbose=False):
     """Find peaks in spectrum"""
+    x = np.asarray(x)
+    y = np.asarray(y)
     # derivative
     grad = np.gradient(y)
     # smooth derivative
@@ -129,38 +248,36 @@ def findpeaks(x, y, wid, sth, ath, pkg=None, verbose=False):
     if not pkg:
         pkg = wid
     hgrp = int(pkg/2)
+    # limits to avoid edges given pkg
+    idx = np.arange(pkg, (nx - pkg))
+    # find zero crossings
+    crossing = np.sign(d[idx]) > np.sign(d[idx + 1])
+    # pass slope threshhold?
+    crossing &= (d[idx] - d[idx + 1]) > sth * y[idx]
+    # pass amplitude threshhold?
+    crossing &= (y[idx] > ath) | (y[idx + 1] > ath)
+    idx = idx[crossing]
     hgt = []
     pks = []
     sgs = []
-    # loop over spectrum
-    # limits to avoid edges given pkg
-    for i in np.arange(pkg, (nx - pkg)):
-        # find zero crossings
-        if np.sign(d[i]) > np.sign(d[i+1]):
-            # pass slope threshhold?
-            if (d[i] - d[i+1]) > sth * y[i]:
-                # pass amplitude threshhold?
-                if y[i] > ath or y[i+1] > ath:
-                    # get subvectors around peak in window
-                    xx = x[(i-hgrp):(i+hgrp+1)]
-                    yy = y[(i-hgrp):(i+hgrp+1)]
-                    if len(yy) > 3:
-                        try:
-                            # gaussian fit
-                            res, _ = curve_fit(gaus, xx, yy,
-                                               p0=[y[i], x[i], 1.])
-                            # check offset of fit from initial peak
-                            r = abs(x - res[1])
-                            t = r.argmin()
-                            if abs(i - t) > pkg:
-                                if verbose:
-                                    print(i, t, x[i], res[1], x[t])
-                            else:
-                                hgt.append(res[0])
-                                pks.append(res[1])
-                                sgs.append(abs(res[2]))
-                        except RuntimeError:
-                            continue
+    if 2 * hgrp + 1 > 3 and len(idx) > 0:
+        # gaussian fits to the windows around all peaks
+        offsets = np.arange(-hgrp, hgrp + 1)
+        fits, fit_ok = fit_gaussians(
+            x[idx[:, np.newaxis] + offsets], y[idx[:, np.newaxis] + offsets],
+            np.stack([y[idx], x[idx], np.ones(len(idx))], axis=1))
+        # check offset of fit from initial peak
+        t = np.abs(x[np.newaxis, :] - fits[:, 1:2]).argmin(axis=1)
+        for i, res, ok, ti in zip(idx, fits, fit_ok, t):
+            if not ok:
+                continue
+            if abs(i - ti) > pkg:
+                if verbose:
+                    print(i, ti, x[i], res[1], x[ti])
+            else:
+                hgt.append(res[0])
+                pks.append(res[1])
+                sgs.append(abs(res[2]))
     # clean by sigmas
     cvals = []
     cpks = []
@@ -229,10 +346,9 @@ class GetAtlasLines(BasePrimitive):
                 self.logger.error("Camera keyword not defined!")
         dichroic_fraction = (maxwav - minwav) / wave_range
         # Get corresponding atlas range
-        minrw = [i for i, v in enumerate(self.action.args.refwave)
-                 if v >= minwav][0]
-        maxrw = [i for i, v in enumerate(self.action.args.refwave)
-                 if v <= maxwav][-1]
+        minrw = np.searchsorted(self.action.args.refwave, minwav, side='left')
+        maxrw = np.searchsorted(self.action.args.refwave, maxwav,
+                                side='right') - 1
         self.logger.info("Min, Max wave (A): %.2f, %.2f" % (minwav, maxwav))
         if self.action.args.dich:
             self.logger.info("Dichroic fraction: %.3f" % dichroic_fraction)
@@ -255,6 +371,112 @@ class GetAtlasLines(BasePrimitive):
         # smooth subyvals
         win = boxcar(3)
         subyvals = sp.signal.convolve(subyvals, win, mode='same') / sum(win)
+        # qualified atlas lines cached for this atlas window and this
+        # reference bar spectrum and solution?  The key covers the arc's own
+        # spectrum, so this only helps when the same arc is reduced again;
+        # other arcs of the configuration share just the convolved atlas
+        lines_file = None
+        if self.config.instrument.atlas_cache:
+            linelist = self.config.instrument.LINELIST
+            lines_file = cache_file(
+                os.path.join(self.config.instrument.cwd,
+                             self.config.instrument.output_directory,
+                             os.path.expanduser(
+                                 self.config.instrument.wavesol_cache_dir)),
+                'atlines', cache_key(
+                    self.action.args.illum, self.action.args.grating,
+                    self.action.args.ccddata.header['CCDCFG'],
+                    self.action.args.ybinsize,
+                    "%.3f" % self.action.args.atsig,
+                    "%.6f" % self.action.args.refdisp, minrw, maxrw,
+                    "%.3f" % minwav, "%.3f" % maxwav,
+                    np.asarray(atspec, dtype=np.float64),
+                    np.asarray(subwvals, dtype=np.float64),
+                    np.asarray(subyvals, dtype=np.float64),
+                    "%.8f" % refbar_disp, linelist,
+                    os.path.getmtime(linelist) if linelist else None))
+        atlines = read_cache(lines_file)
+        if atlines is not None:
+            self.logger.info("Using cached atlas line list: %s" % lines_file)
+        else:
+            atlines = self.find_atlas_lines(atwave, atspec, subwvals,
+                                            subyvals, refbar_disp, minwav,
+                                            maxwav)
+            if lines_file:
+                write_cache(lines_file, atlines)
+        refws = atlines['refws']
+        refas = atlines['refas']
+        rej_fit_w = atlines['rej_fit_w']
+        rej_fit_y = atlines['rej_fit_y']
+        rej_par_w = atlines['rej_par_w']
+        rej_par_a = atlines['rej_par_a']
+        nrej = atlines['nrej']
+        # store wavelengths, fluxes
+        self.action.args.at_wave = refws
+        self.action.args.at_flux = refas
+        # output filename stub
+        atfnam = "arc_%05d_%s_%s_%s_atlines" % \
+            (self.action.args.ccddata.header['FRAMENO'],
+             self.action.args.illum, self.action.args.grating,
+             self.action.args.ifuname)
+        # output directory
+        output_dir = os.path.join(self.config.instrument.cwd,
+                                  self.config.instrument.output_directory)
+        # write out final atlas line list
+        atlines = np.array([refws, refas])
+        atlines = atlines.T
+        with open(os.path.join(output_dir, atfnam+'.txt'), 'w') as atlfn:
+            np.savetxt(atlfn, atlines, fmt=['%12.3f', '%12.3f'])
+        # plot final list of Atlas lines and show rejections
+        norm_fac = np.nanmax(atspec)
+        if self.config.instrument.plot_level >= 1:
+            p = figure(title=self.action.args.plotlabel +
+                       "ATLAS LINES Ngood = %d, Nrej = %d" % (len(refws), nrej),
+                       x_axis_label="Wavelength (A)",
+                       y_axis_label="Normalized Flux",
+                       plot_width=self.config.instrument.plot_width,
+                       plot_height=self.config.instrument.plot_height)
+            p.line(subwvals, subyvals / np.nanmax(subyvals),
+                   legend_label='RefArc', color='lightgray')
+            p.line(atwave, atspec / norm_fac, legend_label='Atlas',
+                   color='blue')
+            # Rejected: nearby neighbor
+            # p.diamond(rej_neigh_w, rej_neigh_y / norm_fac,
+            #          legend_label='NeighRej', color='cyan', size=8)
+            # Rejected: fit failure
+            p.diamond(rej_fit_w, rej_fit_y / norm_fac, legend_label='FitRej',
+                      color='red', size=8)
+            # Rejected: line parameter outside range
+            p.diamond(rej_par_w, rej_par_a / norm_fac, legend_label='ParRej',
+                      color='orange', size=8)
+            p.diamond(refws, refas / norm_fac, legend_label='Kept',
+                      color='green', size=10)
+            p.line([minwav, minwav], [-0.1, 1.1], legend_label='WavLim',
+                   color='brown')
+            p.line([maxwav, maxwav], [-0.1, 1.1], color='brown')
+            p.x_range = Range1d(min([min(subwvals), minwav-10.]), max(subwvals))
+            p.y_range = Range1d(-0.04, 1.04)
+            bokeh_plot(p, self.context.bokeh_session)
+            if self.config.instrument.plot_level >= 2:
+                input("Next? <cr>: ")
+            else:
+                time.sleep(self.config.instrument.plot_pause)
+            save_plot(p, filename=atfnam+".png")
+        self.logger.info("Final atlas list has %d lines" % len(refws))
+
+        log_string = GetAtlasLines.__module__
+        self.action.args.ccddata.header['HISTORY'] = log_string
+        self.logger.info(log_string)
+
+        return self.action.args
+
+    def find_atlas_lines(self, atwave, atspec, subwvals, subyvals,
+                         refbar_disp, minwav, maxwav):
+        """Qualify atlas lines against the lines in the reference bar
+
+        Returns a dictionary with the kept line wavelengths and amplitudes
+        and the rejected lines.
+        """
         # find good peaks in arc spectrum
         smooth_width = 4  # in pixels
         # peak width
@@ -294,15 +516,18 @@ class GetAtlasLines(BasePrimitive):
         rej_par_w = []  # par rejected atlas line wavelength
         rej_par_a = []  # par rejected atlas line amplitude
         nrej = 0
+        # get atlas pixel positions corresponding to arc lines
+        line_xs = np.searchsorted(atwave, spec_cent, side='left')
         # look at each arc spectrum line
+        windows = []
         for i, pk in enumerate(spec_cent):
             if pk <= minwav or pk >= maxwav:
                 continue
-            # get atlas pixel position corresponding to arc line
             try:
-                line_x = [ii for ii, v in enumerate(atwave) if v >= pk][0]
+                if line_xs[i] >= len(atwave):
+                    raise IndexError
                 # get window around atlas line to fit
-                minow, maxow, count = get_line_window(atspec, line_x)
+                minow, maxow, count = get_line_window(atspec, line_xs[i])
             except IndexError:
                 count = 0
                 minow = None
@@ -317,13 +542,17 @@ class GetAtlasLines(BasePrimitive):
                 nrej += 1
                 self.logger.info("Atlas window rejected for line %.3f" % pk)
                 continue
-            # get data to fit
-            yvec = atspec[minow:maxow + 1]
-            xvec = atwave[minow:maxow + 1]
-            # attempt Gaussian fit
-            try:
-                fit, _ = curve_fit(gaus, xvec, yvec, p0=[spec_hgt[i], pk, 1.])
-            except RuntimeError:
+            windows.append((i, minow, maxow))
+        # attempt Gaussian fits to all atlas lines at once
+        xvecs = [atwave[minow:maxow + 1] for _, minow, maxow in windows]
+        yvecs = [atspec[minow:maxow + 1] for _, minow, maxow in windows]
+        fits, fit_ok = fit_gaussians(
+            xvecs, yvecs, [[spec_hgt[i], spec_cent[i], 1.]
+                           for i, _, _ in windows])
+        for (i, _, _), xvec, yvec, fit, ok in zip(windows, xvecs, yvecs,
+                                                  fits, fit_ok):
+            pk = spec_cent[i]
+            if not ok:
                 # keep track of Gaussian fit rejected lines
                 rej_fit_w.append(pk)
                 rej_fit_y.append(spec_hgt[i])
@@ -331,14 +560,8 @@ class GetAtlasLines(BasePrimitive):
                 self.logger.info("Atlas Gaussian fit rejected for line %.3f" %
                                  pk)
                 continue
-            # get interpolation function of atlas line
-            int_line = interpolate.interp1d(xvec, yvec, kind='cubic',
-                                            bounds_error=False,
-                                            fill_value='extrapolate')
-            # use very dense pixel sampling
-            x_dense = np.linspace(min(xvec), max(xvec), num=1000)
-            # resample line with dense sampling
-            y_dense = int_line(x_dense)
+            # resample atlas line with dense sampling
+            x_dense, y_dense = line_peak(xvec, yvec)
             # get peak amplitude and wavelength
             pki = y_dense.argmax()
             pkw = x_dense[pki]
@@ -392,62 +615,8 @@ class GetAtlasLines(BasePrimitive):
                              (len(refws), self.config.instrument.LINELIST))
         else:
             self.logger.info("Using %d generated lines" % len(refws))
-        # store wavelengths, fluxes
-        self.action.args.at_wave = refws
-        self.action.args.at_flux = refas
-        # output filename stub
-        atfnam = "arc_%05d_%s_%s_%s_atlines" % \
-            (self.action.args.ccddata.header['FRAMENO'],
-             self.action.args.illum, self.action.args.grating,
-             self.action.args.ifuname)
-        # output directory
-        output_dir = os.path.join(self.config.instrument.cwd,
-                                  self.config.instrument.output_directory)
-        # write out final atlas line list
-        atlines = np.array([refws, refas])
-        atlines = atlines.T
-        with open(os.path.join(output_dir, atfnam+'.txt'), 'w') as atlfn:
-            np.savetxt(atlfn, atlines, fmt=['%12.3f', '%12.3f'])
-        # plot final list of Atlas lines and show rejections
-        norm_fac = np.nanmax(atspec)
-        if self.config.instrument.plot_level >= 1:
-            p = figure(title=self.action.args.plotlabel +
-                       "ATLAS LINES Ngood = %d, Nrej = %d" % (len(refws), nrej),
-                       x_axis_label="Wavelength (A)",
-                       y_axis_label="Normalized Flux",
-                       plot_width=self.config.instrument.plot_width,
-                       plot_height=self.config.instrument.plot_height)
-            p.line(subwvals, subyvals / np.nanmax(subyvals),
-                   legend_label='RefArc', color='lightgray')
-            p.line(atwave, atspec / norm_fac, legend_label='Atlas',
-                   color='blue')
-            # Rejected: nearby neighbor
-            # p.diamond(rej_neigh_w, rej_neigh_y / norm_fac,
-            #          legend_label='NeighRej', color='cyan', size=8)
-            # Rejected: fit failure
-            p.diamond(rej_fit_w, rej_fit_y / norm_fac, legend_label='FitRej',
-                      color='red', size=8)
-            # Rejected: line parameter outside range
-            p.diamond(rej_par_w, rej_par_a / norm_fac, legend_label='ParRej',
-                      color='orange', size=8)
-            p.diamond(refws, refas / norm_fac, legend_label='Kept',
-                      color='green', size=10)
-            p.line([minwav, minwav], [-0.1, 1.1], legend_label='WavLim',
-                   color='brown')
-            p.line([maxwav, maxwav], [-0.1, 1.1], color='brown')
-            p.x_range = Range1d(min([min(subwvals), minwav-10.]), max(subwvals))
-            p.y_range = Range1d(-0.04, 1.04)
-            bokeh_plot(p, self.context.bokeh_session)
-            if self.config.instrument.plot_level >= 2:
-                input("Next? <cr>: ")
-            else:
-                time.sleep(self.config.instrument.plot_pause)
-            save_plot(p, filename=atfnam+".png")
-        self.logger.info("Final atlas list has %d lines" % len(refws))
-
-        log_string = GetAtlasLines.__module__
-        self.action.args.ccddata.header['HISTORY'] = log_string
-        self.logger.info(log_string)
-
-        return self.action.args
+        return {'refws': refws, 'refas': refas,
+                'rej_fit_w': rej_fit_w, 'rej_fit_y': rej_fit_y,
+                'rej_par_w': rej_par_w, 'rej_par_a': rej_par_a,
+                'nrej': nrej}
     # END: class GetAtlasLines()
@@ -1,83 +1,206 @@
 from keckdrpframework.primitives.base_primitive import BasePrimitive
 from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_writer, \
-    kcwi_fits_reader, strip_fname
+    kcwi_fits_reader, strip_fname, product_exists
 
 import time
 import os
+import logging
+import tempfile
 import math
 import pickle
 import numpy as np
+import scipy
+from scipy import ndimage as ndi
+from numpy.lib import NumpyVersion
 from skimage import transform as tf
+from skimage.util import img_as_float
 from astropy.coordinates import SkyCoord
 from astropy import units as u
 from astropy.nddata import CCDData
 from kcwidrp.core.bokeh_plotting import bokeh_plot
 from bokeh.plotting import figure
-from multiprocessing import Pool
+from multiprocessing import get_context
+
+
+logger = logging.getLogger('KCWI')
+
+# tf.warp interpolates toward cval beyond the input edges with scipy >= 1.6
+if NumpyVersion(scipy.__version__) >= '1.6.0':
+    constant_mode = 'grid-constant'
+else:
+    constant_mode = 'constant'
+
+# memory-mapped input planes and output cubes attached by each worker
+shared_planes = {}
+shared_cubes = {}
+
+
+def publish_array(directory, name, data=None, shape=None, dtype=None):
+    """Create a memory-mapped array file and return its description
+
+    If data is given it is copied to the file, otherwise a zero-filled
+    array of the given shape and dtype is created.
+    """
+    if data is not None:
+        shape = data.shape
+        dtype = data.dtype
+    dtype = np.dtype(dtype)
+    path = os.path.join(directory, name + '.dat')
+    mapped = np.memmap(path, dtype=dtype, mode='w+', shape=shape)
+    if data is not None:
+        mapped[:] = data
+    mapped.flush()
+    del mapped
+    return path, dtype.str, shape
+
+
+def attach_arrays(specs, mode):
+    """Memory-map the arrays described by publish_array"""
+    return {name: np.memmap(path, dtype=np.dtype(dtype), mode=mode,
+                            shape=shape)
+            for name, (path, dtype, shape) in specs.items()}
+
+
+def make_geometry_coordinates(geom, geom_file):
+    """Return the file of per-slice inverse coordinate maps for a geometry
+
+    The maps are computed once from the slice transforms, so every plane
+    of every frame using this geometry can skip evaluating the polynomial
+    transform.  They are stored next to the _geom.pkl file as a single
+    (24, 2, ysize, xsize) float32 array, 192 bytes per (y, x) position of
+    the slice grid, and rebuilt when the geometry is newer.  float32 holds
+    the coordinates to better than 0.001 pixel at half the float64 size.
+    Returns None if the maps cannot be written.
+    """
+    coord_file = os.path.splitext(geom_file)[0] + '_coords.npy'
+    ysize = geom['ysize']
+    xsize = geom['xsize']
+    shape = (24, 2, ysize, xsize)
+    if os.path.exists(coord_file) and \
+            os.path.getmtime(coord_file) >= os.path.getmtime(geom_file):
+        try:
+            coords = np.load(coord_file, mmap_mode='r')
+            if coords.shape == shape and coords.dtype == np.float32:
+                logger.info("Using slice coordinate maps: %s" % coord_file)
+                return coord_file
+        except (ValueError, OSError):
+            pass
+    logger.info("Computing slice coordinate maps: %s" % coord_file)
+    tmp_file = coord_file + '.tmp'
+    try:
+        coords = np.lib.format.open_memmap(tmp_file, mode='w+',
+                                           dtype=np.float32, shape=shape)
+        for isl in range(0, 24):
+            coords[isl] = tf.warp_coords(geom['tform'][isl], (ysize, xsize))
+        coords.flush()
+        del coords
+        os.replace(tmp_file, coord_file)
+    except OSError as e:
+        logger.warning("Unable to write slice coordinate maps: %s" % e)
+        return None
+    return coord_file
+
+
+def warp_planes(planes, coords, order=3, cval=None, preserve_range=None):
+    """Warp a stack of planes onto the same output grid in one pass
+
+    This is equivalent to calling tf.warp with mode='constant' on each
+    plane, but the planes share the coordinate map and, for order > 1, a
+    single batched spline prefilter of the stacked planes.
+
+    Args:
+        planes (list of numpy.ndarray): same-shape 2D input planes
+        coords (numpy.ndarray): (2, ny, nx) inverse coordinate map
+        order (int): spline interpolation order
+        cval (list of float): fill value for each plane (default 0.)
+        preserve_range (list of bool): keep the range of each plane instead
+            of converting it with img_as_float (default False)
+
+    Returns:
+        list of warped (ny, nx) planes
+    """
+    nplanes = len(planes)
+    if cval is None:
+        cval = [0.] * nplanes
+    if preserve_range is None:
+        preserve_range = [False] * nplanes
+    images = [np.asarray(plane, dtype=np.float64) if keep
+              else img_as_float(plane)
+              for plane, keep in zip(planes, preserve_range)]
+    if order > 1:
+        # pad each plane with its fill value, as map_coordinates does,
+        # then prefilter all planes together along both image axes
+        npad = 12
+        ny, nx = images[0].shape
+        stack = np.empty((nplanes, ny + 2 * npad, nx + 2 * npad),
+                         dtype=np.float64)
+        for ip, image in enumerate(images):
+            stack[ip] = cval[ip]
+            stack[ip, npad:-npad, npad:-npad] = image
+        for axis in (1, 2):
+            ndi.spline_filter1d(stack, order, axis=axis, mode='mirror',
+                                output=stack)
+        coords = coords + npad
+    else:
+        stack = images
+    warped = []
+    for ip, image in enumerate(images):
+        out = ndi.map_coordinates(stack[ip], coords, order=order,
+                                  prefilter=False, mode=constant_mode,
+                                  cval=cval[ip])
+        # clip to the input range, keeping cval if it was used, like tf.warp
+        min_val = np.nanmin(image)
+        max_val = np.nanmax(image)
+        if not min_val <= cval[ip] <= max_val and \
+                np.nanmin(out) <= cval[ip] <= np.nanmax(out):
+            min_val = min(min_val, cval[ip])
+            max_val = max(max_val, cval[ip])
+        np.clip(out, min_val, max_val, out=out)
+        warped.append(out)
+
+    return warped
+
+
+def make_cube_init(plane_specs, cube_specs):
+    """Attach a worker to the shared input planes and output cubes"""
+    # copy-on-write, so the planes are never modified on disk
+    shared_planes.update(attach_arrays(plane_specs, 'c'))
+    shared_cubes.update(attach_arrays(cube_specs, 'r+'))
 
 
 def make_cube_helper(argument):
     """Warp each slice"""
-    logger = argument['logger']
-    logger.info("Transforming image slice %d" % (argument['slice_number']+1))
-    # input params
     slice_number = argument['slice_number']
+    logger.info("Transforming image slice %d" % (slice_number+1))
+    # input params
     xsize = argument['xsize']
     ysize = argument['ysize']
-    tform = argument['geom']['tform'][slice_number]
-    xl0 = argument['geom']['xl0'][slice_number]
-    xl1 = argument['geom']['xl1'][slice_number]
-    # slice data
-    slice_img = argument['img'][:, xl0:xl1]
-    slice_var = argument['std'][:, xl0:xl1]
-    slice_msk = argument['msk'][:, xl0:xl1]
-    slice_flg = argument['flg'][:, xl0:xl1]
-    if 'obj' in argument:
-        slice_obj = argument['obj'][:, xl0:xl1]
-    else:
-        slice_obj = None
-    if 'sky' in argument:
-        slice_sky = argument['sky'][:, xl0:xl1]
-    else:
-        slice_sky = None
-    if 'del' in argument:
-        slice_del = argument['del'][:, xl0:xl1]
-    else:
-        slice_del = None
-    # do the warping
-    # logger.info(f"Warp Order: {argument['order']}")
-    warped = tf.warp(slice_img, tform, order=argument['order'],
-                     output_shape=(ysize, xsize))
-    varped = tf.warp(slice_var, tform, order=argument['order'],
-                     output_shape=(ysize, xsize))
-    marped = tf.warp(slice_msk, tform, order=1,
-                     output_shape=(ysize, xsize), 
-                     mode='constant', cval=1) # linear order
-    farped = tf.warp(slice_flg, tform, order=1,
-                     output_shape=(ysize, xsize), 
-                     preserve_range=True, 
-                     mode='constant', cval=64) # linear order keeps all pixels
-
-    if slice_obj is not None:
-        oarped = tf.warp(slice_obj, tform, order=argument['order'],
-                         output_shape=(ysize, xsize))
-    else:
-        oarped = None
-
-    if slice_sky is not None:
-        sarped = tf.warp(slice_sky, tform, order=argument['order'],
-                         output_shape=(ysize, xsize))
-    else:
-        sarped = None
-
-    if slice_del is not None:
-        darped = tf.warp(slice_del, tform, order=argument['order'],
-                         output_shape=(ysize, xsize), preserve_range=True)
+    # precomputed coordinate map, if available, else evaluate the transform
+    if argument['coord_file'] is not None:
+        coords = np.load(argument['coord_file'],
+                         mmap_mode='r')[slice_number]
     else:
-        darped = None
+        coords = tf.warp_coords(argument['tform'], (ysize, xsize))
+    xl0 = argument['xl0']
+    xl1 = argument['xl1']
+    order = argument['order']
+    # image, variance, obj, sky and delta planes share the warp order
+    names = [name for name in ('img', 'std', 'obj', 'sky', 'del')
+             if name in shared_planes]
+    warped = warp_planes([shared_planes[name][:, xl0:xl1] for name in names],
+                         coords, order=order,
+                         preserve_range=[name == 'del' for name in names])
+    # mask and flags use linear order, which keeps all flagged pixels
+    names += ['msk', 'flg']
+    warped += warp_planes([shared_planes['msk'][:, xl0:xl1],
+                           shared_planes['flg'][:, xl0:xl1]],
+                          coords, order=1, cval=[1, 64],
+                          preserve_range=[False, True])
+    for name, plane in zip(names, warped):
+        shared_cubes[name][slice_number] = plane
+        shared_cubes[name].flush()
 
-    return argument['slice_number'], warped, varped, marped, farped, \
-        oarped, sarped, darped
+    return slice_number
 
 
 class MakeCube(BasePrimitive):
@@ -88,7 +211,7 @@ class MakeCube(BasePrimitive):
         full_path = os.path.join(
             self.config.instrument.cwd,
             self.config.instrument.output_directory, objfn)
-        if os.path.exists(full_path):
+        if product_exists(full_path):
             return kcwi_fits_reader(full_path)[0]
         else:
             self.logger.error(f'Unable to read file {objfn}')
@@ -135,13 +258,6 @@ class MakeCube(BasePrimitive):
             # Slice size
             xsize = geom['xsize']
             ysize = geom['ysize']
-            out_cube = np.zeros((ysize, xsize, 24), dtype=np.float64)
-            out_vube = np.zeros((ysize, xsize, 24), dtype=np.float64)
-            out_mube = np.zeros((ysize, xsize, 24), dtype=np.uint8)
-            out_fube = np.zeros((ysize, xsize, 24), dtype=np.uint8)
-            out_oube = np.zeros((ysize, xsize, 24), dtype=np.float64)
-            out_sube = np.zeros((ysize, xsize, 24), dtype=np.float64)
-            out_dube = np.zeros((ysize, xsize, 24), dtype=np.float64)
             # Store original data
             data_img = self.action.args.ccddata.data
             data_std = self.action.args.ccddata.uncertainty.array
@@ -159,7 +275,7 @@ class MakeCube(BasePrimitive):
                 full_path = os.path.join(
                     self.config.instrument.cwd,
                     self.config.instrument.output_directory, objfn)
-                if os.path.exists(full_path):
+                if product_exists(full_path):
                     obj = kcwi_fits_reader(full_path)[0]
                     data_obj = obj.data
 
@@ -167,7 +283,7 @@ class MakeCube(BasePrimitive):
                 full_path = os.path.join(
                     self.config.instrument.cwd,
                     self.config.instrument.output_directory, skyfn)
-                if os.path.exists(full_path):
+                if product_exists(full_path):
                     sky = kcwi_fits_reader(full_path)[0]
                     data_sky = sky.data
             # check for geometry maps
@@ -179,30 +295,38 @@ class MakeCube(BasePrimitive):
                 full_path = os.path.join(
                     self.config.instrument.cwd,
                     self.config.instrument.output_directory, dewfn)
-                if os.path.exists(full_path):
+                if product_exists(full_path):
                     dew = kcwi_fits_reader(full_path)[0]
                     data_dew = dew.data
+            # Planes to warp, with the dtype of their output cubes
+            planes = {'img': data_img, 'std': data_std, 'msk': data_msk,
+                      'flg': data_flg}
+            cube_dtypes = {'img': np.float64, 'std': np.float64,
+                           'msk': np.uint8, 'flg': np.uint8}
+            if obj is not None:
+                planes['obj'] = data_obj
+                cube_dtypes['obj'] = np.float64
+            if sky is not None:
+                planes['sky'] = data_sky
+                cube_dtypes['sky'] = np.float64
+            if dew is not None:
+                planes['del'] = data_dew
+                cube_dtypes['del'] = np.float64
+            # Coordinate maps shared by all planes of all slices
+            coord_file = make_geometry_coordinates(geom, geom_file)
             # Loop over 24 slices
             my_arguments = []
             for isl in range(0, 24):
                 arguments = {
                     'slice_number': isl,
-                    'geom': geom,
-                    'img': data_img,
-                    'std': data_std,
-                    'msk': data_msk,
-                    'flg': data_flg,
+                    'tform': geom['tform'][isl],
+                    'coord_file': coord_file,
+                    'xl0': geom['xl0'][isl],
+                    'xl1': geom['xl1'][isl],
                     'xsize': xsize,
                     'ysize': ysize,
-                    'logger': self.logger,
                     'order': self.config.instrument.warp_order
                 }
-                if obj is not None:
-                    arguments['obj'] = data_obj
-                if sky is not None:
-                    arguments['sky'] = data_sky
-                if dew is not None:
-                    arguments['del'] = data_dew
                 my_arguments.append(arguments)
 
             self.logger.info(f"Image cube order = {arguments['order']}")
@@ -210,23 +334,42 @@ class MakeCube(BasePrimitive):
             self.logger.info(f"Mask cube order = 1")
             self.logger.info(f"Flag cube order = 1")
 
-            p = Pool()
-            results = p.map(make_cube_helper, list(my_arguments))
-            p.close()
-
-            self.logger.info("Building cube")
-            for partial_cube in results:
-                slice_number = partial_cube[0]
-                out_cube[:, :, slice_number] = partial_cube[1]
-                out_vube[:, :, slice_number] = partial_cube[2]
-                out_mube[:, :, slice_number] = partial_cube[3]
-                out_fube[:, :, slice_number] = partial_cube[4]
-                if obj is not None:
-                    out_oube[:, :, slice_number] = partial_cube[5]
-                if sky is not None:
-                    out_sube[:, :, slice_number] = partial_cube[6]
-                if dew is not None:
-                    out_dube[:, :, slice_number] = partial_cube[7]
+            # Publish the planes once and have the workers write their
+            # warped slices directly into memory-mapped output cubes
+            with tempfile.TemporaryDirectory(prefix='kcwi_cube_') as tmpdir:
+                plane_specs = {}
+                cube_specs = {}
+                for name, plane in planes.items():
+                    plane_specs[name] = publish_array(tmpdir, 'plane_' + name,
+                                                      np.asarray(plane))
+                    cube_specs[name] = publish_array(
+                        tmpdir, 'cube_' + name, shape=(24, ysize, xsize),
+                        dtype=cube_dtypes[name])
+
+                # spawn, as forking while the write-behind threads hold
+                # locks is unsafe
+                p = get_context("spawn").Pool(
+                    initializer=make_cube_init,
+                    initargs=(plane_specs, cube_specs))
+                p.map(make_cube_helper, my_arguments)
+                p.close()
+                p.join()
+
+                self.logger.info("Building cube")
+                cubes = attach_arrays(cube_specs, 'r')
+                # back to (wavelength, position, slice) ordering
+                out_cubes = {name: np.array(np.moveaxis(cube, 0, -1),
+                                            order='C')
+                             for name, cube in cubes.items()}
+                del cubes
+
+            out_cube = out_cubes['img']
+            out_vube = out_cubes['std']
+            out_mube = out_cubes['msk']
+            out_fube = out_cubes['flg']
+            out_oube = out_cubes.get('obj')
+            out_sube = out_cubes.get('sky')
+            out_dube = out_cubes.get('del')
 
             if self.config.instrument.plot_level >= 3:
                 for isl in range(0, 24):
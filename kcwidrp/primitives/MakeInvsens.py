@@ -4,7 +4,7 @@ from kcwidrp.core.kcwi_correct_extin import kcwi_correct_extin
 from kcwidrp.core.kcwi_get_std import kcwi_get_std
 from kcwidrp.core.kcwi_plotting import set_plot_lims, save_plot
 from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_writer, \
-    kcwi_fits_reader, strip_fname
+    kcwi_fits_reader, strip_fname, product_exists
 
 from bokeh.plotting import figure, ColumnDataSource
 from scipy.signal import find_peaks
@@ -55,7 +55,7 @@ class MakeInvsens(BasePrimitive):
                     invsensf = os.path.join(self.config.instrument.cwd,
                                             rdir,
                                             msname)
-                    if os.path.exists(invsensf):
+                    if product_exists(invsensf):
                         self.logger.warning("Master cal already exists: %s" %
                                             invsensf)
                         return False
@@ -160,7 +160,7 @@ class MakeInvsens(BasePrimitive):
         full_path = os.path.join(
             self.config.instrument.cwd,
             self.config.instrument.output_directory, delfn)
-        if os.path.exists(full_path):
+        if product_exists(full_path):
             dew = kcwi_fits_reader(full_path)[0]
             dwspec = dew.data[:, cy, mxsl]
             zeros = np.where(dwspec == 0)
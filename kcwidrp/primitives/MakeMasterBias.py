@@ -1,12 +1,11 @@
 from keckdrpframework.models.arguments import Arguments
 from keckdrpframework.primitives.base_img import BaseImg
-from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_reader, \
+from kcwidrp.primitives.kcwi_file_primitives import kcwi_stack_frames, \
     kcwi_fits_writer, master_bias_name, parse_imsec
 from kcwidrp.core.bokeh_plotting import bokeh_plot
 from kcwidrp.core.kcwi_plotting import save_plot
 
 from bokeh.plotting import figure
-import ccdproc
 import numpy as np
 from scipy.stats import sigmaclip
 import time
@@ -55,19 +54,20 @@ class MakeMasterBias(BaseImg):
         # mbname = combine_list[-1].split('.fits')[0] + '_' + suffix + '.fits'
         mbname = master_bias_name(self.action.args.ccddata)
 
-        stack = []
         stackf = []
         for bias in combine_list:
             # stackf.append(bias)
             stackf.append(bias.replace('.fits', '_ins.fits'))
-            biasfn = os.path.join(self.config.instrument.output_directory, stackf[-1])
-            # using [0] drops the table
-            # stack.append(kcwi_fits_reader(bias)[0])
-            stack.append(kcwi_fits_reader(biasfn)[0])
+        biasfns = [os.path.join(self.config.instrument.output_directory, f)
+                   for f in stackf]
 
-        stacked = ccdproc.combine(stack, method=method, sigma_clip=True,
-                                  sigma_clip_low_thresh=None,
-                                  sigma_clip_high_thresh=2.0)
+        # the clipping of ccdproc.combine with sigma_clip_low_thresh=None,
+        # which falls back to 3 sigma, and sigma_clip_high_thresh=2.0;
+        # for readnoise stats use 2nd and 3rd bias
+        stacked, diff, _ = kcwi_stack_frames(
+            biasfns, method=method, low_thresh=3., high_thresh=2.,
+            chunk_rows=self.config.instrument.stack_chunk_rows,
+            nthreads=self.config.instrument.stack_nthreads, diff_pair=(1, 2))
         stacked.header['IMTYPE'] = self.action.args.new_type
         stacked.header['NSTACK'] = (len(combine_list),
                                     'number of images stacked')
@@ -76,10 +76,7 @@ class MakeMasterBias(BaseImg):
             fname_base = os.path.basename(fname)
             stacked.header['STACKF%d' % (ii + 1)] = (fname_base, "stack input file")
 
-        # for readnoise stats use 2nd and 3rd bias
-        diff = stack[1].data.astype(np.float32) - \
-            stack[2].data.astype(np.float32)
-        namps = stack[1].header['NVIDINP']
+        namps = stacked.header['NVIDINP']
         for ia in range(namps):
             # get gain
             gain = stacked.header['GAIN%d' % (ia + 1)]
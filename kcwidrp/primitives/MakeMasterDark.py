@@ -1,9 +1,8 @@
 from keckdrpframework.primitives.base_img import BaseImg
-from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_reader, \
+from kcwidrp.primitives.kcwi_file_primitives import kcwi_stack_frames, \
     kcwi_fits_writer, strip_fname, get_master_name
 
 import os
-import ccdproc
 
 
 class MakeMasterDark(BaseImg):
@@ -42,19 +41,18 @@ class MakeMasterDark(BaseImg):
         combine_list = list(self.combine_list['filename'])
         # get master dark output name
         mdname = strip_fname(combine_list[0]) + '_' + suffix + '.fits'
-        stack = []
         stackf = []
         for dark in combine_list:
             # get dark intensity (int) image file name in redux directory
             stackf.append(dark.split('.fits')[0] + '_int.fits')
-            darkfn = os.path.join(args.in_directory, stackf[-1])
-            # using [0] gets just the image data
-            stack.append(kcwi_fits_reader(darkfn)[0])
+        darkfns = [os.path.join(args.in_directory, f) for f in stackf]
 
-        stacked = ccdproc.combine(stack, method=method, sigma_clip=True,
-                                  sigma_clip_low_thresh=None,
-                                  sigma_clip_high_thresh=2.0)
-        stacked.unit = stack[0].unit
+        # the clipping of ccdproc.combine with sigma_clip_low_thresh=None,
+        # which falls back to 3 sigma, and sigma_clip_high_thresh=2.0
+        stacked, _, _ = kcwi_stack_frames(
+            darkfns, method=method, low_thresh=3., high_thresh=2.,
+            chunk_rows=self.config.instrument.stack_chunk_rows,
+            nthreads=self.config.instrument.stack_nthreads)
         stacked.header.IMTYPE = args.new_type
         stacked.header['NSTACK'] = (len(combine_list),
                                     'number of images stacked')
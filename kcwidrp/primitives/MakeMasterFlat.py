@@ -90,21 +90,21 @@ class MakeMasterFlat(BaseImg):
         self.logger.info("Reading image: %s" % wmf)
         wavemap = kcwi_fits_reader(
             os.path.join(self.config.instrument.cwd, 'redux',
-                         wmf))[0]
+                         wmf), extensions=())[0]
 
         # Slice map image
         slf = mroot + '_slicemap.fits'
         self.logger.info("Reading image: %s" % slf)
         slicemap = kcwi_fits_reader(os.path.join(
             self.config.instrument.cwd, 'redux',
-                         slf))[0]
+                         slf), extensions=())[0]
 
         # Position map image
         pof = mroot + '_posmap.fits'
         self.logger.info("Reading image: %s" % pof)
         posmap = kcwi_fits_reader(os.path.join(
             self.config.instrument.cwd, 'redux',
-                         pof))[0]
+                         pof), extensions=())[0]
 
         # Read in stacked flat image
         stname = strip_fname(stack_list[0]) + '_' + insuff + '.fits'
@@ -169,8 +169,14 @@ class MakeMasterFlat(BaseImg):
         except KeyError:
             dichroic_fraction = 1.
 
+        # flattened maps and data for pixel selection
+        slice_flat = slicemap.data.ravel()
+        pos_flat = posmap.data.ravel()
+        wave_flat = wavemap.data.ravel()
+        stacked_flat = stacked.data.ravel()
+
         # get reference slice data
-        q = [i for i, v in enumerate(slicemap.data.flat) if v == refslice]
+        q = np.flatnonzero(slice_flat == refslice)
         # get wavelength limits
         waves = wavemap.data.compress((wavemap.data > 0.).flat)
         waves = [waves.min(), waves.max()]
@@ -197,25 +203,19 @@ class MakeMasterFlat(BaseImg):
             self.logger.info("Using %.1f - %.1f A of slice %d" % (wavemin,
                                                                   wavemax,
                                                                   refslice))
-            xflat = []
-            yflat = []
-            wflat = []
-            qq = []
-            for i in q:
-                if wavemin < wavemap.data.flat[i] < wavemax:
-                    xflat.append(posmap.data.flat[i])
-                    yflat.append(stacked.data.flat[i])
-                    wflat.append(wavemap.data.flat[i])
-                    qq.append(i)
+            qq = q[(wavemin < wave_flat[q]) & (wave_flat[q] < wavemax)]
+            xflat = pos_flat[qq]
+            yflat = stacked_flat[qq]
+            wflat = wave_flat[qq]
             # get un-vignetted portion
-            qflat = [i for i, v in enumerate(xflat) if flatl <= v <= flatr]
-            xflat = [xflat[i] for i in qflat]
-            yflat = [yflat[i] for i in qflat]
-            wflat = [wflat[i] for i in qflat]
+            qflat = (flatl <= xflat) & (xflat <= flatr)
+            xflat = xflat[qflat]
+            yflat = yflat[qflat]
+            wflat = wflat[qflat]
             # sort on wavelength
             sw = np.argsort(wflat)
-            ywflat = [yflat[i] for i in sw]
-            wwflat = [wflat[i] for i in sw]
+            ywflat = yflat[sw]
+            wwflat = wflat[sw]
             ww0 = np.min(wwflat)
             # fit wavelength slope
             wavelinfit = np.polyfit(wwflat-ww0, ywflat, 2)
@@ -239,32 +239,32 @@ class MakeMasterFlat(BaseImg):
             yflat = yflat / wslfit
             # now sort on slice position
             ss = np.argsort(xflat)
-            xflat = [xflat[i] for i in ss]
-            yflat = [yflat[i] for i in ss]
+            xflat = xflat[ss]
+            yflat = yflat[ss]
             # fit un-vignetted slope
             resflat = np.polyfit(xflat, yflat, 1)
 
             # select the points we will fit for the vignetting
             # get reference region
-            xfit = [posmap.data.flat[i] for i in qq]
-            yfit = [stacked.data.flat[i] for i in qq]
-            wflat = [wavemap.data.flat[i] for i in qq]
+            xfit = pos_flat[qq]
+            yfit = stacked_flat[qq]
+            wflat = wave_flat[qq]
             # take out wavelength slope
             yfit = yfit / np.polyval(wavelinfit, wflat-ww0)
 
             # select the vignetted region
-            qfit = [i for i, v in enumerate(xfit) if fitl <= v <= fitr]
-            xfit = [xfit[i] for i in qfit]
-            yfit = [yfit[i] for i in qfit]
+            qfit = (fitl <= xfit) & (xfit <= fitr)
+            xfit = xfit[qfit]
+            yfit = yfit[qfit]
             # sort on slice position
             s = np.argsort(xfit)
-            xfit = [xfit[i] for i in s]
-            yfit = [yfit[i] for i in s]
+            xfit = xfit[s]
+            yfit = yfit[s]
             # fit vignetted slope
             resfit = np.polyfit(xfit, yfit, 1)
             # corrected data
-            ycdata = stacked.data.flat[qq] / \
-                np.polyval(wavelinfit, wavemap.data.flat[qq]-ww0)
+            ycdata = stacked_flat[qq] / \
+                np.polyval(wavelinfit, wave_flat[qq]-ww0)
             ycmin = 0.5     # np.min(ycdata)
             ycmax = 1.25    # np.max(ycdata)
             # compute the intersection
@@ -276,7 +276,7 @@ class MakeMasterFlat(BaseImg):
                            y_axis_label='Ratio',
                            plot_width=self.config.instrument.plot_width,
                            plot_height=self.config.instrument.plot_height)
-                p.circle(posmap.data.flat[qq], ycdata, legend_label='Data')
+                p.circle(pos_flat[qq], ycdata, legend_label='Data')
                 p.line(allidx, resfit[1] + resfit[0]*allidx,
                        line_color='purple', legend_label='Vign.')
                 p.line(allidx, resflat[1] + resflat[0]*allidx, line_color='red',
@@ -298,28 +298,25 @@ class MakeMasterFlat(BaseImg):
                     time.sleep(self.config.instrument.plot_pause)
 
             # figure out where the correction applies
-            qcor = [i for i, v in enumerate(posmap.data.flat)
-                    if 0 <= v <= (xinter-buffer)]
+            qcor = (0 <= posmap.data) & (posmap.data <= (xinter-buffer))
             # apply the correction!
             self.logger.info("Applying vignetting correction...")
-            for i in qcor:
-                newflat.flat[i] = (resflat[1]+resflat[0]*posmap.data.flat[i]) \
-                                / (resfit[1]+resfit[0]*posmap.data.flat[i]) * \
-                                stacked.data.flat[i]
+            xcor = posmap.data[qcor]
+            newflat[qcor] = (resflat[1]+resflat[0]*xcor) \
+                / (resfit[1]+resfit[0]*xcor) * stacked.data[qcor]
             # now deal with the intermediate (buffer) region
             self.logger.info("Done, now handling buffer region")
             # get buffer points to fit in reference region
-            qbff = [i for i in qq if (xinter-buffer) <=
-                    posmap.data.flat[i] <= (xinter+buffer)]
+            qbff = qq[((xinter-buffer) <= pos_flat[qq]) &
+                      (pos_flat[qq] <= (xinter+buffer))]
             # get slice pos and data for buffer fitting
-            xbuff = [posmap.data.flat[i] for i in qbff]
-            ybuff = [stacked.data.flat[i] / np.polyval(wavelinfit,
-                                                       wavemap.data.flat[i]-ww0)
-                     for i in qbff]
+            xbuff = pos_flat[qbff]
+            ybuff = stacked_flat[qbff] / np.polyval(wavelinfit,
+                                                    wave_flat[qbff]-ww0)
             # sort on slice position
             ssp = np.argsort(xbuff)
-            xbuff = [xbuff[i] for i in ssp]
-            ybuff = [ybuff[i] for i in ssp]
+            xbuff = xbuff[ssp]
+            ybuff = ybuff[ssp]
             # fit buffer with low-order poly
             buffit = np.polyfit(xbuff, ybuff, 3)
             # plot buffer fit
@@ -337,21 +334,21 @@ class MakeMasterFlat(BaseImg):
                 else:
                     time.sleep(self.config.instrument.plot_pause)
             # get all buffer points in image
-            qbuf = [i for i, v in enumerate(posmap.data.flat)
-                    if (xinter-buffer) <= v <= (xinter+buffer)]
+            qbuf = ((xinter-buffer) <= posmap.data) & \
+                (posmap.data <= (xinter+buffer))
             # apply buffer correction to all buffer points in newflat
-            for i in qbuf:
-                newflat.flat[i] = \
-                    (resflat[1] + resflat[0] * posmap.data.flat[i]) / \
-                    np.polyval(buffit, posmap.data.flat[i]) * newflat.flat[i]
+            xbuf = posmap.data[qbuf]
+            newflat[qbuf] = (resflat[1] + resflat[0] * xbuf) / \
+                np.polyval(buffit, xbuf) * newflat[qbuf]
             self.logger.info("Vignetting correction complete.")
 
         self.logger.info("Fitting master illumination")
         # now fit master flat
         # get reference slice points
-        qref = [i for i in q if ffleft <= posmap.data.flat[i] <= ffright]
-        xfr = wavemap.data.flat[qref]
-        yfr = newflat.flat[qref]
+        newflat_flat = newflat.ravel()
+        qref = q[(ffleft <= pos_flat[q]) & (pos_flat[q] <= ffright)]
+        xfr = wave_flat[qref]
+        yfr = newflat_flat[qref]
         # sort on wavelength
         s = np.argsort(xfr)
         xfr = xfr[s]
@@ -368,13 +365,12 @@ class MakeMasterFlat(BaseImg):
                              "for ref slice = %.2f (A)" % ledge_wave)
             if wavegood0 <= ledge_wave <= wavegood1:
                 self.logger.info("BM grating requires correction")
-                qledge = [i for i, v in enumerate(xfr)
-                          if ledge_wave-25 <= v <= ledge_wave+25]
-                xledge = [xfr[i] for i in qledge]
-                yledge = [yfr[i] for i in qledge]
+                qledge = (ledge_wave-25 <= xfr) & (xfr <= ledge_wave+25)
+                xledge = xfr[qledge]
+                yledge = yfr[qledge]
                 s = np.argsort(xledge)
-                xledge = [xledge[i] for i in s]
-                yledge = [yledge[i] for i in s]
+                xledge = xledge[s]
+                yledge = yledge[s]
                 win = boxcar(250)
                 smyledge = sp.signal.convolve(yledge,
                                               win, mode='same') / sum(win)
@@ -437,21 +433,19 @@ class MakeMasterFlat(BaseImg):
                 xhi = apk - 3
                 zlow = apk + 3
                 zhi = apk + 3 + 5
-                qlow = [i for i, v in enumerate(fpoints) if xlow <= v <= xhi]
-                xlf = np.asarray([fpoints[i] for i in qlow])
-                ylf = np.asarray([ylfit[i] for i in qlow])
+                qlow = (xlow <= fpoints) & (fpoints <= xhi)
+                xlf = fpoints[qlow]
+                ylf = ylfit[qlow]
                 lowfit = np.polyfit(xlf, ylf, 1)
-                qhi = [i for i, v in enumerate(fpoints) if zlow <= v <= zhi]
-                xlf = np.asarray([fpoints[i] for i in qhi])
-                ylf = np.asarray([ylfit[i] for i in qhi])
+                qhi = (zlow <= fpoints) & (fpoints <= zhi)
+                xlf = fpoints[qhi]
+                ylf = ylfit[qhi]
                 hifit = np.polyfit(xlf, ylf, 1)
                 ratio = (hifit[1] + hifit[0] * apk) / \
                         (lowfit[1] + lowfit[0] * apk)
                 self.logger.info("BM ledge ratio: %.3f" % ratio)
                 # correct flat data
-                qcorr = [i for i, v in enumerate(xfr) if v >= apk]
-                for i in qcorr:
-                    yfr[i] /= ratio
+                yfr[xfr >= apk] /= ratio
                 # plot BM ledge
                 if self.config.instrument.plot_level >= 1:
                     p = figure(
@@ -464,12 +458,9 @@ class MakeMasterFlat(BaseImg):
                     p.circle(xledge, yledge, fill_color='blue',
                              legend_label='Data')
                     # correct input data
-                    qcorrect = [i for i, v in enumerate(xledge) if v >= apk]
-                    xplt = []
-                    yplt = []
-                    for i in qcorrect:
-                        xplt.append(xledge[i])
-                        yplt.append(yledge[i] / ratio)
+                    qcorrect = xledge >= apk
+                    xplt = xledge[qcorrect]
+                    yplt = yledge[qcorrect] / ratio
                     p.circle(xplt, yplt, fill_color='orange',
                              legend_label='Corrected')
                     p.line(fpoints, ylfit, line_color='red', legend_label='Fit')
@@ -511,10 +502,10 @@ class MakeMasterFlat(BaseImg):
         blueslice = 12
         blueleft = 60 / xbin
         blueright = 80 / xbin
-        qb = [i for i, v in enumerate(slicemap.data.flat) if v == blueslice]
-        qblue = [i for i in qb if blueleft <= posmap.data.flat[i] <= blueright]
-        xfb = wavemap.data.flat[qblue]
-        yfb = newflat.flat[qblue]
+        qblue = np.flatnonzero((slice_flat == blueslice) &
+                               (blueleft <= pos_flat) & (pos_flat <= blueright))
+        xfb = wave_flat[qblue]
+        yfb = newflat_flat[qblue]
         s = np.argsort(xfb)
         xfb = xfb[s]
         yfb = yfb[s]
@@ -528,10 +519,10 @@ class MakeMasterFlat(BaseImg):
         redslice = 23
         redleft = 60 / xbin
         redright = 80 / xbin
-        qr = [i for i, v in enumerate(slicemap.data.flat) if v == redslice]
-        qred = [i for i in qr if redleft <= posmap.data.flat[i] <= redright]
-        xfd = wavemap.data.flat[qred]
-        yfd = newflat.flat[qred]
+        qred = np.flatnonzero((slice_flat == redslice) &
+                              (redleft <= pos_flat) & (pos_flat <= redright))
+        xfd = wave_flat[qred]
+        yfd = newflat_flat[qred]
         s = np.argsort(xfd)
         xfd = xfd[s]
         yfd = yfd[s]
@@ -598,8 +589,8 @@ class MakeMasterFlat(BaseImg):
         wlb1 = minrwave+(maxrwave-minrwave)*wavebuffer
         wlr0 = minrwave+(maxrwave-minrwave)*(1.-wavebuffer)
         wlr1 = minrwave+(maxrwave-minrwave)*(1.-wavebuffer2)
-        qbluefit = [i for i, v in enumerate(waves) if wlb0 < v < wlb1]
-        qredfit = [i for i, v in enumerate(waves) if wlr0 < v < wlr1]
+        qbluefit = np.flatnonzero((wlb0 < waves) & (waves < wlb1))
+        qredfit = np.flatnonzero((wlr0 < waves) & (waves < wlr1))
 
         nqb = len(qbluefit)
         nqr = len(qredfit)
@@ -718,8 +709,8 @@ class MakeMasterFlat(BaseImg):
         # at this point we are going to try to merge the points
         self.logger.info("Correcting points outside %.1f - %.1f A"
                          % (minrwave, maxrwave))
-        qselblue = [i for i, v in enumerate(xfb) if v <= minrwave]
-        qselred = [i for i, v in enumerate(xfd) if v >= maxrwave]
+        qselblue = np.flatnonzero(xfb <= minrwave)
+        qselred = np.flatnonzero(xfd >= maxrwave)
         nqsb = len(qselblue)
         nqsr = len(qselred)
         blue_all_tie = yfitr[0]
@@ -731,14 +722,14 @@ class MakeMasterFlat(BaseImg):
             self.logger.info("Blue ext tie value: %.3f" % yfb[qselblue[-1]])
             if blue_zero_cross:
                 blue_offset = yfb[qselblue[-1]] - blue_all_tie
-                bluefluxes = [yfb[i] - blue_offset for i in qselblue]
+                bluefluxes = yfb[qselblue] - blue_offset
                 self.logger.info("Blue zero crossing, only applying offset")
             else:
                 blue_offset = yfb[qselblue[-1]] * \
                               (bluelinfit[1]+bluelinfit[0]*xfb[qselblue[-1]]) \
                               - blue_all_tie
-                bluefluxes = [yfb[i] * (bluelinfit[1]+bluelinfit[0]*xfb[i])
-                              - blue_offset for i in qselblue]
+                bluefluxes = yfb[qselblue] * \
+                    (bluelinfit[1]+bluelinfit[0]*xfb[qselblue]) - blue_offset
                 self.logger.info("Blue linear ratio fit scaling applied")
             self.logger.info("Blue offset of %.2f applied" % blue_offset)
         else:
@@ -747,14 +738,14 @@ class MakeMasterFlat(BaseImg):
             self.logger.info("Red ext tie value: %.3f" % yfd[qselred[0]])
             if red_zero_cross:
                 red_offset = yfd[qselred[0]] - red_all_tie
-                redfluxes = [yfd[i] - red_offset for i in qselred]
+                redfluxes = yfd[qselred] - red_offset
                 self.logger.info("Red zero crossing, only applying offset")
             else:
                 red_offset = yfd[qselred[0]] * \
                              (redlinfit[1]+redlinfit[0]*xfd[qselred[0]]) \
                              - red_all_tie
-                redfluxes = [yfd[i] * (redlinfit[1]+redlinfit[0]*xfd[i])
-                             - red_offset for i in qselred]
+                redfluxes = yfd[qselred] * \
+                    (redlinfit[1]+redlinfit[0]*xfd[qselred]) - red_offset
                 self.logger.info("Red linear ratio fit scaling applied")
             self.logger.info("Red offset of %.2f applied" % red_offset)
         else:
@@ -822,37 +813,33 @@ class MakeMasterFlat(BaseImg):
         # OK, Now we have extended to the full range... so... we are going to
         # make a ratio flat!
         comflat = np.zeros(newflat.shape, dtype=float)
-        qz = [i for i, v in enumerate(wavemap.data.flat) if v >= 0]
+        qz = wavemap.data >= 0
 
-        comvals = sftall.value(wavemap.data.flat[qz])
+        comvals, _ = sftall.value(wavemap.data[qz])
 
-        comflat.flat[qz] = comvals
+        comflat[qz] = comvals
         ratio = np.zeros(newflat.shape, dtype=float)
-        qzer = [i for i, v in enumerate(newflat.flat) if v != 0]
-        ratio.flat[qzer] = comflat.flat[qzer] / newflat.flat[qzer]
+        qzer = newflat != 0
+        ratio[qzer] = comflat[qzer] / newflat[qzer]
 
         # set up flags
         flags = np.zeros_like(ratio, dtype=np.uint8)
 
         # trim negative points
-        qq = [i for i, v in enumerate(ratio.flat) if v < 0]
-        if len(qq) > 0:
-            ratio.flat[qq] = 0.0
-            flags.flat[qq] = 8
+        qq = ratio < 0
+        ratio[qq] = 0.0
+        flags[qq] = 8
 
         # trim the high points near edges of slice
-        qq = [i for i, v in enumerate(ratio.flat) if v >= 3. and
-              (posmap.data.flat[i] <= 4/xbin or
-               posmap.data.flat[i] >= 136/xbin)]
-        if len(qq) > 0:
-            ratio.flat[qq] = 0.0
-            flags.flat[qq] = 16
+        qq = (ratio >= 3.) & ((posmap.data <= 4/xbin) |
+                              (posmap.data >= 136/xbin))
+        ratio[qq] = 0.0
+        flags[qq] = 16
 
         # don't correct low signal points
-        qq = [i for i, v in enumerate(newflat.flat) if v < 30.]
-        if len(qq) > 0:
-            ratio.flat[qq] = 1.0
-            flags.flat[qq] = 32
+        qq = newflat < 30.
+        ratio[qq] = 1.0
+        flags[qq] = 32
 
         # get master flat output name
         mfname = stack_list[0].split('.fits')[0] + '_' + suffix + '.fits'
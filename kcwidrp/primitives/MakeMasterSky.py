@@ -1,6 +1,6 @@
 from keckdrpframework.primitives.base_img import BaseImg
 from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_reader, \
-    kcwi_fits_writer, strip_fname, get_master_name
+    kcwi_fits_writer, strip_fname, get_master_name, product_exists
 from kcwidrp.core.bokeh_plotting import bokeh_plot
 from kcwidrp.core.kcwi_plotting import save_plot
 from kcwidrp.core.bspline import Bspline
@@ -12,6 +12,79 @@ import numpy as np
 from astropy.io import fits, ascii
 from astropy.table import Table
 
+# decoded maps and geometry-only sky selections, keyed on the arc geometry
+sky_geometry_cache = {}
+
+
+def get_sky_geometry(geom_file, map_files, logger=None):
+    """Return the wavelength, slice and position maps for a geometry
+
+    The maps are kept in memory and only read again when the geometry or
+    map files change.  Only the most recent geometry is kept.
+
+    Args:
+        geom_file (str): the arc _geom.pkl file
+        map_files (tuple): wavemap, slicemap and posmap files
+        logger (logging.Logger): logger for the files read
+
+    Returns:
+        dict with the 'wavemap', 'slicemap' and 'posmap' images and the
+        cached 'selections'
+    """
+    stamp = tuple(os.path.getmtime(f) if os.path.exists(f) else None
+                  for f in (geom_file,) + tuple(map_files))
+    geometry = sky_geometry_cache.get(geom_file)
+    if geometry is None or geometry['stamp'] != stamp:
+        sky_geometry_cache.clear()
+        geometry = {'stamp': stamp, 'selections': {}}
+        for key, map_file in zip(('wavemap', 'slicemap', 'posmap'),
+                                 map_files):
+            if logger:
+                logger.info("Reading image: %s" % os.path.basename(map_file))
+            # maps are cached, so load them into memory, primary image only
+            geometry[key] = kcwi_fits_reader(map_file, extensions=(),
+                                             memmap=False)[0]
+        sky_geometry_cache[geom_file] = geometry
+    elif logger:
+        logger.info("Using cached maps for %s" % os.path.basename(geom_file))
+    return geometry
+
+
+def sky_geometry_selection(geometry, posbuf, dich=False, camera=0):
+    """Select the sky pixels allowed by the geometry alone
+
+    Args:
+        geometry (dict): maps from get_sky_geometry()
+        posbuf (int): pixels to avoid at the slice edges for fitting
+        dich (bool): avoid the dichroic bad region?
+        camera (int): 0 for Blue, 1 for Red
+
+    Returns:
+        tuple of flattened boolean arrays selecting the pixels used to fit
+        the sky and the pixels of the output sky image
+    """
+    key = (posbuf, dich, camera)
+    if key not in geometry['selections']:
+        slicemap = geometry['slicemap'].data.ravel()
+        posmap = geometry['posmap'].data.ravel()
+        wavemap = geometry['wavemap'].data.ravel()
+        waveall0 = geometry['wavemap'].header['WAVALL0']
+        waveall1 = geometry['wavemap'].header['WAVALL1']
+        posmax = np.nanmax(posmap)
+        # exposed regions on the CCD
+        exposed = (0 <= slicemap) & (slicemap <= 23) & \
+            (waveall0 <= wavemap) & (wavemap <= waveall1)
+        qfit = exposed & (posbuf < posmap) & (posmap < (posmax - posbuf))
+        # handle dichroic bad region
+        if dich:
+            if camera == 0:     # Blue
+                qfit &= ~((slicemap > 20) & (wavemap > 5600.))
+            else:               # Red
+                qfit &= ~((slicemap > 20) & (wavemap < 5600.))
+        qout = exposed & (posmap >= 0)
+        geometry['selections'][key] = (qfit, qout)
+    return geometry['selections'][key]
+
 
 class MakeMasterSky(BaseImg):
     """Make master sky image"""
@@ -62,7 +135,7 @@ class MakeMasterSky(BaseImg):
         if skyfile:
             msname = skyfile.split('.fits')[0] + '_' + suffix + '.fits'
             mskyf = os.path.join(rdir, msname)
-            if os.path.exists(mskyf):
+            if product_exists(mskyf):
                 self.logger.info("Master sky already exists: %s" % mskyf)
                 return False
             else:
@@ -91,31 +164,21 @@ class MakeMasterSky(BaseImg):
 
         groot = strip_fname(tab['filename'][0])
 
-        # Wavelength map image
+        # Wavelength, slice and position map images
         wmf = groot + '_wavemap.fits'
-        self.logger.info("Reading image: %s" % wmf)
-        wavemap = kcwi_fits_reader(os.path.join(
-            self.config.instrument.cwd, 'redux', wmf))[0]
-
-        # Slice map image
         slf = groot + '_slicemap.fits'
-        self.logger.info("Reading image: %s" % slf)
-        slicemap = kcwi_fits_reader(os.path.join(
-            self.config.instrument.cwd, 'redux', slf))[0]
-
-        # Position map image
         pof = groot + '_posmap.fits'
-        self.logger.info("Reading image: %s" % pof)
-        posmap = kcwi_fits_reader(os.path.join(
-            self.config.instrument.cwd, 'redux', pof))[0]
-        posmax = np.nanmax(posmap.data)
+        rdir = os.path.join(self.config.instrument.cwd, 'redux')
+        geometry = get_sky_geometry(
+            os.path.join(rdir, groot + '_geom.pkl'),
+            tuple(os.path.join(rdir, f) for f in (wmf, slf, pof)),
+            logger=self.logger)
+        wavemap = geometry['wavemap']
         posbuf = int(10. / self.action.args.xbinsize)
 
         # wavelength region
         wavegood0 = wavemap.header['WAVGOOD0']
         wavegood1 = wavemap.header['WAVGOOD1']
-        waveall0 = wavemap.header['WAVALL0']
-        waveall1 = wavemap.header['WAVALL1']
 
         # get image size
         sm_sz = self.action.args.ccddata.data.shape
@@ -142,40 +205,21 @@ class MakeMasterSky(BaseImg):
                                     % self.action.args.skymask)
 
         # count masked pixels
-        tmsk = len(np.nonzero(np.where(binary_mask.flat, True, False))[0])
+        tmsk = np.count_nonzero(binary_mask)
         self.logger.info("Number of pixels masked = %d" % tmsk)
 
-        finiteflux = np.isfinite(self.action.args.ccddata.data.flat)
+        finiteflux = np.isfinite(self.action.args.ccddata.data.ravel())
 
         # get un-masked points mapped to exposed regions on CCD
         # handle dichroic bad region
-        if self.action.args.dich:
-            if self.action.args.camera == 0:    # Blue
-                q = [i for i, v in enumerate(slicemap.data.flat)
-                     if 0 <= v <= 23 and
-                     posbuf < posmap.data.flat[i] < (posmax - posbuf) and
-                     waveall0 <= wavemap.data.flat[i] <= waveall1 and
-                     not (v > 20 and wavemap.data.flat[i] > 5600.) and
-                     finiteflux[i] and not binary_mask.flat[i]]
-            else:                               # Red
-                q = [i for i, v in enumerate(slicemap.data.flat)
-                     if 0 <= v <= 23 and
-                     posbuf < posmap.data.flat[i] < (posmax - posbuf) and
-                     waveall0 <= wavemap.data.flat[i] <= waveall1 and
-                     not (v > 20 and wavemap.data.flat[i] < 5600.) and
-                     finiteflux[i] and not binary_mask.flat[i]]
-        else:
-            q = [i for i, v in enumerate(slicemap.data.flat)
-                 if 0 <= v <= 23 and
-                 posbuf < posmap.data.flat[i] < (posmax - posbuf) and
-                 waveall0 <= wavemap.data.flat[i] <= waveall1 and
-                 finiteflux[i] and not binary_mask.flat[i]]
+        qfit, qout = sky_geometry_selection(geometry, posbuf,
+                                            dich=self.action.args.dich,
+                                            camera=self.action.args.camera)
+        q = np.flatnonzero(qfit & finiteflux &
+                           ~binary_mask.astype(bool).ravel())
 
         # get all points mapped to exposed regions on the CCD (for output)
-        qo = [i for i, v in enumerate(slicemap.data.flat)
-              if 0 <= v <= 23 and posmap.data.flat[i] >= 0 and
-              waveall0 <= wavemap.data.flat[i] <= waveall1 and
-              finiteflux[i]]
+        qo = np.flatnonzero(qout & finiteflux)
 
         # extract relevant image values
         fluxes = self.action.args.ccddata.data.flat[q]
@@ -226,7 +270,7 @@ class MakeMasterSky(BaseImg):
         self.logger.info(f"Divide by zero errors are normal in inverse variance calculation")
         sft0, gmask = Bspline.iterfit(waves, fluxes, fullbkpt=bkpt,
                                       upper=1, lower=1, maxiter=4)
-        gp = [i for i, v in enumerate(gmask) if v]
+        gp = np.flatnonzero(gmask)
         yfit1, _ = sft0.value(waves)
         self.logger.info("Number of good points = %d" % len(gp))
 
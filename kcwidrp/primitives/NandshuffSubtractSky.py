@@ -191,7 +191,8 @@ class NandshuffSubtractSky(BasePrimitive):
                          table=self.action.args.table,
                          output_file=self.action.args.name,
                          output_dir=self.config.instrument.output_directory,
-                         suffix="intk")
+                         suffix="intk",
+                         background=self.config.instrument.background_writes)
         self.context.proctab.update_proctab(frame=self.action.args.ccddata,
                                             suffix="intk",
                                             filename=self.action.args.name)
@@ -1,5 +1,7 @@
 from keckdrpframework.primitives.base_primitive import BasePrimitive
 from kcwidrp.core.bokeh_plotting import bokeh_plot
+from kcwidrp.core.kcwi_wavesol import cache_file, cache_key, read_cache, \
+    write_cache
 
 from bokeh.plotting import figure
 from bokeh.models import Range1d
@@ -31,16 +33,37 @@ class ReadAtlas(BasePrimitive):
             self.logger.info("Reading atlas spectrum in: %s" % atpath)
         else:
             self.logger.error("Atlas spectrum not found for %s" % atpath)
-        # Read the atlas
-        ff = pf.open(atpath)
-        reflux = ff[0].data
-        refdisp = ff[0].header['CDELT1']
-        refwav = np.arange(0, len(reflux)) * refdisp + ff[0].header['CRVAL1']
-        ff.close()
-        # Convolve with appropriate Gaussian
-        self.logger.info("Convolving Atlas with Gaussian having sigma of %.2f "
-                         "px" % self.action.args.atsig)
-        reflux = gaussian_filter1d(reflux, self.action.args.atsig)
+        # convolved atlas cached for this lamp and atsig?
+        atlas_file = None
+        if self.config.instrument.atlas_cache:
+            atlas_file = cache_file(
+                os.path.join(self.config.instrument.cwd,
+                             self.config.instrument.output_directory,
+                             os.path.expanduser(
+                                 self.config.instrument.wavesol_cache_dir)),
+                'atlas', cache_key(atpath, os.path.getmtime(atpath),
+                                   "%.3f" % self.action.args.atsig))
+        atlas = read_cache(atlas_file)
+        if atlas is not None:
+            self.logger.info("Using cached atlas spectrum: %s" % atlas_file)
+            reflux = atlas['reflux']
+            refdisp = atlas['refdisp']
+            refwav = atlas['refwav']
+        else:
+            # Read the atlas
+            ff = pf.open(atpath)
+            reflux = ff[0].data
+            refdisp = ff[0].header['CDELT1']
+            refwav = np.arange(0, len(reflux)) * refdisp + \
+                ff[0].header['CRVAL1']
+            ff.close()
+            # Convolve with appropriate Gaussian
+            self.logger.info("Convolving Atlas with Gaussian having sigma of "
+                             "%.2f px" % self.action.args.atsig)
+            reflux = gaussian_filter1d(reflux, self.action.args.atsig)
+            if atlas_file:
+                write_cache(atlas_file, {'reflux': reflux, 'refdisp': refdisp,
+                                         'refwav': refwav})
         # Observed arc spectrum
         obsarc = self.context.arcs[self.config.instrument.REFBAR]
         # Preliminary wavelength solution
@@ -61,8 +84,8 @@ class ReadAtlas(BasePrimitive):
             if self.action.args.camera == 0:  # Blue
                 # test if correction needed
                 if maxwav > 5600:
-                    maxwav = [w for w in obswav if w < 5620.][-1]
-                    maxow = [i for i, w in enumerate(obswav) if w < 5620.][-1]
+                    maxow = np.searchsorted(obswav, 5620., side='left') - 1
+                    maxwav = obswav[maxow]
                     minow = maxow - obs_extent
                     if minow < 0:
                         minow = 0
@@ -72,8 +95,8 @@ class ReadAtlas(BasePrimitive):
             elif self.action.args.camera == 1:  # Red
                 # test if correction needed
                 if minwav < 5600:
-                    minwav = [w for w in obswav if w > 5580.][0]
-                    minow = [i for i, w in enumerate(obswav) if w > 5580.][0]
+                    minow = np.searchsorted(obswav, 5580., side='right')
+                    minwav = obswav[minow]
                     maxow = minow + obs_extent
                     if maxow > (len(obsarc) - 1):
                         maxow = len(obsarc) - 1
@@ -83,8 +106,8 @@ class ReadAtlas(BasePrimitive):
             else:
                 self.logger.warning("Camera undefined!!")
         # Get corresponding ref range
-        minrw = [i for i, v in enumerate(refwav) if v >= minwav][0]
-        maxrw = [i for i, v in enumerate(refwav) if v <= maxwav][-1]
+        minrw = np.searchsorted(refwav, minwav, side='left')
+        maxrw = np.searchsorted(refwav, maxwav, side='right') - 1
         # Subsample for cross-correlation
         cc_obsarc = obsarc[minow:maxow]
         cc_obswav = obswav[minow:maxow]
@@ -86,7 +86,8 @@ class RectifyImage(BasePrimitive):
                          table=self.action.args.table,
                          output_file=self.action.args.name,
                          output_dir=self.config.instrument.output_directory,
-                         suffix="int")
+                         suffix="int",
+                         background=self.config.instrument.background_writes)
         self.context.proctab.update_proctab(frame=self.action.args.ccddata,
                                             suffix="int", 
                                             filename=self.action.args.name)
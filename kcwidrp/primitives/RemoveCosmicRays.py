@@ -119,7 +119,8 @@ class RemoveCosmicRays(BasePrimitive):
                              table=self.action.args.table,
                              output_file=self.action.args.name,
                              output_dir=self.config.instrument.output_directory,
-                             suffix="crr")
+                             suffix="crr",
+                             background=self.config.instrument.background_writes)
 
         return self.action.args
     # END: class RemoveCosmicRays()
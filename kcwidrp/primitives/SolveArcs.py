@@ -2,19 +2,220 @@ from keckdrpframework.primitives.base_primitive import BasePrimitive
 from kcwidrp.core.bokeh_plotting import bokeh_plot
 from kcwidrp.core.kcwi_plotting import get_plot_lims, oplot_slices, \
     set_plot_lims, save_plot
-from kcwidrp.primitives.GetAtlasLines import get_line_window, gaus
+from kcwidrp.primitives.GetAtlasLines import get_line_window, \
+    fit_gaussians, line_peak
 
 import numpy as np
 from scipy.signal.windows import boxcar
 import scipy as sp
-from scipy.optimize import curve_fit
-from scipy.interpolate import interpolate
 from scipy.stats import sigmaclip
 from bokeh.plotting import figure
 from bokeh.models import Range1d, LinearAxis
+from multiprocessing import get_context
+from types import SimpleNamespace
 import time
 
 
+def bar_solve_helper(argument):
+    """Find the atlas lines in one bar and fit its wavelength solution
+
+    Runs in a worker process, so the log messages are returned with the
+    results for the pipeline logger.
+    """
+    ib = argument['ib']
+    b = argument['bar']
+    xsvals = argument['xsvals']
+    at_wave = argument['at_wave']
+    at_flux = argument['at_flux']
+    poly_order = argument['poly_order']
+    verbose = argument['verbose']
+    log = []
+    logger = SimpleNamespace(info=log.append)
+    # get bar wavelengths
+    bw = np.polyval(argument['coeff'], xsvals)
+    # smooth spectrum according to slicer
+    if 'Small' in argument['ifuname']:
+        # no smoothing for Small slicer
+        bspec = b
+    else:
+        if 'Large' in argument['ifuname']:
+            # max smoothing for Large slicer
+            win = boxcar(5)
+        else:
+            # intermediate smoothing for Medium slicer
+            win = boxcar(3)
+        # do the smoothing
+        bspec = sp.signal.convolve(b, win, mode='same') / sum(win)
+    rejected = np.zeros(len(at_wave), dtype=bool)
+    arc_pix = {}        # arc line pixel positions
+    arc_int = {}        # arc line pixel intensities
+    gaus_sig = []
+    lines = []
+
+    def reject(iw, message):
+        rejected[iw] = True
+        if verbose:
+            log.append(message)
+
+    # get arc line initial pixel positions (bar wavelengths increase)
+    line_xs = np.searchsorted(bw, at_wave, side='left')
+    # get window for each arc line
+    windows = []
+    for iw, aw in enumerate(at_wave):
+        try:
+            if line_xs[iw] >= len(bw):
+                raise IndexError
+            minow, maxow, count = get_line_window(
+                bspec, line_xs[iw], thresh=argument['hgt'],
+                logger=(logger if verbose else None))
+        except IndexError:
+            reject(iw, "Atlas line not in observation: %.2f" % aw)
+            continue
+        except ValueError:
+            reject(iw, "Interpolation error for line at %.2f" % aw)
+            continue
+        # do we have enough points to fit?
+        if count < 5 or not minow or not maxow:
+            reject(iw, "Arc window rejected for line %.3f" % aw)
+            continue
+        # check if window no longer contains initial value
+        if minow > line_xs[iw] > maxow:
+            reject(iw, "Arc window wandered off for line %.3f" % aw)
+            continue
+        windows.append((iw, minow, maxow))
+    # Gaussian fits to all line windows at once
+    xvecs = [xsvals[minow:maxow + 1] for _, minow, maxow in windows]
+    yvecs = [bspec[minow:maxow + 1] for _, minow, maxow in windows]
+    fits, fit_ok = fit_gaussians(
+        xvecs, yvecs, [[max(yvec), np.nanmean(xvec), 1.0]
+                       for xvec, yvec in zip(xvecs, yvecs)])
+    for (iw, minow, maxow), xvec, yvec, fit, ok in zip(windows, xvecs, yvecs,
+                                                       fits, fit_ok):
+        aw = at_wave[iw]
+        if not ok:
+            reject(iw, "Arc Gaussian fit rejected for line %.3f" % aw)
+            continue
+        gaus_sig.append(fit[2])
+        # re-sample line with dense sampling
+        try:
+            xplot, plt_line = line_peak(xvec, yvec)
+        except ValueError:
+            reject(iw, "Interpolation error for line at %.2f" % aw)
+            continue
+        # get peak position
+        max_index = plt_line.argmax()
+        peak = xplot[max_index]
+        # calculate centroid
+        cent = np.sum(xvec * yvec) / np.sum(yvec)
+        # how different is the centroid from the peak?
+        if abs(cent - peak) > 0.7:
+            reject(iw, "Arc peak - cent offset = %.2f rejected for line %.3f"
+                   % (abs(cent - peak), aw))
+            continue
+        if plt_line[max_index] < 100:
+            reject(iw, "Arc peak too low = %.2f rejected for line %.3f" %
+                   (plt_line[max_index], aw))
+            continue
+        # store surviving line data
+        arc_pix[iw] = peak
+        arc_int[iw] = plt_line[max_index]
+        if argument['keep_lines']:
+            lines.append({'iw': iw, 'aw': aw, 'xvec': xvec, 'yvec': yvec,
+                          'wvec': bw[minow:maxow + 1], 'cent': cent,
+                          'gpeak': fit[1], 'peak': peak})
+    # store values to fit, in atlas line order
+    kept = sorted(arc_pix)
+    at_wave_dat = [at_wave[iw] for iw in kept]      # atlas line wavelengths
+    at_flux_dat = [at_flux[iw] for iw in kept]      # atlas line peak fluxes
+    arc_pix_dat = [arc_pix[iw] for iw in kept]      # arc line pixel positions
+    arc_int_dat = [arc_int[iw] for iw in kept]      # arc line intensities
+    rej_wave = list(np.asarray(at_wave)[rejected])  # rejected line waves
+    rej_flux = list(np.asarray(at_flux)[rejected])  # rejected line fluxes
+    nrej = int(rejected.sum())
+    log.append("")
+    log.append("Fitting wavelength solution starting with %d lines after "
+               "rejecting %d lines" % (len(arc_pix_dat), nrej))
+    # Fit wavelengths
+    log.append("Fitting with polynomial order %d" % poly_order)
+    # Initial fit
+    wfit = np.polyfit(arc_pix_dat, at_wave_dat, poly_order)
+    pwfit = np.poly1d(wfit)
+    arc_wave_fit = pwfit(arc_pix_dat)
+    # fit residuals
+    resid = arc_wave_fit - at_wave_dat
+    resid_c, low, upp = sigmaclip(resid, low=3., high=3.)
+    wsig = resid_c.std()
+    # maximum outlier
+    max_resid = np.max(abs(resid))
+    log.append("wsig: %.3f, max_resid: %.3f" % (wsig, max_resid))
+    # keep track of rejected lines
+    rej_rsd = []        # rejected line residuals
+    rej_rsd_wave = []   # rejected line wavelengths
+    rej_rsd_flux = []   # rejected line fluxes
+    # iteratively remove outliers
+    it = 0
+    while max_resid > 2.5 * wsig and it < 25:
+        arc_dat = []    # arc line pixel values
+        arc_fdat = []   # arc line flux data
+        at_dat = []     # atlas line wavelength values
+        at_fdat = []    # atlas line flux data
+        # trim largest outlier
+        for il, rsd in enumerate(resid):
+            if abs(rsd) < max_resid:
+                # append data for line that passed cut
+                arc_dat.append(arc_pix_dat[il])
+                arc_fdat.append(arc_int_dat[il])
+                at_dat.append(at_wave_dat[il])
+                at_fdat.append(at_flux_dat[il])
+            else:
+                if verbose:
+                    log.append("It%d REJ: %d, %.2f, %.3f, %.3f" %
+                               (it, il, arc_pix_dat[il], at_wave_dat[il],
+                                rsd))
+                # keep track of rejected lines
+                rej_rsd_wave.append(at_wave_dat[il])
+                rej_rsd_flux.append(at_flux_dat[il])
+                rej_rsd.append(rsd)
+        # copy cleaned data back into input arrays
+        arc_pix_dat = arc_dat.copy()
+        arc_int_dat = arc_fdat.copy()
+        at_wave_dat = at_dat.copy()
+        at_flux_dat = at_fdat.copy()
+        # refit cleaned data
+        wfit = np.polyfit(arc_pix_dat, at_wave_dat, poly_order)
+        # new wavelength function
+        pwfit = np.poly1d(wfit)
+        # new wavelengths for arc lines
+        arc_wave_fit = pwfit(arc_pix_dat)
+        # calculate residuals of arc lines
+        resid = arc_wave_fit - at_wave_dat
+        # get statistics
+        resid_c, low, upp = sigmaclip(resid, low=3., high=3.)
+        wsig = resid_c.std()
+        # maximum outlier
+        max_resid = np.max(abs(resid))
+        it += 1
+    # END while max_resid > 3.5 * wsig and it < 5:
+    # log arc bar results
+    log.append("")
+    log.append("BAR %03d, Slice = %02d, RMS = %.3f, N = %d" %
+               (ib, int(ib / 5), wsig, len(arc_pix_dat)))
+    log.append("Nits: %d, wsig: %.3f, max_resid: %.3f" %
+               (it, wsig, max_resid))
+    log.append("NRejRsd: %d, NRejFit: %d" % (len(rej_rsd_wave),
+                                             len(rej_wave)))
+    log.append("Line width median sigma: %.2f px" % np.nanmedian(gaus_sig))
+    log.append("Coefs: " + ' '.join(['%.6g' % (c,) for c in reversed(wfit)]))
+
+    return {'ib': ib, 'wfit': wfit, 'wsig': wsig, 'resid': resid,
+            'at_wave_dat': at_wave_dat, 'arc_pix_dat': arc_pix_dat,
+            'arc_int_dat': arc_int_dat, 'arc_wave_fit': arc_wave_fit,
+            'rej_wave': rej_wave, 'rej_flux': rej_flux, 'rej_rsd': rej_rsd,
+            'rej_rsd_wave': rej_rsd_wave, 'rej_rsd_flux': rej_rsd_flux,
+            'lines': lines, 'log': log}
+    # END: def bar_solve_helper()
+
+
 class SolveArcs(BasePrimitive):
     """Solve the bar arc wavelengths"""
 
@@ -54,283 +255,115 @@ class SolveArcs(BasePrimitive):
         # get x values starting at zero pixels
         self.action.args.xsvals = np.arange(0, len(
             self.context.arcs[self.config.instrument.REFBAR]))
-        # loop over arcs and generate a wavelength solution for each
-        next_bar_to_plot = 0
-        poly_order = 4
+        # Get poly order
+        if self.action.args.dichroic_fraction <= 0.6:
+            poly_order = 2
+        elif 0.6 < self.action.args.dichroic_fraction < 0.75:
+            poly_order = 3
+        else:
+            poly_order = 4
+        # loop over arcs and assemble input arguments
+        my_arguments = []
         for ib, b in enumerate(self.context.arcs):
-            # Starting with pascal shifted coeffs from fit_center()
-            coeff = self.action.args.twkcoeff[ib]
-            # get bar wavelengths
-            bw = np.polyval(coeff, self.action.args.xsvals)
-            # smooth spectrum according to slicer
-            if 'Small' in self.action.args.ifuname:
-                # no smoothing for Small slicer
-                bspec = b
-            else:
-                if 'Large' in self.action.args.ifuname:
-                    # max smoothing for Large slicer
-                    win = boxcar(5)
-                else:
-                    # intermediate smoothing for Medium slicer
-                    win = boxcar(3)
-                # do the smoothing
-                bspec = sp.signal.convolve(b, win, mode='same') / sum(win)
-            # store values to fit
-            at_wave_dat = []    # atlas line wavelengths
-            at_flux_dat = []    # atlas line peak fluxes
-            arc_pix_dat = []    # arc line pixel positions
-            arc_int_dat = []    # arc line pixel intensities
-            rej_wave = []       # rejected line wavelengths
-            rej_flux = []       # rejected line fluxes
-            gaus_sig = []
-            nrej = 0
-            # loop over lines
-            for iw, aw in enumerate(self.action.args.at_wave):
-                # get window for this line
-                try:
-                    # get arc line initial pixel position
-                    line_x = [i for i, v in enumerate(bw) if v >= aw][0]
-                    # get window for arc line
-                    minow, maxow, count = get_line_window(
-                        bspec, line_x, thresh=hgt,
-                        logger=(self.logger if verbose else None))
-                    # do we have enough points to fit?
-                    if count < 5 or not minow or not maxow:
-                        rej_wave.append(aw)
-                        rej_flux.append(self.action.args.at_flux[iw])
-                        nrej += 1
-                        if verbose:
-                            self.logger.info("Arc window rejected for line %.3f"
-                                             % aw)
-                        continue
-                    # check if window no longer contains initial value
-                    if minow > line_x > maxow:
-                        rej_wave.append(aw)
-                        rej_flux.append(self.action.args.at_flux[iw])
-                        nrej += 1
-                        if verbose:
-                            self.logger.info(
-                                "Arc window wandered off for line %.3f" % aw)
-                        continue
-                    # get data to fit
-                    yvec = bspec[minow:maxow + 1]
-                    xvec = self.action.args.xsvals[minow:maxow + 1]
-                    wvec = bw[minow:maxow + 1]
-                    f0 = max(yvec)
-                    par_start = [f0, np.nanmean(xvec), 1.0]
-                    par_bounds = ([f0*0.9, np.min(xvec), 0.5],
-                                  [f0*1.1, np.max(xvec), 2.5])
-                    # Gaussian fit
-                    try:
-                        fit, _ = curve_fit(gaus, xvec, yvec, p0=par_start)
-                        #  bounds=par_bounds, method='trf')
-                        sp_pk_x = fit[1]
-                        gaus_sig.append(fit[2])
-                    except (RuntimeError, ValueError):
-                        rej_wave.append(aw)
-                        rej_flux.append(self.action.args.at_flux[iw])
-                        nrej += 1
-                        if verbose:
-                            self.logger.info(
-                                "Arc Gaussian fit rejected for line %.3f" % aw)
-                        # sp_pk_x = line_x
-                        continue
+            arguments = {
+                'ib': ib,
+                'bar': b,
+                # Starting with pascal shifted coeffs from fit_center()
+                'coeff': self.action.args.twkcoeff[ib],
+                'xsvals': self.action.args.xsvals,
+                'ifuname': self.action.args.ifuname,
+                'at_wave': at_wave,
+                'at_flux': at_flux,
+                'hgt': hgt,
+                'poly_order': poly_order,
+                'verbose': verbose,
+                'keep_lines': do_inter
+            }
+            my_arguments.append(arguments)
 
-                    # get interpolation of arc line
-                    int_line = interpolate.interp1d(xvec, yvec, kind='cubic',
-                                                    bounds_error=False,
-                                                    fill_value='extrapolate')
-                    # use very dense sampling
-                    xplot = np.linspace(min(xvec), max(xvec), num=1000)
-                    # re-sample line with dense sampling
-                    plt_line = int_line(xplot)
-                    # get peak position
-                    max_index = plt_line.argmax()
-                    peak = xplot[max_index]
-                    # calculate centroid
-                    cent = np.sum(xvec * yvec) / np.sum(yvec)
-                    # how different is the centroid from the peak?
-                    if abs(cent - peak) > 0.7:
-                        # keep track of rejected line
-                        rej_wave.append(aw)
-                        rej_flux.append(self.action.args.at_flux[iw])
-                        nrej += 1
-                        if verbose:
-                            self.logger.info("Arc peak - cent offset = %.2f "
-                                             "rejected for line %.3f" %
-                                             (abs(cent - peak), aw))
-                        continue
-                    if plt_line[max_index] < 100:
-                        # keep track of rejected line
-                        rej_wave.append(aw)
-                        rej_flux.append(self.action.args.at_flux[iw])
-                        nrej += 1
-                        if verbose:
-                            self.logger.info("Arc peak too low = %.2f "
-                                             "rejected for line %.3f" %
-                                             (plt_line[max_index], aw))
-                        continue
-                    # store surviving line data
-                    arc_pix_dat.append(peak)
-                    arc_int_dat.append(plt_line[max_index])
-                    at_wave_dat.append(aw)
-                    at_flux_dat.append(self.action.args.at_flux[iw])
-                    # plot, if requested
-                    if do_inter and ib == next_bar_to_plot:
-                        ptitle = " Bar# %d - line %3d/%3d: xc = %.1f, " \
-                                 "Wave = %9.2f" % \
-                                 (ib, (iw + 1), len(self.action.args.at_wave),
-                                  peak, aw)
-                        atx0 = [i for i, v in enumerate(atwave)
-                                if v >= min(wvec)][0]
-                        atx1 = [i for i, v in enumerate(atwave)
-                                if v >= max(wvec)][0]
-                        atnorm = np.nanmax(yvec) / np.nanmax(atspec[atx0:atx1])
-                        p = figure(
-                            title=self.action.args.plotlabel +
-                            "ATLAS/ARC LINE FITS" + ptitle,
-                            x_axis_label="Wavelength (A)",
-                            y_axis_label="Relative Flux",
-                            plot_width=self.config.instrument.plot_width,
-                            plot_height=self.config.instrument.plot_height)
-                        ylim = [0, np.nanmax(yvec)]
-                        p.line(atwave[atx0:atx1], atspec[atx0:atx1] * atnorm,
-                               color='blue', legend_label='Atlas')
-                        p.circle(atwave[atx0:atx1], atspec[atx0:atx1] * atnorm,
-                                 color='green', legend_label='Atlas')
-                        p.line([aw, aw], ylim, color='red',
-                               legend_label='AtCntr')
-                        p.x_range = Range1d(start=min(wvec), end=max(wvec))
-                        p.extra_x_ranges = {"pix": Range1d(start=min(xvec),
-                                                           end=max(xvec))}
-                        p.add_layout(LinearAxis(x_range_name="pix",
-                                                axis_label="CCD Y pix"),
-                                     'above')
-                        p.line(xplot, plt_line, color='black',
-                               legend_label='Arc', x_range_name="pix")
-                        p.circle(xvec, yvec, legend_label='Arc', color='red',
-                                 x_range_name="pix")
-                        ylim = [0, np.nanmax(plt_line)]
-                        p.line([cent, cent], ylim, color='green',
-                               legend_label='Cntr', line_dash='dashed',
-                               x_range_name="pix")
-                        p.line([sp_pk_x, sp_pk_x], ylim, color='magenta',
-                               legend_label='Gpeak', line_dash='dashdot',
-                               x_range_name="pix")
-                        p.line([peak, peak], ylim, color='black',
-                               legend_label='Peak', line_dash='dashdot',
-                               x_range_name="pix")
-                        p.y_range.start = 0
-                        bokeh_plot(p, self.context.bokeh_session)
+        # generate a wavelength solution for each bar
+        p = get_context("spawn").Pool()
+        results = p.map(bar_solve_helper, my_arguments)
+        p.close()
 
-                        q = input(ptitle + " - Next? <cr>, q to quit: ")
-                        if 'Q' in q.upper():
-                            do_inter = False
-                except IndexError:
-                    if verbose:
-                        self.logger.info(
-                            "Atlas line not in observation: %.2f" % aw)
-                    rej_wave.append(aw)
-                    rej_flux.append(self.action.args.at_flux[iw])
-                    nrej += 1
-                    continue
-                except ValueError:
-                    if verbose:
-                        self.logger.info(
-                            "Interpolation error for line at %.2f" % aw)
-                    rej_wave.append(aw)
-                    rej_flux.append(self.action.args.at_flux[iw])
-                    nrej += 1
-            self.logger.info("")
-            self.logger.info("Fitting wavelength solution starting with %d "
-                             "lines after rejecting %d lines" %
-                             (len(arc_pix_dat), nrej))
-            # Fit wavelengths
-            # Get poly order
-            if self.action.args.dichroic_fraction <= 0.6:
-                poly_order = 2
-            elif 0.6 < self.action.args.dichroic_fraction < 0.75:
-                poly_order = 3
-            else:
-                poly_order = 4
-            self.logger.info("Fitting with polynomial order %d" % poly_order)
-            # Initial fit
-            wfit = np.polyfit(arc_pix_dat, at_wave_dat, poly_order)
-            pwfit = np.poly1d(wfit)
-            arc_wave_fit = pwfit(arc_pix_dat)
-            # fit residuals
-            resid = arc_wave_fit - at_wave_dat
-            resid_c, low, upp = sigmaclip(resid, low=3., high=3.)
-            wsig = resid_c.std()
-            # maximum outlier
-            max_resid = np.max(abs(resid))
-            self.logger.info("wsig: %.3f, max_resid: %.3f" % (wsig, max_resid))
-            # keep track of rejected lines
-            rej_rsd = []        # rejected line residuals
-            rej_rsd_wave = []   # rejected line wavelengths
-            rej_rsd_flux = []   # rejected line fluxes
-            # iteratively remove outliers
-            it = 0
-            while max_resid > 2.5 * wsig and it < 25:
-                arc_dat = []    # arc line pixel values
-                arc_fdat = []   # arc line flux data
-                at_dat = []     # atlas line wavelength values
-                at_fdat = []    # atlas line flux data
-                # trim largest outlier
-                for il, rsd in enumerate(resid):
-                    if abs(rsd) < max_resid:
-                        # append data for line that passed cut
-                        arc_dat.append(arc_pix_dat[il])
-                        arc_fdat.append(arc_int_dat[il])
-                        at_dat.append(at_wave_dat[il])
-                        at_fdat.append(at_flux_dat[il])
-                    else:
-                        if verbose:
-                            self.logger.info("It%d REJ: %d, %.2f, %.3f, %.3f" %
-                                             (it, il, arc_pix_dat[il],
-                                              at_wave_dat[il], rsd))
-                        # keep track of rejected lines
-                        rej_rsd_wave.append(at_wave_dat[il])
-                        rej_rsd_flux.append(at_flux_dat[il])
-                        rej_rsd.append(rsd)
-                # copy cleaned data back into input arrays
-                arc_pix_dat = arc_dat.copy()
-                arc_int_dat = arc_fdat.copy()
-                at_wave_dat = at_dat.copy()
-                at_flux_dat = at_fdat.copy()
-                # refit cleaned data
-                wfit = np.polyfit(arc_pix_dat, at_wave_dat, poly_order)
-                # new wavelength function
-                pwfit = np.poly1d(wfit)
-                # new wavelengths for arc lines
-                arc_wave_fit = pwfit(arc_pix_dat)
-                # calculate residuals of arc lines
-                resid = arc_wave_fit - at_wave_dat
-                # get statistics
-                resid_c, low, upp = sigmaclip(resid, low=3., high=3.)
-                wsig = resid_c.std()
-                # maximum outlier
-                max_resid = np.max(abs(resid))
-                # wsig = np.nanstd(resid)
-                it += 1
-            # END while max_resid > 3.5 * wsig and it < 5:
-            # log arc bar results
-            self.logger.info("")
-            self.logger.info("BAR %03d, Slice = %02d, RMS = %.3f, N = %d" %
-                             (ib, int(ib / 5), wsig, len(arc_pix_dat)))
-            self.logger.info(
-                "Nits: %d, wsig: %.3f, max_resid: %.3f" % (it, wsig, max_resid))
-            self.logger.info("NRejRsd: %d, NRejFit: %d" % (len(rej_rsd_wave),
-                                                           len(rej_wave)))
-            self.logger.info("Line width median sigma: %.2f px" %
-                             np.nanmedian(gaus_sig))
-            self.logger.info("Coefs: " + ' '.join(['%.6g' % (c,)
-                                                   for c in reversed(wfit)]))
+        # collect results and replay the bar plots
+        next_bar_to_plot = 0
+        for result in results:
+            ib = result['ib']
+            b = self.context.arcs[ib]
+            for message in result['log']:
+                self.logger.info(message)
+            wfit = result['wfit']
+            wsig = result['wsig']
+            at_wave_dat = result['at_wave_dat']
+            arc_pix_dat = result['arc_pix_dat']
+            resid = result['resid']
+            rej_rsd = result['rej_rsd']
+            rej_rsd_wave = result['rej_rsd_wave']
             # store final fit coefficients
             self.action.args.fincoeff.append(wfit)
             # store statistics
             bar_sig.append(wsig)
             bar_nls.append(len(arc_pix_dat))
+            # plot line fits, if requested
+            if do_inter and ib == next_bar_to_plot:
+                for line in result['lines']:
+                    aw = line['aw']
+                    xvec = line['xvec']
+                    yvec = line['yvec']
+                    wvec = line['wvec']
+                    cent = line['cent']
+                    peak = line['peak']
+                    xplot, plt_line = line_peak(xvec, yvec)
+                    ptitle = " Bar# %d - line %3d/%3d: xc = %.1f, " \
+                             "Wave = %9.2f" % \
+                             (ib, (line['iw'] + 1), len(at_wave), peak, aw)
+                    atx0 = [i for i, v in enumerate(atwave)
+                            if v >= min(wvec)][0]
+                    atx1 = [i for i, v in enumerate(atwave)
+                            if v >= max(wvec)][0]
+                    atnorm = np.nanmax(yvec) / np.nanmax(atspec[atx0:atx1])
+                    p = figure(
+                        title=self.action.args.plotlabel +
+                        "ATLAS/ARC LINE FITS" + ptitle,
+                        x_axis_label="Wavelength (A)",
+                        y_axis_label="Relative Flux",
+                        plot_width=self.config.instrument.plot_width,
+                        plot_height=self.config.instrument.plot_height)
+                    ylim = [0, np.nanmax(yvec)]
+                    p.line(atwave[atx0:atx1], atspec[atx0:atx1] * atnorm,
+                           color='blue', legend_label='Atlas')
+                    p.circle(atwave[atx0:atx1], atspec[atx0:atx1] * atnorm,
+                             color='green', legend_label='Atlas')
+                    p.line([aw, aw], ylim, color='red',
+                           legend_label='AtCntr')
+                    p.x_range = Range1d(start=min(wvec), end=max(wvec))
+                    p.extra_x_ranges = {"pix": Range1d(start=min(xvec),
+                                                       end=max(xvec))}
+                    p.add_layout(LinearAxis(x_range_name="pix",
+                                            axis_label="CCD Y pix"),
+                                 'above')
+                    p.line(xplot, plt_line, color='black',
+                           legend_label='Arc', x_range_name="pix")
+                    p.circle(xvec, yvec, legend_label='Arc', color='red',
+                             x_range_name="pix")
+                    ylim = [0, np.nanmax(plt_line)]
+                    p.line([cent, cent], ylim, color='green',
+                           legend_label='Cntr', line_dash='dashed',
+                           x_range_name="pix")
+                    p.line([line['gpeak'], line['gpeak']], ylim,
+                           color='magenta', legend_label='Gpeak',
+                           line_dash='dashdot', x_range_name="pix")
+                    p.line([peak, peak], ylim, color='black',
+                           legend_label='Peak', line_dash='dashdot',
+                           x_range_name="pix")
+                    p.y_range.start = 0
+                    bokeh_plot(p, self.context.bokeh_session)
+
+                    q = input(ptitle + " - Next? <cr>, q to quit: ")
+                    if 'Q' in q.upper():
+                        do_inter = False
+                        break
             # do plotting?
             if master_inter and ib == next_bar_to_plot:
                 # plot bar fit residuals
@@ -365,9 +398,10 @@ class SolveArcs(BasePrimitive):
                            y_axis_label="Flux",
                            plot_width=self.config.instrument.plot_width,
                            plot_height=self.config.instrument.plot_height)
-                bwav = pwfit(self.action.args.xsvals)
+                bwav = np.polyval(wfit, self.action.args.xsvals)
                 p.line(bwav, b, color='darkgrey', legend_label='Arc')
-                p.diamond(arc_wave_fit, arc_int_dat, color='darkgrey', size=8)
+                p.diamond(result['arc_wave_fit'], result['arc_int_dat'],
+                          color='darkgrey', size=8)
                 ylim = [np.nanmin(b), np.nanmax(b)]
                 atnorm = np.nanmax(b) / np.nanmax(atspec)
                 p.line(atwave, atspec * atnorm, color='blue',
@@ -378,9 +412,11 @@ class SolveArcs(BasePrimitive):
                 p.diamond(at_wave, at_flux * atnorm, legend_label='Kept',
                           color='green', size=8)
                 if rej_rsd_wave:
-                    p.diamond(rej_rsd_wave, [rj*atnorm for rj in rej_rsd_flux],
+                    p.diamond(rej_rsd_wave,
+                              [rj*atnorm for rj in result['rej_rsd_flux']],
                               color='orange', legend_label='RejRsd', size=6)
-                p.diamond(rej_wave, [rj*atnorm for rj in rej_flux],
+                p.diamond(result['rej_wave'],
+                          [rj*atnorm for rj in result['rej_flux']],
                           color='red', legend_label='RejFit', size=6)
                 bokeh_plot(p, self.context.bokeh_session)
                 q = input("Next? <int> or <cr>, q - quit: ")
@@ -1,10 +1,8 @@
 from keckdrpframework.primitives.base_img import BaseImg
-from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_reader, \
-    kcwi_fits_writer, strip_fname
+from kcwidrp.primitives.kcwi_file_primitives import \
+    kcwi_fits_writer, kcwi_stack_frames, strip_fname
 
 import os
-import ccdproc
-import numpy as np
 
 
 class StackFlats(BaseImg):
@@ -59,33 +57,25 @@ class StackFlats(BaseImg):
         combine_list = list(self.combine_list['filename'])
         # get flat stack output name
         stname = strip_fname(combine_list[0]) + '_' + suffix + '.fits'
-        stack = []
         stackf = []
-        mask = None
         for flat in combine_list:
             # get flat intensity (int) image file name in redux directory
             stackf.append(strip_fname(flat) + '_intd.fits')
-            flatfn = os.path.join(self.config.instrument.cwd,
-                                  self.config.instrument.output_directory,
-                                stackf[-1])
-            # using [0] gets just the image data
-            f = kcwi_fits_reader(flatfn)[0]
-            # Set mask to None to prevent ccdproc.combine from masking
-            f.mask = None
-            stack.append(f)
+        flatfns = [os.path.join(self.config.instrument.cwd,
+                                self.config.instrument.output_directory, f)
+                   for f in stackf]
 
-        stacked = ccdproc.combine(stack, method=method, sigma_clip=True,
-                                  sigma_clip_low_thresh=None,
-                                  sigma_clip_high_thresh=2.0)
+        # the clipping of ccdproc.combine with sigma_clip_low_thresh=None,
+        # which falls back to 3 sigma, and sigma_clip_high_thresh=2.0;
+        # the input masks are not used
+        stacked, _, last_mask = kcwi_stack_frames(
+            flatfns, method=method, low_thresh=3., high_thresh=2.,
+            chunk_rows=self.config.instrument.stack_chunk_rows,
+            nthreads=self.config.instrument.stack_nthreads)
 
-        # Get the BPM out of one of the flats (bpm is the same for all)
-        # and add it to the stacked flat as the stack's mask
-        last_flat_name = strip_fname(combine_list[-1]) + '_intd.fits'
-        last_flat_path = os.path.join(self.config.instrument.cwd,
-                                  self.config.instrument.output_directory,
-                                last_flat_name)
-        last_flat = kcwi_fits_reader(last_flat_path)[0]
-        stacked.mask = last_flat.mask
+        # Use the BPM of the last flat (bpm is the same for all)
+        # as the stack's mask
+        stacked.mask = last_mask
         
         stacked.header['IMTYPE'] = self.action.args.stack_type
         stacked.header['NSTACK'] = (len(combine_list),
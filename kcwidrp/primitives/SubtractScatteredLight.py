@@ -103,7 +103,8 @@ class SubtractScatteredLight(BasePrimitive):
                          table=self.action.args.table,
                          output_file=self.action.args.name,
                          output_dir=self.config.instrument.output_directory,
-                         suffix="intd")
+                         suffix="intd",
+                         background=self.config.instrument.background_writes)
         self.context.proctab.update_proctab(frame=self.action.args.ccddata,
                                             suffix="intd", 
                                             filename=self.action.args.name)
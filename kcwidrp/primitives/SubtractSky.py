@@ -1,6 +1,6 @@
 from keckdrpframework.primitives.base_primitive import BasePrimitive
 from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_reader, \
-    kcwi_fits_writer, get_master_name, strip_fname
+    kcwi_fits_writer, get_master_name, strip_fname, product_exists
 import os
 
 
@@ -75,7 +75,7 @@ class SubtractSky(BasePrimitive):
                 skyfile = tab['filename'][0]
 
         msname = strip_fname(skyfile) + '_' + target_type.lower() + ".fits"
-        if os.path.exists(os.path.join(self.config.instrument.cwd,
+        if product_exists(os.path.join(self.config.instrument.cwd,
                                        'redux', msname)):
             self.logger.info("Reading image: %s" % msname)
             msky = kcwi_fits_reader(
@@ -121,7 +121,8 @@ class SubtractSky(BasePrimitive):
                          table=self.action.args.table,
                          output_file=self.action.args.name,
                          output_dir=self.config.instrument.output_directory,
-                         suffix="intk")
+                         suffix="intk",
+                         background=self.config.instrument.background_writes)
         self.context.proctab.update_proctab(frame=self.action.args.ccddata,
                                             suffix="intk",
                                             filename=self.action.args.name)
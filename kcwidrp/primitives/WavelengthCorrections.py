@@ -8,7 +8,48 @@ from astropy.coordinates import SkyCoord, EarthLocation
 from keckdrpframework.primitives.base_primitive import BasePrimitive
 from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_writer, \
                                                     kcwi_fits_reader, \
-                                                    strip_fname
+                                                    strip_fname, product_exists
+
+
+def resample_cube(cube, wave_in, wave_out, kind='cubic', mask=False):
+    """Resample a cube from one wavelength grid to another
+
+    All spaxels share the same wavelength grids, so the interpolation is
+    set up once and applied to the whole (nwave, nspaxel) matrix.
+
+    Args:
+        cube (numpy.ndarray): (nwave, ny, nx) cube sampled on wave_in
+        wave_in (numpy.ndarray): input wavelengths
+        wave_out (numpy.ndarray): output wavelengths
+        kind (str): interpolation kind for scipy.interpolate.interp1d
+        mask (bool): set if the cube is a mask cube, in which case each
+            output pixel takes the larger of the previous and next input
+            pixels, and 128 off the ends of the input grid
+
+    Returns:
+        numpy.ndarray: resampled cube with the same shape and type as cube
+    """
+    wave_in = np.asarray(wave_in, dtype=np.float64)
+    wave_out = np.asarray(wave_out, dtype=np.float64)
+    spec = cube.reshape(cube.shape[0], -1)
+    if not mask:
+        f_interp = interp1d(wave_in, spec, kind=kind, axis=0,
+                            fill_value='extrapolate')
+        spec_new = f_interp(wave_out)
+    else:
+        # previous and next input pixel for each output wavelength
+        pix = np.arange(len(wave_in))
+        spec_new = None
+        for kind_mask in ('previous', 'next'):
+            ipix = interp1d(wave_in, pix, kind=kind_mask, bounds_error=False,
+                            fill_value=-1)(wave_out).astype(int)
+            spec_mask = np.where((ipix >= 0)[:, np.newaxis],
+                                 spec[ipix, :], 128)
+            if spec_new is None:
+                spec_new = spec_mask
+            else:
+                spec_new = np.maximum(spec_new, spec_mask)
+    return spec_new.reshape(cube.shape).astype(cube.dtype, copy=False)
 
 
 class WavelengthCorrections(BasePrimitive):
@@ -86,43 +127,9 @@ class WavelengthCorrections(BasePrimitive):
         wave_vac = self.a2v_conversion(wave_air)
 
         # resample to uniform grid
-        cube_new = np.zeros_like(cube)
-        for i in range(cube.shape[2]):
-            for j in range(cube.shape[1]):
-
-                spec0 = cube[:, j, i]
-                if not mask:
-                    f_cubic = interp1d(
-                        wave_vac,
-                        spec0,
-                        kind=self.config.instrument.wave_interp_order,
-                        fill_value='extrapolate'
-                        )
-                    spec_new = f_cubic(wave_air)
-                else:
-                    f_pre = interp1d(
-                        wave_vac,
-                        spec0,
-                        kind='previous',
-                        bounds_error=False,
-                        fill_value=128
-                        )
-                    spec_pre = f_pre(wave_air)
-
-                    f_nex = interp1d(
-                        wave_vac,
-                        spec0,
-                        kind='next',
-                        bounds_error=False,
-                        fill_value=128
-                        )
-                    spec_nex = f_nex(wave_air)
-
-                    spec_new = np.zeros_like(spec0)
-                    for k in range(spec0.shape[0]):
-                        spec_new[k] = max(spec_pre[k], spec_nex[k])
-
-                cube_new[:, j, i] = spec_new
+        cube_new = resample_cube(cube, wave_vac.value, wave_air.value,
+                                 kind=self.config.instrument.wave_interp_order,
+                                 mask=mask)
 
         obj.header['CTYPE3'] = 'WAVE'
         obj.data = cube_new
@@ -242,29 +249,10 @@ class WavelengthCorrections(BasePrimitive):
 
         # resample to uniform grid
         self.logger.info("Resampling to uniform grid")
-        cube_new = np.zeros_like(cube)
-        for i in range(cube.shape[2]):
-            for j in range(cube.shape[1]):
-
-                spc0 = cube[:, j, i]
-                if not mask:
-                    f_cubic = interp1d(wav_hel, spc0, 
-                                    kind=self.config.instrument.wave_interp_order,
-                                    fill_value='extrapolate')
-                    spec_new = f_cubic(wav_old)
-
-                else:
-                    f_pre = interp1d(wav_hel, spc0, kind='previous',
-                                    bounds_error=False, fill_value=128)
-                    spec_pre = f_pre(wav_old)
-                    f_nex = interp1d(wav_hel, spc0, kind='next',
-                                    bounds_error=False, fill_value=128)
-                    spec_nex = f_nex(wav_old)
-                    spec_new = np.zeros_like(spc0)
-                    for k in range(spc0.shape[0]):
-                        spec_new[k] = max(spec_pre[k], spec_nex[k])
-                cube_new[:, j, i] = spec_new
-        
+        cube_new = resample_cube(cube, wav_hel, wav_old,
+                                 kind=self.config.instrument.wave_interp_order,
+                                 mask=mask)
+
         obj.header['VCORR'] = vcorr
         obj.data = cube_new
         return obj
@@ -318,7 +306,7 @@ class WavelengthCorrections(BasePrimitive):
         full_path = os.path.join(
             self.config.instrument.cwd,
             self.config.instrument.output_directory, objfn)
-        if os.path.exists(full_path):
+        if product_exists(full_path):
             return kcwi_fits_reader(full_path)[0]
         else:
             self.logger.error(f'Unable to read file {objfn}')
@@ -1,19 +1,39 @@
 from keckdrpframework.models.arguments import Arguments
 from astropy.io import fits
-from astropy.nddata import CCDData
+from astropy.nddata import CCDData, StdDevUncertainty
 from astropy.table import Table
 # from astropy import units as u
 import numpy as np
 
 from keckdrpframework.primitives.base_primitive import BasePrimitive
+from kcwidrp.core.kcwi_stack import sigma_clip_combine
 import os
 import logging
 import pkg_resources
 import subprocess
+import threading
+import json
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 logger = logging.getLogger('KCWI')
 
+# version provenance, resolved once per process
+provenance = None
+# write-behind queue for FITS products, see set_write_queue()
+write_executor = None
+write_slots = None
+# output path -> future of its queued write
+pending_writes = {}
+pending_lock = threading.Lock()
+# recently written products, see set_product_registry()
+product_registry = OrderedDict()
+registry_max_bytes = 1024 * 2**20
+registry_lock = threading.RLock()
+# header index file -> {path: (mtime, size, header string)}
+header_indexes = {}
+
 
 def parse_imsec(section=None):
 
@@ -461,14 +481,21 @@ class ingest_file(BasePrimitive):
         self.name = self.action.args.name
         out_args = Arguments()
 
-        ccddata, table = kcwi_fits_reader(self.name)
+        # classify from the header, the image is read when first used
+        index_file = os.path.join(self.config.instrument.cwd,
+                                  self.config.instrument.output_directory,
+                                  'kcwi.headers')
+        ccddata = LazyCCDData(np.empty((0, 0)), unit='adu',
+                              meta=read_header(self.name,
+                                               index_file=index_file),
+                              pixel_file=self.name)
 
         # save the ccd data into an object
         # that can be shared across the functions
         self.ccddata = ccddata
 
         out_args.ccddata = ccddata
-        out_args.table = table
+        out_args.table = None
 
         imtype = self.get_keyword("IMTYPE")
         groupid = self.get_keyword("GROUPID")
@@ -479,6 +506,7 @@ class ingest_file(BasePrimitive):
 
         if self.check_if_file_can_be_processed(imtype) is False:
             # self.logger.warn("Object frame cannot be reduced. Rescheduling")
+            self.park_until_calibrated()
             self.action.new_event = None
             return None
         else:
@@ -557,90 +585,106 @@ class ingest_file(BasePrimitive):
         return self.output
 
     def check_if_file_can_be_processed(self, imtype):
-        # bias frames
-        bias_frames = self.context.proctab.search_proctab(frame=self.ccddata, target_type='MBIAS', nearest=True)
-        # continuum bars
-        contbars_frames = self.context.proctab.search_proctab(frame=self.ccddata, target_type='CONTBARS', nearest=True)
-        # master flats
-        masterflat_frames = self.context.proctab.search_proctab(frame=self.ccddata, target_type='MFLAT', nearest=True)
-        # inverse sensitivity
-        inverse_sensitivity_frames = self.context.proctab.search_proctab(frame=self.ccddata, target_type='INVSENS', nearest=True)
-        # arclamp
-        arclamp_frames = self.context.proctab.search_proctab(frame=self.ccddata, target_type='ARCLAMP', nearest=True)
+        # calibrations needed for each type, in the order they are reported
+        needs = {'OBJECT': ('MBIAS', 'MFLAT', 'ARCLAMP'),
+                 'ARCLAMP': ('CONTBARS',),
+                 'FLATLAMP': ('MBIAS',),
+                 'TWIFLAT': ('MBIAS',),
+                 'DOMEFLAT': ('MBIAS',)}
+        found = {}
+        for target_type in needs.get(imtype, ()):
+            found[target_type] = len(self.context.proctab.search_proctab(
+                frame=self.ccddata, target_type=target_type, nearest=True))
+        self.missing_calibrations = [t for t in found if found[t] == 0]
+        if not self.missing_calibrations:
+            return True
 
         if imtype == 'OBJECT':
-            if len(bias_frames) > 0 \
-                and len(masterflat_frames) > 0 \
-                and len(arclamp_frames) > 0:
-                return True
-            else:
-                self.logger.warn("Cannot reduce OBJECT frame. Rescheduling for later. Found:")
-                self.logger.warn(f"\tMBIAS: {len(bias_frames)}")
-                self.logger.warn(f"\tMFLAT: {len(masterflat_frames)}")
-                self.logger.warn(f"\tARCLAMP: {len(arclamp_frames)}")
-                return False
-
-        if imtype == 'ARCLAMP':
-            if (len(contbars_frames)) > 0:
-                return True
-            else:
-                self.logger.warn("Cannot reduce ARCLAMP frame. Missing continuum bars. Rescheduling for later.")
-                return False
-
-        if imtype in ['FLATLAMP', 'TWIFLAT', 'DOMEFLAT']:
-            if len(bias_frames) > 0:
-                return True
-            else:
-                self.logger.warn(f"Cannot reduce {imtype} frame. Missing master bias. Rescheduling for later.")
-                return False
-
-
-
-        return True
-
-
-def kcwi_fits_reader(file):
+            self.logger.warn("Cannot reduce OBJECT frame. Rescheduling for later. Found:")
+            for target_type in found:
+                self.logger.warn(f"\t{target_type}: {found[target_type]}")
+        elif imtype == 'ARCLAMP':
+            self.logger.warn("Cannot reduce ARCLAMP frame. Missing continuum bars. Rescheduling for later.")
+        else:
+            self.logger.warn(f"Cannot reduce {imtype} frame. Missing master bias. Rescheduling for later.")
+        return False
+
+    def park_until_calibrated(self):
+        """Put the ingest event back on the queue once a missing
+        calibration is added to the proc table, instead of re-ingesting
+        the frame on every queue cycle."""
+        event = self.action.event
+        event._recurrent = False
+        proctab = self.context.proctab
+        ikeys = [proctab.search_key(self.ccddata, target_type)
+                 for target_type in self.missing_calibrations]
+
+        def wake():
+            self.logger.info("Calibrations updated, re-ingesting %s" %
+                             os.path.basename(self.name))
+            self.context.append_event(event.name, event.args,
+                                      recurrent=True)
+
+        proctab.wait_for(ikeys, wake)
+        self.logger.info("Waiting for %s to ingest %s" %
+                         (", ".join(self.missing_calibrations),
+                          os.path.basename(self.name)))
+
+
+def kcwi_fits_reader(file, extensions=None, dtype=np.float64, memmap=None):
     """A reader for KeckData objects.
     Currently this is a separate function, but should probably be
     registered as a reader similar to fits_ccddata_reader.
     Arguments:
     file -- The filename (or pathlib.Path) of the FITS file to open.
+    extensions -- Extensions to read besides the primary image, from
+                  'UNCERT', 'FLAGS', 'MASK' and 'Exposure Events'
+                  (default: all of them that are present).
+    dtype -- Type of the primary image, or None to keep the type on disk.
+    memmap -- Memory map the file (default: the astropy default).  With
+              dtype=None the images stay mapped after the file is closed.
     """
-    try:
-        hdul = fits.open(file)
-    except (FileNotFoundError, OSError) as e:
-        print(e)
-        raise e
-    read_imgs = 0
-    read_tabs = 0
-    # primary image
-    ccddata = CCDData(hdul['PRIMARY'].data, meta=hdul['PRIMARY'].header,
-                      unit='adu')
-    read_imgs += 1
-    # check for other legal components
-    if 'UNCERT' in hdul:
-        ccddata.uncertainty = hdul['UNCERT'].data
-        read_imgs += 1
-    if 'FLAGS' in hdul:
-        ccddata.flags = hdul['FLAGS'].data
-        read_imgs += 1
-    if 'MASK' in hdul:
-        ccddata.mask = hdul['MASK'].data
+    if extensions is None:
+        extensions = ('UNCERT', 'FLAGS', 'MASK', 'Exposure Events')
+    # products written by this process are served from memory
+    hdul = lookup_product(file, extensions)
+    if hdul is None:
+        # the file may still be queued for writing
+        flush_fits_writes(file)
+        try:
+            hdul = fits.open(file, memmap=memmap)
+        except (FileNotFoundError, OSError) as e:
+            print(e)
+            raise e
+    with hdul:
+        read_imgs = 0
+        read_tabs = 0
+        # primary image
+        ccddata = CCDData(hdul['PRIMARY'].data, meta=hdul['PRIMARY'].header,
+                          unit='adu')
         read_imgs += 1
-    if 'Exposure Events' in hdul:
-        table = hdul['Exposure Events']
-        read_tabs += 1
-    else:
-        table = None
+        # check for other legal components
+        if 'UNCERT' in extensions and 'UNCERT' in hdul:
+            ccddata.uncertainty = hdul['UNCERT'].data
+            read_imgs += 1
+        if 'FLAGS' in extensions and 'FLAGS' in hdul:
+            ccddata.flags = hdul['FLAGS'].data
+            read_imgs += 1
+        if 'MASK' in extensions and 'MASK' in hdul:
+            ccddata.mask = hdul['MASK'].data
+            read_imgs += 1
+        if 'Exposure Events' in extensions and 'Exposure Events' in hdul:
+            # copy the table out before the file is closed
+            table = hdul['Exposure Events'].copy()
+            read_tabs += 1
+        else:
+            table = None
+        nhdus = len(hdul)
     # prepare for floating point
-    ccddata.data = ccddata.data.astype(np.float64)
+    if dtype is not None:
+        ccddata.data = ccddata.data.astype(dtype, copy=False)
     # Check for CCDCFG keyword
-    if 'CCDCFG' not in ccddata.header:
-        ccdcfg = ccddata.header['CCDSUM'].replace(" ", "")
-        ccdcfg += "%1d" % ccddata.header['CCDMODE']
-        ccdcfg += "%02d" % ccddata.header['GAINMUL']
-        ccdcfg += "%02d" % ccddata.header['AMPMNUM']
-        ccddata.header['CCDCFG'] = ccdcfg
+    add_ccdcfg(ccddata.header)
 
     if ccddata:
         if 'BUNIT' in ccddata.header:
@@ -650,10 +694,177 @@ def kcwi_fits_reader(file):
             # print("setting image units to " + ccddata.header['BUNIT'])
 
     logger.info("<<< read %d imgs and %d tables out of %d hdus in %s" %
-                (read_imgs, read_tabs, len(hdul), file))
+                (read_imgs, read_tabs, nhdus, file))
     return ccddata, table
 
 
+def add_ccdcfg(header):
+    """Add the CCDCFG keyword to a header if it is missing"""
+    if 'CCDCFG' not in header:
+        ccdcfg = header['CCDSUM'].replace(" ", "")
+        ccdcfg += "%1d" % header['CCDMODE']
+        ccdcfg += "%02d" % header['GAINMUL']
+        ccdcfg += "%02d" % header['AMPMNUM']
+        header['CCDCFG'] = ccdcfg
+
+
+def load_header_index(index_file):
+    """Read a header index journal, later entries win"""
+    index = {}
+    if index_file is not None and os.path.isfile(index_file):
+        with open(index_file) as ifile:
+            for line in ifile:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    logger.warning("skipping bad header index entry")
+                    continue
+                index[entry['path']] = (entry['mtime'], entry['size'],
+                                        entry['header'])
+    return index
+
+
+def read_header(file, index_file=None):
+    """Return the primary header of a FITS file, without reading the image
+
+    Arguments:
+    file -- The filename of the FITS file.
+    index_file -- Header index journal.  Headers of files whose path,
+                  modification time and size match an entry are not
+                  parsed again, and new headers are appended to it.
+    """
+    path = os.path.abspath(str(file))
+    stat = os.stat(path)
+    if index_file not in header_indexes:
+        header_indexes[index_file] = load_header_index(index_file)
+    index = header_indexes[index_file]
+    entry = index.get(path)
+    if entry is not None and entry[:2] == (stat.st_mtime_ns, stat.st_size):
+        header = fits.Header.fromstring(entry[2])
+    else:
+        header = fits.getheader(path)
+        index[path] = (stat.st_mtime_ns, stat.st_size, header.tostring())
+        if index_file is not None:
+            try:
+                with open(index_file, 'a') as ifile:
+                    ifile.write(json.dumps({
+                        'path': path, 'mtime': stat.st_mtime_ns,
+                        'size': stat.st_size,
+                        'header': index[path][2]}) + '\n')
+            except OSError as e:
+                logger.warning("unable to update header index: %s" % e)
+    add_ccdcfg(header)
+    return header
+
+
+class LazyCCDData(CCDData):
+    """A CCDData whose image is read from its file on first use
+
+    Takes the arguments of CCDData, plus pixel_file, the FITS file the
+    image, unit, uncertainty, mask and flags are read from when one of
+    them is first used; until then the data given are a placeholder.  The
+    header is available right away, so frames can be classified without
+    reading the image.
+    """
+
+    def __init__(self, *args, pixel_file=None, **kwd):
+        self.pixel_file = None
+        CCDData.__init__(self, *args, **kwd)
+        self.pixel_file = pixel_file
+
+    def load(self):
+        if self.pixel_file is not None:
+            file = self.pixel_file
+            self.pixel_file = None
+            ccddata = kcwi_fits_reader(file)[0]
+            self.data = ccddata.data
+            self.unit = ccddata.unit
+            self.uncertainty = ccddata.uncertainty
+            self.mask = ccddata.mask
+            self.flags = ccddata.flags
+
+    @property
+    def data(self):
+        self.load()
+        return CCDData.data.fget(self)
+
+    @data.setter
+    def data(self, value):
+        # replacing the image before it is read drops the file
+        self.pixel_file = None
+        CCDData.data.fset(self, value)
+
+    @property
+    def unit(self):
+        self.load()
+        return CCDData.unit.fget(self)
+
+    @unit.setter
+    def unit(self, value):
+        CCDData.unit.fset(self, value)
+
+    @property
+    def uncertainty(self):
+        self.load()
+        return CCDData.uncertainty.fget(self)
+
+    @uncertainty.setter
+    def uncertainty(self, value):
+        CCDData.uncertainty.fset(self, value)
+
+    @property
+    def mask(self):
+        self.load()
+        return CCDData.mask.fget(self)
+
+    @mask.setter
+    def mask(self, value):
+        CCDData.mask.fset(self, value)
+
+    @property
+    def flags(self):
+        self.load()
+        return CCDData.flags.fget(self)
+
+    @flags.setter
+    def flags(self, value):
+        CCDData.flags.fset(self, value)
+
+
+def kcwi_stack_frames(file_list, method='average', low_thresh=3.,
+                      high_thresh=3., chunk_rows=256, nthreads=0,
+                      diff_pair=None):
+    """Sigma-clipped combine of FITS frames without loading them all
+
+    As with ccdproc.combine, the result is the first frame, read in full,
+    with its image, mask and uncertainty replaced by the combined ones.
+    The other frames are memory mapped and combined in row chunks, see
+    kcwidrp.core.kcwi_stack.sigma_clip_combine.
+
+    Returns the stacked CCDData, the difference image (or None) and the
+    mask of the last frame (or None).
+    """
+    stacked = kcwi_fits_reader(file_list[0])[0]
+    images = [stacked.data]
+    last_mask = stacked.mask
+    for file in file_list[1:]:
+        frame = kcwi_fits_reader(file, extensions=('MASK',), dtype=None,
+                                 memmap=True)[0]
+        images.append(frame.data)
+        last_mask = frame.mask
+    data, mask, unc, diff = sigma_clip_combine(
+        images, method=method, low_thresh=low_thresh,
+        high_thresh=high_thresh, chunk_rows=chunk_rows, nthreads=nthreads,
+        diff_pair=diff_pair)
+    unit = None
+    if stacked.uncertainty is not None:
+        unit = stacked.uncertainty.unit
+    stacked.data = data
+    stacked.mask = mask
+    stacked.uncertainty = StdDevUncertainty(unc, unit=unit)
+    return stacked, diff, last_mask
+
+
 def write_table(output_dir=None, table=None, names=None, comment=None,
                 keywords=None, output_name=None, clobber=False):
     output_file = os.path.join(output_dir, output_name)
@@ -694,19 +905,17 @@ def read_table(input_dir=None, file_name=None):
     return retab
 
 
-def kcwi_fits_writer(ccddata, table=None, output_file=None, output_dir=None,
-                     suffix=None):
-    
-    # Determine if the version info is already in the header
-    contains_version = False
-    for h in ccddata.header["HISTORY"]:
-        if "kcwidrp version" in h:
-            contains_version = True
+def get_provenance():
+    """Return the HISTORY lines recording the kcwidrp and git versions
 
-    if not contains_version:
+    The version and git lookups are done on the first call only, and the
+    result is reused for every file written by this process.
+    """
+    global provenance
+    if provenance is None:
         # Add setup.py version number to header
         version = pkg_resources.get_distribution('kcwidrp').version
-        ccddata.header.add_history(f"kcwidrp version={version}")
+        provenance = [f"kcwidrp version={version}"]
 
         # Get string filepath to .git dir, relative to this primitive
         primitive_loc = os.path.dirname(os.path.abspath(__file__))
@@ -714,19 +923,196 @@ def kcwi_fits_writer(ccddata, table=None, output_file=None, output_dir=None,
 
         # Attempt to gather git version information
         git1 = subprocess.run(["git", "--git-dir", git_loc, "describe",
-                                 "--tags", "--long"], capture_output=True)
+                               "--tags", "--long"], capture_output=True)
         git2 = subprocess.run(["git", "--git-dir", git_loc, "log", "-1",
-                                 "--format=%cd"], capture_output=True)
-        
+                               "--format=%cd"], capture_output=True)
+
         # If all went well, save to the header
         if not bool(git1.stderr) and not bool(git2.stderr):
             git_v = git1.stdout.decode('utf-8')[:-1]
             git_d = git2.stdout.decode('utf-8')[:-1]
-            ccddata.header.add_history(f"git version={git_v}")
-            ccddata.header.add_history(f"git date={git_d}")
+            provenance.append(f"git version={git_v}")
+            provenance.append(f"git date={git_d}")
         else:
             logger.debug("Package not installed from a git repo, skipping")
-    
+    return provenance
+
+
+def set_product_registry(max_mb=1024):
+    """Set the size of the registry of recently written products
+
+    kcwi_fits_writer keeps a read-only copy of each product it writes, and
+    kcwi_fits_reader serves those from memory instead of decoding the file
+    again.  The least recently used products are dropped first.
+
+    Arguments:
+    max_mb -- Maximum size of the registry in MB, 0 to disable it.
+    """
+    global registry_max_bytes
+    with registry_lock:
+        registry_max_bytes = int(max_mb * 2**20)
+        trim_registry()
+
+
+def trim_registry():
+    nbytes = sum(entry['nbytes'] for entry in product_registry.values())
+    while product_registry and nbytes > registry_max_bytes:
+        nbytes -= product_registry.popitem(last=False)[1]['nbytes']
+
+
+def register_product(hdus_to_save, out_file):
+    """Add detached hdus of a product being written to the registry"""
+    key = os.path.abspath(out_file)
+    nbytes = sum(hdu.data.nbytes for hdu in hdus_to_save
+                 if hdu.data is not None)
+    with registry_lock:
+        product_registry.pop(key, None)
+        if nbytes > registry_max_bytes:
+            return
+        # the writer may update the headers, so keep copies of them
+        product_registry[key] = {
+            'hdus': [(hdu.name, hdu.header.copy(), hdu.data)
+                     for hdu in hdus_to_save],
+            'nbytes': nbytes, 'mtime': None}
+        trim_registry()
+
+
+def stamp_product(out_file):
+    """Record the modification time of a product once it is on disk"""
+    key = os.path.abspath(out_file)
+    with registry_lock:
+        if key in product_registry:
+            product_registry[key]['mtime'] = os.stat(key).st_mtime_ns
+
+
+def lookup_product(file, extensions):
+    """Return an HDUList of a registered product, or None
+
+    The entry is dropped if the file was changed by someone else since it
+    was written.  Only the requested extensions are copied out.
+    """
+    key = os.path.abspath(str(file))
+    with registry_lock:
+        entry = product_registry.get(key)
+        if entry is None:
+            return None
+        # a missing mtime means our own write is still queued
+        if entry['mtime'] is not None:
+            try:
+                current = os.stat(key).st_mtime_ns
+            except OSError:
+                current = None
+            if current != entry['mtime']:
+                del product_registry[key]
+                return None
+        product_registry.move_to_end(key)
+        hdus = entry['hdus']
+    hdul = fits.HDUList()
+    for name, header, data in hdus:
+        if hdul and name not in extensions:
+            continue
+        if data is not None:
+            data = data.copy()
+        if not hdul:
+            hdul.append(fits.PrimaryHDU(data, header=header.copy()))
+        else:
+            hdul.append(fits.ImageHDU(data, header=header.copy(), name=name))
+    return hdul
+
+
+def set_write_queue(nthreads=2, maxsize=8):
+    """Set up the write-behind queue used by kcwi_fits_writer
+
+    Arguments:
+    nthreads -- Number of threads writing files.
+    maxsize -- Maximum number of products queued or being written; further
+               background writes block until a slot is free.
+    """
+    global write_executor, write_slots
+    flush_fits_writes()
+    if write_executor is not None:
+        write_executor.shutdown(wait=True)
+    write_executor = ThreadPoolExecutor(max_workers=max(1, nthreads),
+                                        thread_name_prefix='kcwi_write')
+    write_slots = threading.BoundedSemaphore(max(1, maxsize))
+
+
+def write_hdus(hdus_to_save, out_file):
+    logger.info(">>> Saving %d hdus to %s" % (len(hdus_to_save), out_file))
+    hdus_to_save.writeto(out_file, overwrite=True)
+
+
+def detach_hdus(hdus_to_save):
+    """Copy hdus so they no longer share data with the CCDData"""
+    hdus_to_save = fits.HDUList([hdu.copy() for hdu in hdus_to_save])
+    for hdu in hdus_to_save:
+        if hdu.data is not None:
+            # shared with the registry, and keeps writeto from
+            # byte swapping in place
+            hdu.data.flags.writeable = False
+    return hdus_to_save
+
+
+def queued_write(hdus_to_save, out_file):
+    try:
+        write_hdus(hdus_to_save, out_file)
+        stamp_product(out_file)
+    except Exception as e:
+        logger.error("Background write of %s failed: %s" % (out_file, e))
+        with registry_lock:
+            product_registry.pop(os.path.abspath(out_file), None)
+        raise
+    finally:
+        write_slots.release()
+
+
+def flush_fits_writes(path=None):
+    """Wait for queued writes from kcwi_fits_writer to finish
+
+    Arguments:
+    path -- Only wait for the write of this file (default: all files).
+    """
+    with pending_lock:
+        if path is None:
+            futures = list(pending_writes.values())
+            pending_writes.clear()
+        else:
+            future = pending_writes.pop(os.path.abspath(str(path)), None)
+            futures = [future] if future is not None else []
+    for future in futures:
+        # re-raises any error from the write
+        future.result()
+
+
+def product_exists(path):
+    """Check for a file, waiting for it first if its write is queued
+
+    Use this instead of os.path.exists() for products that may have been
+    written with kcwi_fits_writer(..., background=True).
+    """
+    flush_fits_writes(path)
+    return os.path.exists(path)
+
+
+def kcwi_fits_writer(ccddata, table=None, output_file=None, output_dir=None,
+                     suffix=None, background=False):
+    """Write a CCDData object, with FLAGS, to a FITS file
+
+    Arguments:
+    background -- Queue the file on the write-behind queue; the data are
+                  copied first, so ccddata can be changed right away.
+                  kcwi_fits_reader waits for a queued file before
+                  reading it; other readers call flush_fits_writes().
+    """
+
+    # Determine if the version info is already in the header
+    contains_version = 'HISTORY' in ccddata.header and \
+        any("kcwidrp version" in h for h in ccddata.header["HISTORY"])
+
+    if not contains_version:
+        for h in get_provenance():
+            ccddata.header.add_history(h)
+
     out_file = os.path.join(output_dir, os.path.basename(output_file))
     if suffix is not None:
         (main_name, extension) = os.path.splitext(out_file)
@@ -741,9 +1127,27 @@ def kcwi_fits_writer(ccddata, table=None, output_file=None, output_dir=None,
     # and causes problems.  Leaving it off for now.
     # if table is not None:
     #    hdus_to_save.append(table)
-    # log
-    logger.info(">>> Saving %d hdus to %s" % (len(hdus_to_save), out_file))
-    hdus_to_save.writeto(out_file, overwrite=True)
+    # keep writes of the same file in order
+    flush_fits_writes(out_file)
+    if background:
+        if write_executor is None:
+            set_write_queue()
+        # wait for a free slot in the queue
+        write_slots.acquire()
+    if background or registry_max_bytes > 0:
+        # detach the hdus from ccddata before handing them off
+        hdus_to_save = detach_hdus(hdus_to_save)
+        register_product(hdus_to_save, out_file)
+    else:
+        with registry_lock:
+            product_registry.pop(os.path.abspath(out_file), None)
+    if background:
+        future = write_executor.submit(queued_write, hdus_to_save, out_file)
+        with pending_lock:
+            pending_writes[os.path.abspath(out_file)] = future
+    else:
+        write_hdus(hdus_to_save, out_file)
+        stamp_product(out_file)
 
 def strip_fname(filename):
     if not filename:
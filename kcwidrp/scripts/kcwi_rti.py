@@ -21,6 +21,8 @@ import pkg_resources
 
 from kcwidrp.pipelines.keck_rti_pipeline import Keck_RTI_Pipeline
 from kcwidrp.core.kcwi_proctab import Proctab
+from kcwidrp.primitives.kcwi_file_primitives import set_write_queue, \
+    set_product_registry, flush_fits_writes
 import logging.config
 
 
@@ -140,6 +142,13 @@ def main():
     # check for the output directory
     check_directory(kcwi_config.output_directory)
 
+    # size the write-behind queue for intermediate images
+    set_write_queue(nthreads=kcwi_config.getValue('write_threads', 2),
+                    maxsize=kcwi_config.getValue('write_queue_size', 8))
+    # keep recently written products in memory
+    set_product_registry(
+        max_mb=kcwi_config.getValue('product_registry_mb', 1024))
+
     try:
         framework = Framework(Keck_RTI_Pipeline, framework_config_fullpath)
         # add this line ONLY if you are using a local logging config file
@@ -271,6 +280,12 @@ def main():
     framework.start(args.queue_manager_only, args.ingest_data_only,
                     args.wait_for_event, args.continuous)
 
+    # finish any queued image writes
+    flush_fits_writes()
+
+    # write out the full proc table
+    framework.context.proctab.compact_proctab()
+
 
 if __name__ == "__main__":
     main()
@@ -22,6 +22,8 @@ import pkg_resources
 
 from kcwidrp.pipelines.kcwi_pipeline import Kcwi_pipeline
 from kcwidrp.core.kcwi_proctab import Proctab
+from kcwidrp.primitives.kcwi_file_primitives import set_write_queue, \
+    set_product_registry, flush_fits_writes
 import logging.config
 
 
@@ -89,6 +91,13 @@ def main():
 
     # END HANDLING OF CONFIGURATION FILES ##########
 
+    # size the write-behind queue for intermediate images
+    set_write_queue(nthreads=kcwi_config.getValue('write_threads', 2),
+                    maxsize=kcwi_config.getValue('write_queue_size', 8))
+    # keep recently written products in memory
+    set_product_registry(
+        max_mb=kcwi_config.getValue('product_registry_mb', 1024))
+
     try:
         framework = Framework(Kcwi_pipeline, framework_config_fullpath)
         # add this line ONLY if you are using a local logging config file
@@ -154,5 +163,11 @@ def main():
 
     framework.start(False, False, True, True)
 
+    # finish any queued image writes
+    flush_fits_writes()
+
+    # write out the full proc table
+    framework.context.proctab.compact_proctab()
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -0,0 +1,80 @@
+import numpy as np
+
+from kcwidrp.core.bspline.Bspline import Bspline, band_normal_equations, \
+    binned_invvar
+
+
+def loop_intrv(sset, x):
+    """Reference breakpoint interval search, one value at a time"""
+    gb = sset.breakpoints[sset.mask]
+    n = gb.size - sset.nord
+    indx = np.zeros((x.size,), dtype='i4')
+    ileft = sset.nord - 1
+    for i in range(x.size):
+        while x[i] > gb[ileft+1] and ileft < n - 1:
+            ileft += 1
+        indx[i] = ileft
+    return indx
+
+
+def test_intrv_matches_loop():
+    rng = np.random.default_rng(5)
+    bkpt = np.sort(rng.uniform(0., 100., 30))
+    bkpt[5] = bkpt[4]
+    for x in (np.sort(rng.uniform(-5., 105., 500)),
+              rng.uniform(-5., 105., 500)):
+        x[3] = np.nan
+        sset = Bspline(x, fullbkpt=bkpt.copy())
+        sset.mask[7] = False
+        assert np.array_equal(sset.intrv(x), loop_intrv(sset, x))
+
+
+def test_band_normal_equations_matches_loop():
+    rng = np.random.default_rng(6)
+    x = np.sort(rng.uniform(0., 10., 2000))
+    x2 = rng.uniform(-1., 1., 2000)
+    sset = Bspline(x, npoly=2, bkpt=np.linspace(0., 10., 25))
+    sset.xmin, sset.xmax = -1., 1.
+    a1, lower, upper = sset.action(x, x2=x2)
+    a2 = a1 * rng.uniform(0.5, 2., 2000)[:, np.newaxis]
+    ydata = np.sin(x)
+    nn = sset.mask[sset.nord:].sum()
+    nfull = nn * sset.npoly
+    bw = sset.npoly * sset.nord
+    alpha, beta = band_normal_equations(a1, a2, ydata, lower, upper,
+                                        nn - sset.nord + 1, sset.npoly, nfull)
+    # dense, one segment at a time
+    expected = np.zeros((nfull + bw, nfull + bw))
+    expected_beta = np.zeros(nfull + bw)
+    for k in range(nn - sset.nord + 1):
+        rows = slice(lower[k], upper[k] + 1)
+        itop = k * sset.npoly
+        expected[itop:itop+bw, itop:itop+bw] += np.dot(a1[rows].T, a2[rows])
+        expected_beta[itop:itop+bw] += np.dot(ydata[rows], a2[rows])
+    for m in range(bw):
+        band = np.diagonal(expected, offset=m)
+        assert np.allclose(alpha[m, :band.size], band, rtol=1.e-12,
+                           atol=1.e-12)
+    assert np.allclose(beta, expected_beta, rtol=1.e-12, atol=1.e-12)
+
+
+def test_binned_invvar_matches_loop():
+    rng = np.random.default_rng(7)
+    xwork = np.sort(np.round(rng.uniform(4000., 5000., 20000), 1))
+    xwork[:100] = 4000.
+    ywork = 1000. * np.sin(xwork / 30.) + 1.e4 + rng.normal(size=xwork.size)
+    maskwork = rng.random(xwork.size) > 0.1
+    invwork = np.ones_like(ywork)
+    # reference, one bin at a time
+    expected = invwork.copy()
+    bins = np.linspace(np.min(xwork), np.max(xwork), 1000)
+    width = (np.max(xwork) - np.min(xwork)) / 999
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for x0 in bins:
+            testvar = np.var(ywork[maskwork & (xwork >= x0) &
+                                   (xwork < x0 + width)])
+            if np.isfinite(1 / testvar):
+                expected[(xwork > x0) & (xwork < x0 + width)] = 1 / testvar
+    result = binned_invvar(xwork, ywork, maskwork, invwork)
+    assert np.allclose(result, expected, rtol=1.e-12, atol=0.)
+    assert np.array_equal(result == 1., expected == 1.)
@@ -0,0 +1,97 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pkg_resources
+
+from kcwidrp.primitives import CorrectDefects as cd
+
+
+def loop_correct(data, flags, full_path, pixel_range_for_good_value=5):
+    """The original per-defect, per-pixel correction loop"""
+    defect_table = pd.read_csv(full_path, sep=r'\s+')
+    number_of_bad_pixels = 0
+    for index, row in defect_table.iterrows():
+        x0 = row['X0'] - 1
+        x1 = row['X1']
+        y0 = row['Y0'] - 1
+        y1 = row['Y1']
+        for by in range(y0, y1):
+            values = list(data[by, x0-pixel_range_for_good_value:x0])
+            values.extend(data[by, x1+1:x1+pixel_range_for_good_value+1])
+            good_values = np.nanmedian(np.asarray(values))
+            for bx in range(x0, x1):
+                data[by, bx] = good_values
+                flags[by, bx] += 2
+                number_of_bad_pixels += 1
+    return number_of_bad_pixels
+
+
+def write_defects(path, rows):
+    with open(path, 'w') as fp:
+        fp.write("  X0    X1    Y0    Y1\n")
+        for row in rows:
+            fp.write("%4d  %4d  %4d  %4d\n" % row)
+
+
+def compare(full_path, shape, seed=0):
+    rng = np.random.default_rng(seed)
+    data = rng.normal(100., 10., size=shape)
+    data[rng.random(shape) > 0.99] = np.nan
+    old_data = data.copy()
+    old_flags = np.zeros(shape, dtype=np.uint8)
+    new_flags = np.zeros(shape, dtype=np.uint8)
+    nold = loop_correct(old_data, old_flags, full_path)
+    nnew = cd.correct_defects(data, new_flags,
+                              cd.compile_defects(full_path, shape))
+    assert nnew == nold
+    np.testing.assert_array_equal(new_flags, old_flags)
+    np.testing.assert_array_equal(data, old_data)
+    return new_flags
+
+
+def test_compiled_matches_loop(tmp_path):
+    full_path = str(tmp_path / "defect.dat")
+    nx = 60
+    write_defects(full_path, [
+        (1, 1, 5, 20),          # low side starts at a negative index
+        (3, 4, 10, 30),         # low side slice wraps to an empty sample
+        (nx - 2, nx, 2, 12),    # high side is clipped at the image edge
+        (nx, nx, 15, 25),       # high side is empty
+        (20, 24, 40, 60),
+        (22, 22, 50, 70),       # overlaps the previous defect
+        (26, 27, 45, 55),       # samples the corrected defect at 20-24
+        (30, 29, 10, 20),       # empty column range
+    ])
+    flags = compare(full_path, (80, nx))
+    # overlapping pixels are flagged by both defects
+    assert flags[54, 21] == 4
+    assert flags[45, 21] == 2
+    assert flags[0, 0] == 0
+
+
+def test_package_defect_lists():
+    package = cd.__name__.split('.')[0]
+    for path, shape in (("data/defect_ALL_2x2.dat", (2056, 2048)),
+                        ("data/defect_TUP_1x1.dat", (4112, 4096))):
+        full_path = pkg_resources.resource_filename(package, path)
+        compare(full_path, shape)
+
+
+def test_defect_cache_invalidation(tmp_path):
+    full_path = str(tmp_path / "defect.dat")
+    shape = (40, 30)
+    write_defects(full_path, [(10, 11, 5, 15)])
+    first = cd.get_defects(full_path, shape)
+    assert cd.get_defects(full_path, shape) is first
+    assert len(first['rows']) == 22
+    # another shape is compiled separately
+    assert cd.get_defects(full_path, (40, 40)) is not first
+
+    write_defects(full_path, [(10, 11, 5, 15), (20, 20, 1, 40)])
+    mtime = os.path.getmtime(full_path) + 10.
+    os.utime(full_path, (mtime, mtime))
+    second = cd.get_defects(full_path, shape)
+    assert second is not first
+    assert len(second['rows']) == 62
+    assert cd.get_defects(full_path, shape) is second
@@ -0,0 +1,76 @@
+import numpy as np
+
+from kcwidrp.primitives.FitCenter import batch_cross_correlate, \
+    dispersion_trials, bar_fit_helper, central_coefficients
+from kcwidrp.primitives.GetAtlasLines import gaus
+
+
+def test_batch_cross_correlate_matches_correlate():
+    rng = np.random.default_rng(11)
+    lengths = (50, 77, 120, 121)
+    spectra = [rng.normal(size=n) for n in lengths]
+    references = [rng.normal(size=n) for n in lengths]
+    maxima, shifts = batch_cross_correlate(spectra, references)
+    for spec, ref, peak, shift in zip(spectra, references, maxima, shifts):
+        crosscorrelation = np.correlate(spec, ref, mode='full')
+        offsets_array = np.arange(1 - len(spec), len(spec))
+        x0c = int(len(crosscorrelation) / 3)
+        x1c = int(2 * (len(crosscorrelation) / 3))
+        central = crosscorrelation[x0c:x1c]
+        assert np.isclose(peak, central.max(), rtol=1.e-12, atol=1.e-12)
+        assert shift == offsets_array[x0c:x1c][central.argmax()]
+
+
+def test_dispersion_trials_span_window():
+    nn, disps = dispersion_trials(0.5, 0.05, 0.02, 2000)
+    assert nn == 50
+    assert len(disps) == nn + 1
+    assert np.isclose(disps[0], 0.5 * 0.95)
+    assert np.isclose(disps[-1], 0.5 * 1.05)
+    assert np.isclose(disps[nn // 2], 0.5)
+    nn, disps = dispersion_trials(0.5, 0.01, 0.02, 50)
+    assert nn == 10
+    assert np.isclose(disps[-1] - disps[0], 0.01)
+
+
+def make_bar_argument(bs, refwave, reflux, disps, nn):
+    xvals = np.arange(2000) - 1000
+    return {'b': 0, 'bs': bs, 'minrow': 500, 'maxrow': 1500,
+            'disps': disps, 'p0': [4000.2], 'PIX': 0.015, 'ybin': 2,
+            'rho': 2.8, 'FCAM': 305., 'xvals': xvals, 'refwave': refwave,
+            'reflux': reflux, 'taperfrac': 0.2, 'refdisp': 0.1,
+            'subxvals': xvals[500:1500], 'nn': nn, 'x0': 1000}
+
+
+def test_bar_fit_helper_xcorr_peak():
+    rng = np.random.default_rng(2)
+    lines = np.sort(rng.uniform(3650., 4350., 60))
+    fluxes = rng.uniform(100., 1000., 60)
+    refwave = np.arange(3500., 4500., 0.1)
+    reflux = np.zeros(len(refwave))
+    for wave, flux in zip(lines, fluxes):
+        reflux += gaus(refwave, flux, wave, 0.4)
+    argument = make_bar_argument(None, refwave, reflux, None, None)
+    coefficients = central_coefficients(4000., 0.3, argument)
+    pix = np.arange(2000.)
+    waves = np.polyval(coefficients, argument['xvals'])
+    bar = np.zeros(len(pix))
+    for wave, flux in zip(lines, fluxes):
+        bar += gaus(pix, flux, np.interp(wave, waves, pix), 1.3)
+    nn, disps = dispersion_trials(0.3, 0.05, 0.1, 1000)
+    result = bar_fit_helper(make_bar_argument(bar, refwave, reflux, disps,
+                                              nn))
+    assert abs(result[5] / 0.3 - 1.) < 0.002
+    assert abs(result[2] - 4000.) < 0.5
+    assert 0.5 < result[6] <= 1.
+    # the peak does not depend on the brightness of the lamp
+    brighter = bar_fit_helper(make_bar_argument(5. * bar, refwave, reflux,
+                                                disps, nn))
+    assert np.isclose(brighter[6], result[6])
+    # and drops for a spectrum that does not match the atlas
+    other = np.zeros(len(pix))
+    for x, flux in zip(rng.uniform(0., 2000., 60), fluxes):
+        other += gaus(pix, flux, x, 1.3)
+    mismatch = bar_fit_helper(make_bar_argument(other, refwave, reflux,
+                                                disps, nn))
+    assert mismatch[6] < 0.9 * result[6]
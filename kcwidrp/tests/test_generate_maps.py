@@ -0,0 +1,83 @@
+import pickle
+
+import numpy as np
+from skimage import transform as tf
+
+from kcwidrp.primitives.GenerateMaps import generate_geometry_maps
+
+
+def make_synthetic_geom(ny=120, slice_width=12, xsize=10):
+    """Build a small 24 slice geometry with curved polynomial transforms"""
+    xl0s = []
+    xl1s = []
+    invtf_list = []
+    yy, xx = np.mgrid[0:ny:10, 0:slice_width:3]
+    src = np.column_stack((xx.ravel(), yy.ravel())).astype(float)
+    for isl in range(24):
+        # overlapping slice limits, like the real geometry
+        xl0 = max(0, isl * (slice_width - 2) - 1)
+        xl0s.append(xl0)
+        xl1s.append(xl0 + slice_width)
+        # smooth distortion in both position and wavelength
+        dst = src.copy()
+        dst[:, 0] = 0.95 * src[:, 0] - 1.0 + 1.e-4 * isl * src[:, 1] + \
+            2.e-5 * (src[:, 1] - ny / 2.)**2
+        dst[:, 1] = 1.01 * src[:, 1] + 0.3 * src[:, 0] - 0.1 * isl + \
+            1.e-6 * src[:, 1]**3
+        invtf_list.append(tf.estimate_transform('polynomial', src, dst,
+                                                order=3))
+    return {'xl0': xl0s, 'xl1': xl1s, 'invtf': invtf_list,
+            'wave0out': 3500., 'dwout': 0.5, 'xsize': xsize}
+
+
+def loop_geometry_maps(geom, data_img):
+    """Reference per-pixel implementation of the map generation"""
+    xl0s = geom['xl0']
+    xl1s = geom['xl1']
+    invtf_list = geom['invtf']
+    wave0 = geom['wave0out']
+    dw = geom['dwout']
+    xsize = geom['xsize']
+    ny = data_img.shape[0]
+    wave_map_img = np.full_like(data_img, fill_value=-1.)
+    xpos_map_img = np.full_like(data_img, fill_value=-1.)
+    slice_map_img = np.full_like(data_img, fill_value=-1.)
+    delta_map_img = np.full_like(data_img, fill_value=-1.)
+    for isl in range(0, 24):
+        itrf = invtf_list[isl]
+        xl0 = xl0s[isl]
+        xl1 = xl1s[isl]
+        for ix in range(xl0, xl1):
+            coords = np.zeros((ny, 2))
+            for iy in range(0, ny):
+                coords[iy, 0] = ix - xl0
+                coords[iy, 1] = iy
+            ncoo = itrf(coords)
+            for iy in range(0, ny):
+                if 0 <= ncoo[iy, 0] <= xsize:
+                    slice_map_img[iy, ix] = isl
+                    xpos_map_img[iy, ix] = ncoo[iy, 0]
+                    wave_map_img[iy, ix] = ncoo[iy, 1] * dw + wave0
+                    if iy > 0:
+                        delta_map_img[iy, ix] = abs(
+                            (ncoo[iy, 1] - ncoo[iy-1, 1]) * dw)
+    return wave_map_img, xpos_map_img, slice_map_img, delta_map_img
+
+
+def test_generate_geometry_maps_matches_loop(tmp_path):
+    geom_file = tmp_path / "synthetic_geom.pkl"
+    with open(geom_file, 'wb') as ofile:
+        pickle.dump(make_synthetic_geom(), ofile)
+    with open(geom_file, 'rb') as ifile:
+        geom = pickle.load(ifile)
+
+    data_img = np.zeros((120, 250), dtype=np.float64)
+    expected = loop_geometry_maps(geom, data_img)
+    result = generate_geometry_maps(geom, data_img)
+
+    for exp_map, res_map in zip(expected, result):
+        assert res_map.dtype == exp_map.dtype
+        assert res_map.tobytes() == exp_map.tobytes()
+    # make sure the geometry actually exercised the masking
+    assert np.any(expected[2] < 0)
+    assert np.any(expected[2] >= 0)
@@ -0,0 +1,50 @@
+import numpy as np
+from scipy.optimize import curve_fit
+
+from kcwidrp.primitives.GetAtlasLines import findpeaks, fit_gaussians, \
+    gaus
+
+
+def test_fit_gaussians_matches_curve_fit():
+    rng = np.random.default_rng(1)
+    xvecs = []
+    yvecs = []
+    p0 = []
+    for _ in range(50):
+        npts = rng.integers(5, 15)
+        center = rng.uniform(100., 3000.)
+        xvec = np.arange(npts) + np.floor(center) - npts // 2
+        amp = rng.uniform(100., 5.e4)
+        yvec = gaus(xvec, amp, center, rng.uniform(0.7, 2.5)) + \
+            rng.normal(0., 0.3 * np.sqrt(amp), npts)
+        xvecs.append(xvec)
+        yvecs.append(yvec)
+        p0.append([yvec.max(), xvec.mean(), 1.])
+    # a window with a bad pixel fails, like curve_fit
+    yvecs[3] = yvecs[3].copy()
+    yvecs[3][1] = np.nan
+    fits, fit_ok = fit_gaussians(xvecs, yvecs, p0)
+    assert not fit_ok[3]
+    assert fit_ok.sum() == len(xvecs) - 1
+    for k in np.flatnonzero(fit_ok):
+        ref, _ = curve_fit(gaus, xvecs[k], yvecs[k], p0=p0[k])
+        assert np.allclose(fits[k], ref, rtol=1.e-5, atol=1.e-6)
+
+
+def test_fit_gaussians_no_windows():
+    fits, fit_ok = fit_gaussians([], [], [])
+    assert fits.shape == (0, 3)
+    assert len(fit_ok) == 0
+
+
+def test_findpeaks_recovers_lines():
+    rng = np.random.default_rng(7)
+    wave = np.linspace(4000., 5000., 2000)
+    centers = np.linspace(4050., 4950., 30) + rng.uniform(-2., 2., 30)
+    flux = np.full(len(wave), 10.)
+    for center in centers:
+        flux += gaus(wave, rng.uniform(500., 5000.), center, 1.0)
+    pks, sigma, hgts = findpeaks(wave, flux, 4, 0.014, 0., 8)
+    assert len(pks) > 25
+    assert np.abs(np.subtract.outer(pks, centers)).min(axis=1).max() < 0.01
+    assert abs(sigma - 1.0) < 0.05
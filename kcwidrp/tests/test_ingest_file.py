@@ -0,0 +1,140 @@
+from types import SimpleNamespace
+
+import numpy as np
+from astropy.io import fits
+from keckdrpframework.models.arguments import Arguments
+from keckdrpframework.models.event import Event
+
+from kcwidrp.core.kcwi_proctab import Proctab
+from kcwidrp.primitives import kcwi_file_primitives as kfp
+from kcwidrp.primitives.kcwi_file_primitives import ingest_file
+from kcwidrp.tests.test_proctab import make_frame
+
+
+class FakeLogger:
+
+    def info(self, msg):
+        pass
+
+    warn = info
+
+
+def make_ingest(tmp_path, frame):
+    events = []
+    proctab = Proctab(None)
+    proctab.read_proctab(tfil=str(tmp_path / 'kcwi.proc'))
+    context = SimpleNamespace(
+        proctab=proctab,
+        append_event=lambda name, args, recurrent=False:
+        events.append((name, args.name, recurrent)))
+    ingest = object.__new__(ingest_file)
+    ingest.context = context
+    ingest.logger = FakeLogger()
+    ingest.action = SimpleNamespace(
+        event=Event('next_file', Arguments(name='kb00010.fits'),
+                    recurrent=True))
+    ingest.name = 'kb00010.fits'
+    ingest.ccddata = frame
+    return ingest, proctab, events
+
+
+def test_blocked_object_waits_for_calibrations(tmp_path):
+    target = make_frame(10, 'OBJECT', 59000.42)
+    ingest, proctab, events = make_ingest(tmp_path, target)
+    proctab.update_proctab(make_frame(1, 'MBIAS', 59000.1), suffix='mbias',
+                           filename='b1')
+
+    assert ingest.check_if_file_can_be_processed('OBJECT') is False
+    assert ingest.missing_calibrations == ['MFLAT', 'ARCLAMP']
+    ingest.park_until_calibrated()
+    # no longer re-queued on every cycle
+    assert ingest.action.event._recurrent is False
+
+    proctab.update_proctab(make_frame(2, 'MBIAS', 59000.2), suffix='mbias',
+                           filename='b2')
+    assert events == []
+    proctab.update_proctab(make_frame(3, 'MFLAT', 59000.3), suffix='mflat',
+                           filename='f3')
+    assert events == [('next_file', 'kb00010.fits', True)]
+    proctab.update_proctab(make_frame(4, 'ARCLAMP', 59000.3), suffix='RAW',
+                           filename='a4')
+    assert len(events) == 1
+
+    assert ingest.check_if_file_can_be_processed('OBJECT') is True
+
+
+def test_header_index_and_lazy_pixels(tmp_path, monkeypatch):
+    raw = str(tmp_path / 'kb00010.fits')
+    hdr = fits.Header()
+    hdr['CCDCFG'] = '2211000'
+    hdr['IMTYPE'] = 'OBJECT'
+    fits.writeto(raw, np.arange(6, dtype=np.uint16).reshape(2, 3), hdr)
+    index_file = str(tmp_path / 'kcwi.headers')
+
+    parsed = []
+    getheader = kfp.fits.getheader
+    monkeypatch.setattr(kfp.fits, 'getheader',
+                        lambda path: parsed.append(path) or getheader(path))
+    assert kfp.read_header(raw, index_file=index_file)['IMTYPE'] == 'OBJECT'
+    # a new process reads the index instead of the file
+    monkeypatch.setattr(kfp, 'header_indexes', {})
+    header = kfp.read_header(raw, index_file=index_file)
+    assert header['IMTYPE'] == 'OBJECT'
+    assert len(parsed) == 1
+
+    ccd = kfp.LazyCCDData(np.empty((0, 0)), unit='adu', meta=header,
+                          pixel_file=raw)
+    assert ccd.pixel_file == raw
+    ccd.header['IMTYPE'] = 'SKY'
+    assert ccd.data.dtype == np.float64
+    assert np.array_equal(ccd.data, np.arange(6).reshape(2, 3))
+    assert ccd.pixel_file is None
+    # header changes made before the image was read are kept
+    assert ccd.header['IMTYPE'] == 'SKY'
+
+    # a changed file is parsed again
+    monkeypatch.setattr(kfp, 'header_indexes', {})
+    hdr['IMTYPE'] = 'ARCLAMP'
+    fits.writeto(raw, np.zeros((2, 4), dtype=np.uint16), hdr,
+                 overwrite=True)
+    assert kfp.read_header(raw, index_file=index_file)['IMTYPE'] == 'ARCLAMP'
+    assert len(parsed) == 2
+
+
+def make_lazy_frame(tmp_path):
+    raw = str(tmp_path / 'kb00011.fits')
+    hdr = fits.Header()
+    hdr['CCDCFG'] = '2211000'
+    hdr['BUNIT'] = 'electron'
+    fits.HDUList([
+        fits.PrimaryHDU(np.arange(12, dtype=np.float32).reshape(3, 4),
+                        header=hdr),
+        fits.ImageHDU(np.ones((3, 4)), name='UNCERT'),
+        fits.ImageHDU(np.full((3, 4), 2, dtype=np.uint8), name='FLAGS'),
+        fits.ImageHDU(np.eye(3, 4, dtype=np.uint8), name='MASK')
+    ]).writeto(raw, overwrite=True)
+    return kfp.LazyCCDData(np.empty((0, 0)), unit='adu', meta=hdr,
+                           pixel_file=raw)
+
+
+def test_lazy_frame_behaves_as_ccddata(tmp_path):
+    expected = np.arange(12.).reshape(3, 4)
+    # copies, slices and arithmetic read the image first
+    copied = make_lazy_frame(tmp_path).copy()
+    assert np.array_equal(copied.data, expected)
+    assert copied.unit == 'electron'
+    assert np.array_equal(copied.mask, np.eye(3, 4))
+    assert np.array_equal(copied.uncertainty.array, np.ones((3, 4)))
+    assert np.array_equal(copied.flags, np.full((3, 4), 2))
+
+    sliced = make_lazy_frame(tmp_path)[1:3]
+    assert sliced.data.shape == (2, 4)
+    assert np.array_equal(sliced.data, expected[1:3])
+
+    doubled = make_lazy_frame(tmp_path).multiply(2.)
+    assert np.array_equal(doubled.data, 2. * expected)
+    assert doubled.unit == 'electron'
+
+    ccd = make_lazy_frame(tmp_path)
+    assert np.array_equal(ccd.flags, np.full((3, 4), 2))
+    assert ccd.pixel_file is None
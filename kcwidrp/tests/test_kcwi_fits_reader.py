@@ -0,0 +1,173 @@
+import os
+import time
+from types import SimpleNamespace
+
+import numpy as np
+from astropy.io import fits
+from astropy.nddata import CCDData
+
+from kcwidrp.primitives import kcwi_file_primitives as kfp
+from kcwidrp.primitives.kcwi_file_primitives import kcwi_fits_reader
+
+
+def write_frame(path):
+    hdr = fits.Header()
+    hdr['CCDCFG'] = '2211000'
+    hdr['BUNIT'] = 'electron'
+    hdul = fits.HDUList([
+        fits.PrimaryHDU(np.arange(12, dtype=np.float32).reshape(3, 4),
+                        header=hdr),
+        fits.ImageHDU(np.ones((3, 4)), name='UNCERT'),
+        fits.ImageHDU(np.zeros((3, 4), dtype=np.uint8), name='FLAGS'),
+        fits.ImageHDU(np.zeros((3, 4), dtype=np.uint8), name='MASK'),
+        fits.BinTableHDU.from_columns(
+            [fits.Column(name='EVENT', format='10A', array=['A', 'B'])],
+            name='Exposure Events')])
+    hdul.writeto(path)
+
+
+def test_reader_defaults(tmp_path):
+    path = tmp_path / 'frame.fits'
+    write_frame(path)
+    ccd, table = kcwi_fits_reader(str(path))
+    assert ccd.data.dtype == np.float64
+    assert np.array_equal(ccd.data, np.arange(12).reshape(3, 4))
+    assert ccd.uncertainty is not None
+    assert ccd.flags is not None and ccd.mask is not None
+    assert str(ccd.unit) == 'electron'
+    assert list(table.data['EVENT']) == ['A', 'B']
+
+
+def test_reader_selected_extensions(tmp_path):
+    path = tmp_path / 'frame.fits'
+    write_frame(path)
+    ccd, table = kcwi_fits_reader(str(path), extensions=('MASK',),
+                                  dtype=None, memmap=True)
+    assert ccd.data.dtype.kind == 'f' and ccd.data.dtype.itemsize == 4
+    assert np.array_equal(ccd.data, np.arange(12).reshape(3, 4))
+    assert ccd.uncertainty is None
+    assert ccd.flags is None
+    assert ccd.mask is not None
+    assert table is None
+
+
+def test_writer_background_and_provenance(tmp_path, monkeypatch):
+    calls = []
+    real_run = kfp.subprocess.run
+
+    def run(*args, **kwargs):
+        calls.append(args)
+        return real_run(*args, **kwargs)
+
+    monkeypatch.setattr(kfp, 'provenance', None)
+    monkeypatch.setattr(kfp.subprocess, 'run', run)
+    monkeypatch.setattr(kfp.pkg_resources, 'get_distribution',
+                        lambda name: SimpleNamespace(version='1.0'))
+    hdr = fits.Header()
+    hdr['CCDCFG'] = '2211000'
+    for i in range(2):
+        ccd = CCDData(np.full((3, 4), float(i)), meta=hdr.copy(), unit='adu')
+        kfp.kcwi_fits_writer(ccd, output_file='frame.fits',
+                             output_dir=str(tmp_path), suffix='int%d' % i,
+                             background=True)
+        # changes after the call must not reach the file
+        ccd.data[:] = -1.
+    assert len(calls) == 2
+    for i in range(2):
+        ccd = kfp.kcwi_fits_reader(str(tmp_path / ('frame_int%d.fits' % i)))[0]
+        assert np.all(ccd.data == i)
+        assert any("kcwidrp version" in h for h in ccd.header['HISTORY'])
+
+
+def test_write_queue_is_bounded_and_ordered(tmp_path, monkeypatch):
+    monkeypatch.setattr(kfp, 'provenance', ['kcwidrp version=1.0'])
+    kfp.set_write_queue(nthreads=2, maxsize=2)
+    # read back from disk
+    kfp.set_product_registry(0)
+    try:
+        hdr = fits.Header()
+        hdr['CCDCFG'] = '2211000'
+        ccd = CCDData(np.zeros((50, 40)), meta=hdr, unit='adu')
+        for i in range(6):
+            ccd.data[:] = i
+            # same file every other time, later writes must win
+            kfp.kcwi_fits_writer(ccd, output_file='frame.fits',
+                                 output_dir=str(tmp_path),
+                                 suffix='intk%d' % (i % 2), background=True)
+            assert len(kfp.pending_writes) <= 2
+        out = tmp_path / 'frame_intk0.fits'
+        assert np.all(kfp.kcwi_fits_reader(out)[0].data == 4)
+        assert str(out) not in kfp.pending_writes
+        kfp.flush_fits_writes()
+        assert not kfp.pending_writes
+        assert np.all(kfp.kcwi_fits_reader(
+            str(tmp_path / 'frame_intk1.fits'))[0].data == 5)
+    finally:
+        kfp.set_write_queue()
+        kfp.set_product_registry()
+
+
+def test_product_registry(tmp_path, monkeypatch):
+    monkeypatch.setattr(kfp, 'provenance', ['kcwidrp version=1.0'])
+    hdr = fits.Header()
+    hdr['CCDCFG'] = '2211000'
+    hdr['BUNIT'] = 'electron'
+    ccd = CCDData(np.arange(12.).reshape(3, 4), meta=hdr, unit='electron',
+                  uncertainty=np.ones((3, 4)),
+                  mask=np.eye(3, 4, dtype=bool))
+    ccd.flags = np.full((3, 4), 2, dtype=np.uint8)
+    path = tmp_path / 'frame_intk.fits'
+    kfp.set_product_registry(1)
+    try:
+        kfp.kcwi_fits_writer(ccd, output_file='frame.fits',
+                             output_dir=str(tmp_path), suffix='intk')
+        assert str(path) in kfp.product_registry
+        cached = kfp.kcwi_fits_reader(path)[0]
+        # changes to what was read must not reach the registry
+        cached.data[:] = -1.
+        cached = kfp.kcwi_fits_reader(path)[0]
+        kfp.set_product_registry(0)
+        disk = kfp.kcwi_fits_reader(path)[0]
+        for a, b in ((cached.data, disk.data), (cached.mask, disk.mask),
+                     (cached.flags, disk.flags),
+                     (cached.uncertainty.array, disk.uncertainty.array)):
+            assert a.dtype.str[1:] == b.dtype.str[1:]
+            assert np.array_equal(a, b)
+        assert cached.unit == disk.unit
+        assert cached.header['HISTORY'][0] == disk.header['HISTORY'][0]
+
+        # a file changed on disk is read again
+        kfp.set_product_registry(1)
+        kfp.kcwi_fits_writer(ccd, output_file='frame.fits',
+                             output_dir=str(tmp_path), suffix='intk')
+        fits.writeto(path, np.zeros((3, 4)), header=disk.header,
+                     overwrite=True)
+        os.utime(path, ns=(0, 0))
+        assert np.all(kfp.kcwi_fits_reader(path)[0].data == 0.)
+        assert str(path) not in kfp.product_registry
+    finally:
+        kfp.set_product_registry()
+
+
+def test_product_exists_waits_for_queued_write(tmp_path, monkeypatch):
+    monkeypatch.setattr(kfp, 'provenance', ['kcwidrp version=1.0'])
+    write_hdus = kfp.write_hdus
+
+    def slow_write(hdus_to_save, out_file):
+        time.sleep(0.3)
+        write_hdus(hdus_to_save, out_file)
+
+    monkeypatch.setattr(kfp, 'write_hdus', slow_write)
+    kfp.set_write_queue()
+    path = tmp_path / 'frame_intk.fits'
+    hdr = fits.Header()
+    hdr['CCDCFG'] = '2211000'
+    ccd = CCDData(np.zeros((3, 4)), meta=hdr, unit='adu')
+    kfp.kcwi_fits_writer(ccd, output_file='frame.fits',
+                         output_dir=str(tmp_path), suffix='intk',
+                         background=True)
+    assert not os.path.exists(path)
+    assert kfp.product_exists(path)
+    assert os.path.exists(path)
+    assert not kfp.pending_writes
+    assert not kfp.product_exists(tmp_path / 'frame_sky.fits')
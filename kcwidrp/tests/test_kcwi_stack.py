@@ -0,0 +1,64 @@
+import warnings
+
+import ccdproc
+import numpy as np
+from astropy.io import fits
+from astropy.nddata import CCDData
+
+from kcwidrp.core.kcwi_stack import sigma_clip_combine
+from kcwidrp.primitives.kcwi_file_primitives import kcwi_stack_frames
+
+
+def test_sigma_clip_combine_matches_ccdproc():
+    rng = np.random.default_rng(7)
+    images = [rng.normal(100., 5., (61, 37)) for _ in range(7)]
+    images[0][3, 4] = 1.e4
+    images[1][5, 5] = -1.e3
+    images[2][10, 10] = np.nan
+    for image in images:
+        image[20, 20] = 7.
+    for method in ('average', 'median'):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            expected = ccdproc.combine(
+                [CCDData(im, unit='adu') for im in images], method=method,
+                sigma_clip=True, sigma_clip_low_thresh=None,
+                sigma_clip_high_thresh=2.0)
+            data, mask, unc, diff = sigma_clip_combine(
+                images, method=method, low_thresh=3., high_thresh=2.,
+                chunk_rows=8, nthreads=3, diff_pair=(1, 2))
+        assert np.allclose(data, expected.data, rtol=0., atol=1.e-12,
+                           equal_nan=True)
+        assert np.array_equal(mask, expected.mask)
+        assert np.allclose(unc, expected.uncertainty.array, rtol=0.,
+                           atol=1.e-12, equal_nan=True)
+        assert np.array_equal(diff, images[1].astype(np.float32) -
+                              images[2].astype(np.float32), equal_nan=True)
+
+
+def test_stack_frames_returns_last_mask(tmp_path):
+    rng = np.random.default_rng(3)
+    images = [rng.normal(100., 5., (20, 12)) for _ in range(3)]
+    files = []
+    for i, image in enumerate(images):
+        mask = np.zeros(image.shape, dtype=np.uint8)
+        mask[i, :] = 1
+        hdr = fits.Header()
+        hdr['CCDCFG'] = '2211000'
+        path = str(tmp_path / ('flat%d.fits' % i))
+        fits.HDUList([fits.PrimaryHDU(image, header=hdr),
+                      fits.ImageHDU(np.ones(image.shape), name='UNCERT'),
+                      fits.ImageHDU(mask, name='MASK')]).writeto(path)
+        files.append(path)
+    stacked, diff, last_mask = kcwi_stack_frames(files, low_thresh=3.,
+                                                 high_thresh=2.)
+    data, mask, _, _ = sigma_clip_combine(images, low_thresh=3.,
+                                          high_thresh=2.)
+    assert diff is None
+    assert np.allclose(stacked.data, data, rtol=0., atol=1.e-12)
+    assert np.array_equal(stacked.mask, mask)
+    assert np.array_equal(last_mask, fits.getdata(files[-1], 'MASK'))
+    # a single frame is its own last frame; unset sizes use the defaults
+    _, _, last_mask = kcwi_stack_frames(files[:1], chunk_rows=None,
+                                        nthreads=None)
+    assert np.array_equal(last_mask, fits.getdata(files[0], 'MASK'))
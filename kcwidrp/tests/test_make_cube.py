@@ -0,0 +1,103 @@
+import os
+import pickle
+from multiprocessing import get_context
+
+import numpy as np
+from skimage import transform as tf
+
+from kcwidrp.primitives.MakeCube import warp_planes, \
+    make_geometry_coordinates, publish_array, attach_arrays, \
+    make_cube_init, make_cube_helper
+
+
+def make_slice_transform(ny, nx):
+    """Curved 3rd order polynomial transform for a synthetic slice"""
+    yy, xx = np.mgrid[0:ny:10, 0:nx:5]
+    src = np.column_stack((xx.ravel(), yy.ravel())).astype(float)
+    dst = src.copy()
+    dst[:, 0] = 1.02 * src[:, 0] - 2. + 1.e-4 * (src[:, 1] - ny / 2.)**2
+    dst[:, 1] = src[:, 1] + 0.05 * src[:, 0] + 3.
+    return tf.estimate_transform('polynomial', src, dst, order=3)
+
+
+def test_warp_planes_matches_warp():
+    rng = np.random.default_rng(42)
+    ny, nx = 100, 24
+    output_shape = (95, 22)
+    tform = make_slice_transform(ny, nx)
+    coords = tf.warp_coords(tform, output_shape)
+
+    planes = [rng.normal(size=(ny, nx)) + 10. for _ in range(3)]
+    warped = warp_planes(planes, coords, order=3,
+                         preserve_range=[False, False, True])
+    for plane, result in zip(planes, warped):
+        expected = tf.warp(plane, tform, order=3, output_shape=output_shape)
+        assert np.allclose(result, expected, rtol=0., atol=1.e-10)
+
+    msk = (rng.random((ny, nx)) > 0.9).astype(np.uint8)
+    flg = rng.integers(0, 3, size=(ny, nx)).astype(np.uint8)
+    marped, farped = warp_planes([msk, flg], coords, order=1, cval=[1, 64],
+                                 preserve_range=[False, True])
+    assert np.allclose(marped, tf.warp(msk, tform, order=1,
+                                       output_shape=output_shape,
+                                       mode='constant', cval=1),
+                       rtol=0., atol=1.e-12)
+    assert np.allclose(farped, tf.warp(flg, tform, order=1,
+                                       output_shape=output_shape,
+                                       preserve_range=True,
+                                       mode='constant', cval=64),
+                       rtol=0., atol=1.e-12)
+
+
+def test_geometry_coordinates_are_float32(tmp_path):
+    geom = {'xsize': 22, 'ysize': 95,
+            'tform': [make_slice_transform(100 + isl, 24)
+                      for isl in range(24)]}
+    geom_file = str(tmp_path / 'arc_geom.pkl')
+    with open(geom_file, 'wb') as ofile:
+        pickle.dump(geom, ofile)
+    coord_file = make_geometry_coordinates(geom, geom_file)
+    coords = np.load(coord_file, mmap_mode='r')
+    assert coords.dtype == np.float32
+    assert coords.shape == (24, 2, 95, 22)
+    for isl in (0, 23):
+        assert np.allclose(coords[isl],
+                           tf.warp_coords(geom['tform'][isl], (95, 22)),
+                           rtol=0., atol=1.e-3)
+    # reused while the geometry is unchanged
+    mtime = os.path.getmtime(coord_file)
+    del coords
+    assert make_geometry_coordinates(geom, geom_file) == coord_file
+    assert os.path.getmtime(coord_file) == mtime
+
+
+def test_slices_warp_in_spawned_workers(tmp_path):
+    rng = np.random.default_rng(1)
+    ny, nx, xsize, ysize = 100, 48, 22, 95
+    planes = {'img': rng.normal(size=(ny, nx)) + 10.,
+              'std': rng.random((ny, nx)) + 1.,
+              'msk': (rng.random((ny, nx)) > 0.9).astype(np.uint8),
+              'flg': rng.integers(0, 3, size=(ny, nx)).astype(np.uint8)}
+    dtypes = {'img': np.float64, 'std': np.float64, 'msk': np.uint8,
+              'flg': np.uint8}
+    tforms = [make_slice_transform(ny, 24) for _ in range(2)]
+    plane_specs = {name: publish_array(str(tmp_path), 'plane_' + name, plane)
+                   for name, plane in planes.items()}
+    cube_specs = {name: publish_array(str(tmp_path), 'cube_' + name,
+                                      shape=(2, ysize, xsize),
+                                      dtype=dtypes[name])
+                  for name in planes}
+    arguments = [{'slice_number': isl, 'tform': tforms[isl],
+                  'coord_file': None, 'xl0': 24 * isl, 'xl1': 24 * (isl + 1),
+                  'xsize': xsize, 'ysize': ysize, 'order': 3}
+                 for isl in range(2)]
+    with get_context("spawn").Pool(2, initializer=make_cube_init,
+                                   initargs=(plane_specs, cube_specs)) as p:
+        assert p.map(make_cube_helper, arguments) == [0, 1]
+    cubes = attach_arrays(cube_specs, 'r')
+    for isl, tform in enumerate(tforms):
+        coords = tf.warp_coords(tform, (ysize, xsize))
+        expected = warp_planes([planes['img'][:, 24 * isl:24 * (isl + 1)]],
+                               coords, order=3)[0]
+        assert np.allclose(cubes['img'][isl], expected, rtol=0.,
+                           atol=1.e-12)
@@ -0,0 +1,203 @@
+import types
+
+import numpy as np
+
+from kcwidrp.core.bspline import Bspline
+from kcwidrp.primitives import MakeMasterFlat as mmf
+
+
+class Frame:
+    """Minimal stand-in for a CCDData read from disk"""
+    def __init__(self, data, header):
+        self.data = data
+        self.header = dict(header)
+        self.flags = None
+
+
+def make_synthetic_maps(xbin=4, ny=600, seed=0):
+    """Synthetic wavelength, slice and position maps with a vignetted flat"""
+    rng = np.random.default_rng(seed)
+    width = int(140 / xbin)
+    rows, cols = np.mgrid[0:ny, 0:24 * width]
+    slc = (cols // width).astype(float)
+    pos = (cols % width).astype(float) + 0.3 * np.sin(rows / 50.)
+    # slice 12 extends to the blue and slice 23 to the red of slice 9
+    offset = np.zeros(24)
+    offset[12] = -6.
+    offset[23] = 6.
+    wave = 4000. + 2.0 * rows + 0.05 * pos + offset[cols // width]
+    wave[:, ::97] = -1.
+    vign = np.where(pos < 20 / xbin, 0.7 + 0.3 * pos / (20 / xbin), 1.)
+    spec = 1000. + 300. * np.sin((wave - 4000.) / 150.)
+    data = spec * vign * (1. + 0.01 * rng.normal(size=wave.shape))
+    data[rng.random(wave.shape) > 0.999] = 10.
+    hdr = {'WAVGOOD0': 4100., 'WAVGOOD1': 4500., 'DICHFRAC': 1.,
+           'IMTYPE': 'SFLAT', 'NAXIS2': ny, 'FRAMENO': 1}
+    return {'wavemap': Frame(wave, hdr), 'slicemap': Frame(slc, hdr),
+            'posmap': Frame(pos, hdr), 'sflat': Frame(data, hdr)}
+
+
+def run_make_master_flat(maps, xbin, monkeypatch):
+    """Run MakeMasterFlat._perform on the maps without the framework"""
+    output = {}
+
+    def reader(path, **kwargs):
+        for key, frame in maps.items():
+            if path.endswith('_' + key + '.fits'):
+                return [Frame(frame.data.copy(), frame.header)]
+        raise IOError(path)
+
+    def writer(frame, output_file=None, output_dir=None):
+        output['frame'] = frame
+
+    monkeypatch.setattr(mmf, 'kcwi_fits_reader', reader)
+    monkeypatch.setattr(mmf, 'kcwi_fits_writer', writer)
+    prim = object.__new__(mmf.MakeMasterFlat)
+    prim.logger = types.SimpleNamespace(info=print, warning=print,
+                                        error=print)
+    prim.config = types.SimpleNamespace(instrument=types.SimpleNamespace(
+        cwd='.', KNOTSPP=1.25, plot_level=0, output_directory='redux'))
+    prim.context = types.SimpleNamespace(proctab=types.SimpleNamespace(
+        search_proctab=lambda **kw: {'filename': ['kb_arc.fits']},
+        update_proctab=lambda **kw: None, write_proctab=lambda: None))
+    prim.stack_list = {'filename': ['kb_flat.fits']}
+    prim.action = types.SimpleNamespace(args=types.SimpleNamespace(
+        new_type='MFLAT', stack_type='SFLAT', groupid='g', xbinsize=xbin,
+        camera=0, grating='BL', cwave=4300., ccddata=None))
+    prim._perform()
+    return output['frame'].data, output['frame'].flags
+
+
+def bspline_fit(xx, yy, knots):
+    bkpt = np.min(xx) + np.arange(knots+1) * (np.max(xx) - np.min(xx)) / knots
+    sft, _ = Bspline.iterfit(xx, yy, fullbkpt=bkpt)
+    return sft
+
+
+def loop_master_flat(maps, xbin):
+    """Reference pixel-loop master flat for an internal flat"""
+    wavemap = maps['wavemap'].data
+    posmap = maps['posmap'].data
+    slicemap = maps['slicemap'].data
+    stacked = maps['sflat'].data
+    newflat = stacked.copy()
+    fitl, fitr = int(4/xbin), int(24/xbin)
+    flatl, flatr = int(34/xbin), int(72/xbin)
+    ffleft, ffright = int(10/xbin), int(70/xbin)
+    buffer = 6.0/float(xbin)
+    q = [i for i, v in enumerate(slicemap.flat) if v == 9]
+    waves = wavemap.compress((wavemap > 0.).flat)
+    wmin, wmax = waves.min(), min([waves.max(), 5620.])
+    dw = (wmax - wmin) / 30.0
+    wavemin, wavemax = (wmin+wmax) / 2.0 - dw, (wmin+wmax) / 2.0 + dw
+    qq = [i for i in q if wavemin < wavemap.flat[i] < wavemax]
+    qflat = [i for i in qq if flatl <= posmap.flat[i] <= flatr]
+    xflat = [posmap.flat[i] for i in qflat]
+    yflat = [stacked.flat[i] for i in qflat]
+    wflat = [wavemap.flat[i] for i in qflat]
+    sw = np.argsort(wflat)
+    ww0 = np.min(wflat)
+    wavelinfit = np.polyfit([wflat[i] - ww0 for i in sw],
+                            [yflat[i] for i in sw], 2)
+    yflat = yflat / np.polyval(wavelinfit, wflat-ww0)
+    ss = np.argsort(xflat)
+    resflat = np.polyfit([xflat[i] for i in ss], [yflat[i] for i in ss], 1)
+    qfit = [i for i in qq if fitl <= posmap.flat[i] <= fitr]
+    xfit = [posmap.flat[i] for i in qfit]
+    yfit = [stacked.flat[i] / np.polyval(wavelinfit, wavemap.flat[i]-ww0)
+            for i in qfit]
+    s = np.argsort(xfit)
+    resfit = np.polyfit([xfit[i] for i in s], [yfit[i] for i in s], 1)
+    xinter = -(resflat[1] - resfit[1]) / (resflat[0] - resfit[0])
+    for i, v in enumerate(posmap.flat):
+        if 0 <= v <= (xinter-buffer):
+            newflat.flat[i] = (resflat[1]+resflat[0]*v) / \
+                (resfit[1]+resfit[0]*v) * stacked.flat[i]
+    qbff = [i for i in qq
+            if (xinter-buffer) <= posmap.flat[i] <= (xinter+buffer)]
+    xbuff = [posmap.flat[i] for i in qbff]
+    ybuff = [stacked.flat[i] / np.polyval(wavelinfit, wavemap.flat[i]-ww0)
+             for i in qbff]
+    ssp = np.argsort(xbuff)
+    buffit = np.polyfit([xbuff[i] for i in ssp], [ybuff[i] for i in ssp], 3)
+    for i, v in enumerate(posmap.flat):
+        if (xinter-buffer) <= v <= (xinter+buffer):
+            newflat.flat[i] = (resflat[1] + resflat[0] * v) / \
+                np.polyval(buffit, v) * newflat.flat[i]
+
+    def select(sl, left, right):
+        qs = [i for i in range(slicemap.size) if slicemap.flat[i] == sl and
+              left <= posmap.flat[i] <= right]
+        xs = wavemap.flat[qs]
+        ys = newflat.flat[qs]
+        s = np.argsort(xs)
+        return xs[s], ys[s]
+    xfr, yfr = select(9, ffleft, ffright)
+    xfb, yfb = select(12, 60 / xbin, 80 / xbin)
+    xfd, yfd = select(23, 60 / xbin, 80 / xbin)
+    sftr = bspline_fit(xfr, yfr, 100)
+    sftb = bspline_fit(xfb, yfb, 100)
+    sftd = bspline_fit(xfd, yfd, 100)
+    yfitr, _ = sftr.value(xfr)
+    minrwave, maxrwave = np.min(xfr), np.max(xfr)
+    waves = np.min(xfb) + (np.max(xfd) - np.min(xfb)) * \
+        np.arange(1001) / 1000
+    wlb0 = minrwave+(maxrwave-minrwave)*0.05
+    wlb1 = minrwave+(maxrwave-minrwave)*0.1
+    wlr0 = minrwave+(maxrwave-minrwave)*0.9
+    wlr1 = minrwave+(maxrwave-minrwave)*0.95
+    qbluefit = [i for i, v in enumerate(waves) if wlb0 < v < wlb1]
+    qredfit = [i for i, v in enumerate(waves) if wlr0 < v < wlr1]
+    bluelinfit = np.polyfit(waves[qbluefit],
+                            sftr.value(waves[qbluefit])[0] /
+                            sftb.value(waves[qbluefit])[0], 1)
+    redlinfit = np.polyfit(waves[qredfit],
+                           sftr.value(waves[qredfit])[0] /
+                           sftd.value(waves[qredfit])[0], 1)
+    qselblue = [i for i, v in enumerate(xfb) if v <= minrwave]
+    qselred = [i for i, v in enumerate(xfd) if v >= maxrwave]
+    blue_offset = yfb[qselblue[-1]] * \
+        (bluelinfit[1]+bluelinfit[0]*xfb[qselblue[-1]]) - yfitr[0]
+    bluefluxes = [yfb[i] * (bluelinfit[1]+bluelinfit[0]*xfb[i]) - blue_offset
+                  for i in qselblue]
+    red_offset = yfd[qselred[0]] * \
+        (redlinfit[1]+redlinfit[0]*xfd[qselred[0]]) - yfitr[-1]
+    redfluxes = [yfd[i] * (redlinfit[1]+redlinfit[0]*xfd[i]) - red_offset
+                 for i in qselred]
+    allx = np.append(np.append(xfb[qselblue], xfr), xfd[qselred])
+    ally = np.append(np.append(bluefluxes, yfr), redfluxes)
+    s = np.argsort(allx)
+    sftall = bspline_fit(allx[s], ally[s], 100)
+
+    comflat = np.zeros(newflat.shape, dtype=float)
+    qz = [i for i, v in enumerate(wavemap.flat) if v >= 0]
+    comflat.flat[qz] = sftall.value(wavemap.flat[qz])[0]
+    ratio = np.zeros(newflat.shape, dtype=float)
+    qzer = [i for i, v in enumerate(newflat.flat) if v != 0]
+    ratio.flat[qzer] = comflat.flat[qzer] / newflat.flat[qzer]
+    flags = np.zeros_like(ratio, dtype=np.uint8)
+    for i, v in enumerate(ratio.flat):
+        if v < 0:
+            ratio.flat[i] = 0.0
+            flags.flat[i] = 8
+    for i, v in enumerate(ratio.flat):
+        if v >= 3. and (posmap.flat[i] <= 4/xbin or
+                        posmap.flat[i] >= 136/xbin):
+            ratio.flat[i] = 0.0
+            flags.flat[i] = 16
+    for i, v in enumerate(newflat.flat):
+        if v < 30.:
+            ratio.flat[i] = 1.0
+            flags.flat[i] = 32
+    return ratio, flags
+
+
+def test_make_master_flat_matches_loop(monkeypatch):
+    xbin = 4
+    maps = make_synthetic_maps(xbin=xbin)
+    ratio, flags = run_make_master_flat(maps, xbin, monkeypatch)
+    expected_ratio, expected_flags = loop_master_flat(maps, xbin)
+    assert ratio.tobytes() == expected_ratio.tobytes()
+    assert np.array_equal(flags, expected_flags)
+    # make sure the low signal clipping was exercised
+    assert np.any(flags == 32)
@@ -0,0 +1,67 @@
+import os
+import types
+
+import numpy as np
+
+from kcwidrp.primitives import MakeMasterSky as mms
+
+
+def make_geometry(rng, ny=200, nx=300):
+    hdr = {'WAVALL0': 3500., 'WAVALL1': 6500.}
+    slc = rng.integers(-1, 25, size=(ny, nx)).astype(float)
+    pos = rng.uniform(-1., 75., size=(ny, nx))
+    pos[0, :5] = np.nan
+    wav = rng.uniform(3000., 7000., size=(ny, nx))
+    wav[1, :5] = np.nan
+    return {key: types.SimpleNamespace(data=img, header=hdr)
+            for key, img in (('wavemap', wav), ('slicemap', slc),
+                             ('posmap', pos))}
+
+
+def test_sky_geometry_selection_matches_loop():
+    rng = np.random.default_rng(8)
+    geometry = make_geometry(rng)
+    geometry['selections'] = {}
+    slc = geometry['slicemap'].data
+    pos = geometry['posmap'].data
+    wav = geometry['wavemap'].data
+    posbuf = 5
+    posmax = np.nanmax(pos)
+    qfit, qout = mms.sky_geometry_selection(geometry, posbuf, dich=True,
+                                            camera=1)
+    expected = [i for i, v in enumerate(slc.flat)
+                if 0 <= v <= 23 and
+                posbuf < pos.flat[i] < (posmax - posbuf) and
+                3500. <= wav.flat[i] <= 6500. and
+                not (v > 20 and wav.flat[i] < 5600.)]
+    assert np.array_equal(np.flatnonzero(qfit), expected)
+    expected = [i for i, v in enumerate(slc.flat)
+                if 0 <= v <= 23 and pos.flat[i] >= 0 and
+                3500. <= wav.flat[i] <= 6500.]
+    assert np.array_equal(np.flatnonzero(qout), expected)
+
+
+def test_sky_geometry_cache(tmp_path, monkeypatch):
+    rng = np.random.default_rng(9)
+    maps = make_geometry(rng)
+    reads = []
+
+    def reader(path, **kwargs):
+        reads.append(path)
+        key = os.path.basename(path).split('_')[-1].split('.')[0]
+        return [maps[key]]
+
+    monkeypatch.setattr(mms, 'kcwi_fits_reader', reader)
+    geom_file = str(tmp_path / 'kb_arc_geom.pkl')
+    map_files = tuple(str(tmp_path / ('kb_arc_%s.fits' % key))
+                      for key in ('wavemap', 'slicemap', 'posmap'))
+    for f in (geom_file,) + map_files:
+        open(f, 'w').close()
+    first = mms.get_sky_geometry(geom_file, map_files)
+    second = mms.get_sky_geometry(geom_file, map_files)
+    assert first is second
+    assert len(reads) == 3
+    # a new geometry solution invalidates the cache
+    os.utime(geom_file, (0, 0))
+    mms.get_sky_geometry(geom_file, map_files)
+    assert len(reads) == 6
@@ -31,4 +31,22 @@ def test_parse_framework_config():
     framework_config_file = 'configs/framework.cfg'
     framework_config_fullpath = pkg_resources.resource_filename(
         pkg, framework_config_file)
-    framework_config = ConfigClass(framework_config_fullpath)
\ No newline at end of file
+    framework_config = ConfigClass(framework_config_fullpath)
+
+def test_kcwi_configs_define_performance_keys():
+
+    keys = ('background_writes', 'write_threads', 'write_queue_size',
+            'product_registry_mb', 'stack_chunk_rows', 'stack_nthreads',
+            'wavesol_cache', 'wavesol_cache_dir', 'wavesol_window',
+            'wavesol_tolerance', 'wavesol_min_xcorr', 'atlas_cache', 'DAR_chunk_size',
+            'DAR_nthreads')
+    for kcwi_config_file in ('configs/kcwi.cfg',
+                             'configs/kcwi_original_CRR.cfg',
+                             'configs/kcwi_koarti.cfg'):
+        kcwi_config_fullpath = pkg_resources.resource_filename(
+            pkg, kcwi_config_file)
+        kcwi_config = ConfigClass(kcwi_config_fullpath,
+                                  default_section='KCWI')
+        for key in keys:
+            assert getattr(kcwi_config, key) is not None, \
+                "%s missing from %s" % (key, kcwi_config_file)
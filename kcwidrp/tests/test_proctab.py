@@ -0,0 +1,102 @@
+from astropy.io import fits
+from astropy.nddata import CCDData
+import numpy as np
+
+from kcwidrp.core.kcwi_proctab import Proctab
+
+
+def make_frame(frameno, imtype, mjd, stateid='abc123', ccdcfg='1111100'):
+    """Minimal frame carrying the header keywords used by the proctab"""
+    hdr = fits.Header()
+    hdr['FRAMENO'] = frameno
+    hdr['STATEID'] = stateid
+    hdr['STATENAM'] = 'test state'
+    hdr['CCDCFG'] = ccdcfg
+    hdr['IMTYPE'] = imtype
+    hdr['GROUPID'] = 'grp1'
+    hdr['TTIME'] = 0.
+    hdr['CAMERA'] = 'BLUE'
+    hdr['IFUNAM'] = 'Large'
+    hdr['BGRATNAM'] = 'BL'
+    hdr['BGRANGLE'] = 10.5
+    hdr['BCWAVE'] = 4500.
+    hdr['BFILTNAM'] = 'KBlue'
+    hdr['BINNING'] = '2,2'
+    hdr['MJD'] = mjd
+    hdr['OFNAME'] = 'kb%05d.fits' % frameno
+    hdr['TARGNAME'] = 'target'
+    hdr['OBJECT'] = 'object'
+    return CCDData(np.zeros((2, 2)), meta=hdr, unit='adu')
+
+
+def test_search_and_nearest(tmp_path):
+    tfil = str(tmp_path / 'kcwi.proc')
+    proctab = Proctab(None)
+    proctab.read_proctab(tfil=tfil)
+    for fno, mjd in ((1, 59000.1), (2, 59000.2), (3, 59000.5)):
+        frame = make_frame(fno, 'ARCLAMP', mjd)
+        proctab.update_proctab(frame, suffix='RAW', filename='a%d' % fno)
+    # replacing a row keeps it unique
+    proctab.update_proctab(make_frame(2, 'ARCLAMP', 59000.2), suffix='int',
+                           filename='a2')
+    assert len(proctab.proctab) == 3
+
+    target = make_frame(10, 'OBJECT', 59000.42)
+    tab = proctab.search_proctab(target, target_type='ARCLAMP')
+    assert list(tab['FRAMENO']) == [1, 2, 3]
+    tab = proctab.search_proctab(target, target_type='ARCLAMP', nearest=True)
+    assert list(tab['FRAMENO']) == [3]
+    tab = proctab.search_proctab(make_frame(11, 'OBJECT', 59000.2,
+                                            stateid='other'),
+                                 target_type='ARCLAMP')
+    assert len(tab) == 0
+    assert proctab.in_proctab(make_frame(1, 'ARCLAMP', 59000.1))
+    assert not proctab.in_proctab(target)
+
+
+def test_journal_and_legacy_format(tmp_path):
+    tfil = str(tmp_path / 'kcwi.proc')
+    proctab = Proctab(None)
+    proctab.read_proctab(tfil=tfil)
+    proctab.update_proctab(make_frame(1, 'BIAS', 59000.1), suffix='RAW',
+                           filename='b1')
+    proctab.write_proctab()
+    assert (tmp_path / 'kcwi.proc.jnl').exists()
+
+    # an unclean shutdown is recovered from the journal
+    recovered = Proctab(None)
+    recovered.read_proctab(tfil=tfil)
+    assert len(recovered.proctab) == 1
+    tab = recovered.search_proctab(make_frame(5, 'OBJECT', 59000.3),
+                                   target_type='BIAS', target_group='grp1')
+    assert list(tab['filename']) == ['b1']
+
+    # compaction writes the legacy fixed-width file and clears the journal
+    recovered.compact_proctab()
+    assert not (tmp_path / 'kcwi.proc.jnl').exists()
+    legacy = proctab.make_table(recovered.rows.values())
+    legacy.write(tfil, format='ascii.fixed_width', overwrite=True)
+    reread = Proctab(None)
+    reread.read_proctab(tfil=tfil)
+    assert list(reread.proctab['CID']) == ['abc123']
+    assert list(reread.proctab['DID']) == [1111100]
+
+
+def test_wait_for_wakes_once(tmp_path):
+    proctab = Proctab(None)
+    proctab.read_proctab(tfil=str(tmp_path / 'kcwi.proc'))
+    target = make_frame(10, 'OBJECT', 59000.42)
+    woken = []
+    proctab.wait_for([proctab.search_key(target, 'MBIAS'),
+                      proctab.search_key(target, 'ARCLAMP')],
+                     lambda: woken.append(1))
+    # different state, nobody is woken
+    proctab.update_proctab(make_frame(1, 'ARCLAMP', 59000.1, stateid='x'),
+                           suffix='RAW', filename='a1')
+    assert woken == []
+    proctab.update_proctab(make_frame(2, 'MBIAS', 59000.1), suffix='mbias',
+                           filename='b2')
+    proctab.update_proctab(make_frame(3, 'ARCLAMP', 59000.3), suffix='RAW',
+                           filename='a3')
+    assert woken == [1]
+    assert len(proctab.search_proctab(target, target_type='MBIAS')) == 1
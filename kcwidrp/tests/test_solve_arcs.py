@@ -0,0 +1,28 @@
+import numpy as np
+
+from kcwidrp.primitives.GetAtlasLines import gaus
+from kcwidrp.primitives.SolveArcs import bar_solve_helper
+
+
+def test_bar_solve_helper_recovers_solution():
+    rng = np.random.default_rng(5)
+    xsvals = np.arange(2000)
+    coeff = [0., 1.e-9, 2.e-6, 0.5, 3600.]
+    waves = np.polyval(coeff, xsvals)
+    at_wave = np.sort(rng.uniform(3650., 4550., 80))
+    at_flux = rng.uniform(500., 20000., 80)
+    bar = np.full(len(xsvals), 20.)
+    for wave, flux in zip(at_wave, at_flux):
+        bar += gaus(xsvals, flux, np.interp(wave, waves, xsvals), 1.3)
+    # start from a slightly shifted solution
+    start = list(coeff)
+    start[-1] += 0.3
+    result = bar_solve_helper({
+        'ib': 7, 'bar': bar, 'coeff': start, 'xsvals': xsvals,
+        'ifuname': 'Medium', 'at_wave': at_wave, 'at_flux': at_flux,
+        'hgt': 50., 'poly_order': 4, 'verbose': False, 'keep_lines': True})
+    assert result['ib'] == 7
+    assert len(result['arc_pix_dat']) > 40
+    assert len(result['lines']) + len(result['rej_wave']) == len(at_wave)
+    assert np.max(np.abs(np.polyval(result['wfit'], xsvals) - waves)) < 0.02
+    assert result['log'][-1].startswith("Coefs: ")
@@ -0,0 +1,36 @@
+import numpy as np
+from scipy.interpolate import interp1d
+
+from kcwidrp.primitives.WavelengthCorrections import resample_cube
+
+
+def test_resample_cube_matches_spaxel_loop():
+    rng = np.random.default_rng(1)
+    wave_old = 3500. + np.arange(400) * 0.5
+    wave_hel = wave_old * (1. + 30. / 2.99792458e5)
+    cube = rng.normal(size=(400, 6, 4))
+    result = resample_cube(cube, wave_hel, wave_old, kind='cubic')
+    for i in range(cube.shape[2]):
+        for j in range(cube.shape[1]):
+            expected = interp1d(wave_hel, cube[:, j, i], kind='cubic',
+                                fill_value='extrapolate')(wave_old)
+            assert np.allclose(result[:, j, i], expected, rtol=0.,
+                               atol=1.e-12)
+
+
+def test_resample_mask_cube_matches_spaxel_loop():
+    rng = np.random.default_rng(2)
+    wave_old = 3500. + np.arange(400) * 0.5
+    wave_hel = wave_old * (1. - 30. / 2.99792458e5)
+    cube = rng.integers(0, 3, size=(400, 6, 4)).astype(np.uint8)
+    result = resample_cube(cube, wave_hel, wave_old, mask=True)
+    assert result.dtype == cube.dtype
+    for i in range(cube.shape[2]):
+        for j in range(cube.shape[1]):
+            spec = cube[:, j, i]
+            spec_pre = interp1d(wave_hel, spec, kind='previous',
+                                bounds_error=False, fill_value=128)(wave_old)
+            spec_nex = interp1d(wave_hel, spec, kind='next',
+                                bounds_error=False, fill_value=128)(wave_old)
+            expected = np.maximum(spec_pre, spec_nex).astype(np.uint8)
+            assert np.array_equal(result[:, j, i], expected)
@@ -0,0 +1,55 @@
+import os
+
+import numpy as np
+from astropy.io import fits
+
+from kcwidrp.core import kcwi_wavesol
+from kcwidrp.core.kcwi_wavesol import wavesol_key, cache_file, cache_key, \
+    read_cache, write_cache
+
+
+def make_header(stateid='abc123', ccdcfg='2211010201'):
+    header = fits.Header()
+    header['STATEID'] = stateid
+    header['CCDCFG'] = ccdcfg
+    return header
+
+
+def test_wavesol_key_tracks_configuration_and_atlas():
+    refwave = np.linspace(3500., 5500., 1000)
+    reflux = np.random.default_rng(3).random(1000)
+    key = wavesol_key(make_header(), 23.4, refwave, reflux, 0.2)
+    assert key == wavesol_key(make_header(), 23.4, refwave.copy(),
+                              reflux.copy(), 0.2)
+    assert key != wavesol_key(make_header(stateid='abc124'), 23.4,
+                              refwave, reflux, 0.2)
+    assert key != wavesol_key(make_header(ccdcfg='1111010201'), 23.4,
+                              refwave, reflux, 0.2)
+    assert key != wavesol_key(make_header(), 23.5, refwave, reflux, 0.2)
+    assert key != wavesol_key(make_header(), 23.4, refwave, reflux, 0.1)
+    reflux[10] += 1.
+    assert key != wavesol_key(make_header(), 23.4, refwave, reflux, 0.2)
+
+
+def test_wavesol_round_trip(tmp_path):
+    file = cache_file(str(tmp_path / 'wavesol'), 'wavesol', 'abc')
+    assert read_cache(file) is None
+    write_cache(file, {'centdisp': [0.5, 0.51], 'twkcoeff': {0: [1.]}})
+    solution = read_cache(file)
+    assert solution['centdisp'] == [0.5, 0.51]
+    assert solution['twkcoeff'] == {0: [1.]}
+    assert [f.name for f in (tmp_path / 'wavesol').iterdir()] == \
+        ['wavesol_abc.pkl']
+
+
+def test_read_cache_serves_copies_from_memory(tmp_path):
+    file = cache_file(str(tmp_path), 'atlas', cache_key('fear', "%.3f" % 2.5))
+    write_cache(file, {'reflux': np.arange(5.)})
+    atlas = read_cache(file)
+    atlas['reflux'] *= 0.
+    assert np.array_equal(read_cache(file)['reflux'], np.arange(5.))
+    # later reads come from memory, a new process reads the file
+    (tmp_path / os.path.basename(file)).unlink()
+    assert read_cache(file) is not None
+    kcwi_wavesol.cache_items.pop(file)
+    assert read_cache(file) is None